@@ -6,7 +6,7 @@ import sys, os, uuid, time
 sys.path.append(os.path.abspath(".."))
 
 from haigha.connection import Connection
-from haigha.message import Message
+from haigha.rpc import RpcServer
 
 connection = Connection(host='localhost', heartbeat=None, debug=True)
 channel = connection.channel()
@@ -24,20 +24,11 @@ def on_request(msg):
     n = int(msg.body)
 
     print " [.] fib(%s)"  % (n,)
-    result = fib(n)
+    return str(fib(n))
 
-    reply_to = msg.properties["reply_to"]
-    correlation_id = msg.properties["correlation_id"]
-    resp = Message(str(result), correlation_id=correlation_id)
-    channel.basic.publish(resp,'',reply_to)
-
-    delivery_info = msg.delivery_info
-    channel.basic.ack(delivery_info["delivery_tag"])
-
-channel.basic.qos(prefetch_count=1)
-channel.basic.consume('rpc_queue', on_request, no_ack=False)
+server = RpcServer(channel, 'rpc_queue', on_request, workers=4, prefetch=16)
+server.start()
 
 print " [x] Awaiting RPC requests"
 while not channel.closed:
     connection.read_frames()
-
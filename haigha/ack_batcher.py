@@ -0,0 +1,156 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+
+class AckBatcher(object):
+
+    '''
+    Coalesces consumer acks on a channel into `basic.ack` frames with
+    multiple=True. Delivery tags are assigned sequentially per channel, so
+    the batcher tracks the contiguous prefix of tags which have been acked
+    locally and acks the whole prefix with a single frame once it has grown
+    by `size` tags, or once the oldest unsent ack is `interval` seconds old.
+    Tags acked out of order beyond a gap are held until the gap closes; if
+    it hasn't closed by the time the interval expires, they are acked
+    individually.
+
+    The batcher must be created before any messages are consumed on the
+    channel and all acks, rejects and nacks for the channel must go through
+    it, otherwise the prefix stops at the first tag it doesn't know about
+    and every later ack falls back to being sent individually. It should
+    not be used on a channel with no_ack consumers.
+
+    The interval is a timer on the connection's timers, so it fires from
+    read_frames(), which waits no longer than the next timer. Keep `size`
+    below the channel's prefetch count, or the broker will stop delivering
+    before a batch fills.
+    '''
+
+    def __init__(self, channel, size=100, interval=0.1):
+        '''
+        Initialize the batcher on a channel.
+        '''
+        self._channel = channel
+        self._size = size
+        self._interval = interval
+
+        # Highest tag in the contiguous run of settled tags, how many of
+        # those tags have been acked locally but not yet sent, and the highest
+        # of those. A multiple ack must name a tag which is still outstanding
+        # on the broker, so it is sent for the latter.
+        self._prefix_end = 0
+        self._unsent = 0
+        self._last_unsent = 0
+
+        # Tags beyond the prefix which were acked locally but not yet sent,
+        # and those which were already settled with the broker.
+        self._acked = set()
+        self._settled = set()
+
+        # Flushes the pending acks once the oldest is `interval` seconds old
+        self._flush_timer = None
+
+        channel.add_close_listener(self._closed_cb)
+
+    @property
+    def pending(self):
+        '''Number of acks which have not been sent to the broker.'''
+        return self._unsent + len(self._acked)
+
+    def ack(self, delivery_tag):
+        '''
+        Acknowledge a delivery. The ack is sent in a batch.
+        '''
+        if delivery_tag <= self._prefix_end:
+            return
+        if self._flush_timer is None:
+            self._flush_timer = self._channel.connection.timers.schedule(
+                self._interval, self.flush)
+        self._acked.add(delivery_tag)
+        self._advance()
+
+        if self._unsent >= self._size:
+            self._flush_prefix()
+
+    def reject(self, delivery_tag, requeue=False):
+        '''
+        Reject a delivery. The reject is sent immediately.
+        '''
+        self._channel.basic.reject(delivery_tag, requeue=requeue)
+        self._settle(delivery_tag)
+
+    def nack(self, delivery_tag, requeue=False):
+        '''
+        Nack a delivery. The nack is sent immediately. Requires a
+        RabbitConnection.
+        '''
+        self._channel.basic.nack(delivery_tag, requeue=requeue)
+        self._settle(delivery_tag)
+
+    def flush(self):
+        '''
+        Send all pending acks now. The contiguous prefix is acked with a
+        single frame and any tags beyond a gap are acked individually.
+        '''
+        self._flush_prefix()
+        if self._acked:
+            for tag in sorted(self._acked):
+                self._channel.basic.ack(tag)
+            self._settled.update(self._acked)
+            self._acked = set()
+        self._cancel_timer()
+
+    def _settle(self, delivery_tag):
+        '''
+        Record a tag which was settled with the broker outside of a batch.
+        '''
+        if delivery_tag > self._prefix_end:
+            self._settled.add(delivery_tag)
+            self._advance()
+
+    def _advance(self):
+        '''
+        Extend the prefix over any tags which follow it.
+        '''
+        while True:
+            tag = self._prefix_end + 1
+            if tag in self._acked:
+                self._acked.remove(tag)
+                self._unsent += 1
+                self._last_unsent = tag
+            elif tag in self._settled:
+                self._settled.remove(tag)
+            else:
+                break
+            self._prefix_end = tag
+
+    def _flush_prefix(self):
+        '''
+        Ack the contiguous prefix with a single frame if it has unsent acks.
+        '''
+        if self._unsent:
+            self._channel.basic.ack(self._last_unsent, multiple=True)
+            self._unsent = 0
+            if not self._acked:
+                self._cancel_timer()
+
+    def _cancel_timer(self):
+        '''
+        Cancel the flush timer, if there is one.
+        '''
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+
+    def _closed_cb(self, channel):
+        '''
+        Callback when the channel closes. The broker requeues everything that
+        was unacked, so drop the pending acks.
+        '''
+        self._acked = set()
+        self._settled = set()
+        self._unsent = 0
+        self._cancel_timer()
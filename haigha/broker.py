@@ -0,0 +1,1520 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+import errno
+import itertools
+import select
+import socket
+import threading
+from collections import deque, OrderedDict
+from logging import root as root_logger
+
+from haigha.clock import monotonic
+from haigha.connection import PROTOCOL_HEADER
+from haigha.frames.frame import Frame
+from haigha.frames.content_frame import ContentFrame
+from haigha.frames.header_frame import HeaderFrame
+from haigha.frames.heartbeat_frame import HeartbeatFrame
+from haigha.frames.method_frame import MethodFrame
+from haigha.reader import Reader
+from haigha.writer import Writer
+
+# Pseudo-queue for RabbitMQ's direct reply-to, see
+# https://www.rabbitmq.com/direct-reply-to.html
+DIRECT_REPLY_TO = 'amq.rabbitmq.reply-to'
+
+
+class LocalBroker(object):
+
+    '''
+    A minimal AMQP 0-9-1 broker which runs in a thread of the current
+    process, for benchmarking and testing haigha without a RabbitMQ. It
+    listens on a loopback port and speaks real frames, parsed and written
+    with haigha's own Frame, Reader and Writer, so clients exercise their
+    whole stack down to the socket:
+
+        broker = LocalBroker().start()
+        connection = Connection(host=broker.host, port=broker.port)
+        ...
+        broker.stop()
+
+    It supports the direct, fanout and topic exchanges and the predeclared
+    amq.* ones, exchange to exchange bindings, exclusive and auto-delete
+    queues, consumers with prefetch limits, get, ack, reject, nack,
+    recover, mandatory returns, publisher confirms, transactions, consumer
+    cancel notifications and direct reply-to. Errors close the channel or
+    connection with the same reply codes as RabbitMQ.
+
+    Nothing is persisted and there are no users, vhosts or headers
+    exchanges. Messages are held in memory until they are consumed, so
+    publishers are throttled only by the prefetch limits of consumers and
+    by the broker stopping reading from connections which have too much
+    output waiting to be sent.
+
+    All the state is owned by a single thread running a select() loop, so
+    the broker uses at most one core and adds a thread handoff to every
+    message. Compare results against each other rather than against a real
+    broker.
+    '''
+
+    # Stop reading from and delivering to a connection while it has more
+    # than this many bytes waiting to be sent
+    OUTPUT_HIGH_WATER = 1048576
+
+    # Maximum number of bytes read from a socket at a time
+    READ_SIZE = 262144
+
+    SERVER_PROPERTIES = {
+        'product': 'haigha LocalBroker',
+        'capabilities': {
+            'publisher_confirms': True,
+            'exchange_exchange_bindings': True,
+            'basic.nack': True,
+            'consumer_cancel_notify': True,
+            'direct_reply_to': True,
+        },
+    }
+
+    def __init__(self, host='127.0.0.1', port=0, frame_max=131072,
+                 channel_max=65535, heartbeat=0, logger=None):
+        self._host = host
+        self._port = port
+        self._frame_max = frame_max
+        self._channel_max = channel_max
+        self._heartbeat = heartbeat
+        self._logger = logger or root_logger
+
+        self._exchanges = {}
+        for name, exchange_type in (('', 'direct'),
+                                    ('amq.direct', 'direct'),
+                                    ('amq.fanout', 'fanout'),
+                                    ('amq.topic', 'topic')):
+            self._exchanges[name] = _Exchange(name, exchange_type)
+        self._queues = {}
+        self._connections = {}
+        self._dirty = set()
+        self._names = itertools.count(1)
+
+        self._listener = None
+        self._wakeup = None
+        self._thread = None
+        self._running = False
+
+        self._stats = {
+            'connections': 0,
+            'published': 0,
+            'delivered': 0,
+            'acked': 0,
+            'returned': 0,
+        }
+
+    @property
+    def host(self):
+        return self._host
+
+    @property
+    def port(self):
+        '''The port being listened on, assigned by the OS if it was 0.'''
+        return self._port
+
+    @property
+    def logger(self):
+        return self._logger
+
+    @property
+    def running(self):
+        return self._running
+
+    @property
+    def stats(self):
+        '''
+        Return a dict of the number of connections accepted and messages
+        published, delivered, acked and returned since the broker started.
+        '''
+        return dict(self._stats)
+
+    def queue_depth(self, name):
+        '''
+        Return the number of messages waiting in a queue, or None if there
+        is no such queue.
+        '''
+        queue = self._queues.get(name)
+        if queue is None:
+            return None
+        return len(queue.messages)
+
+    def start(self):
+        '''
+        Start listening and serving in a daemon thread. Returns self.
+        '''
+        if self._running:
+            return self
+
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((self._host, self._port))
+        listener.listen(128)
+        listener.setblocking(0)
+        self._port = listener.getsockname()[1]
+        self._listener = listener
+
+        # Written to by stop() to wake up the select() loop
+        self._wakeup = socket.socketpair()
+
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._run, name='haigha broker %d' % (self._port))
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        '''
+        Stop serving, close all connections and wait for the thread to exit.
+        '''
+        if not self._running:
+            return
+        self._running = False
+        try:
+            self._wakeup[1].send('x')
+        except EnvironmentError:
+            pass
+        self._thread.join()
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    ###
+    # Event loop
+    ###
+    def _run(self):
+        '''
+        Run loop of the broker thread.
+        '''
+        try:
+            while self._running:
+                self._poll()
+        except Exception:
+            self._logger.exception('broker on port %d failed', self._port)
+            self._running = False
+        finally:
+            for connection in self._connections.values():
+                connection.close()
+            self._listener.close()
+            self._listener = None
+            for sock in self._wakeup:
+                sock.close()
+            self._wakeup = None
+
+    def _poll(self):
+        '''
+        Wait for and handle one round of socket events.
+        '''
+        readers = [self._listener, self._wakeup[0]]
+        writers = []
+        for connection in self._connections.itervalues():
+            if len(connection.output) < self.OUTPUT_HIGH_WATER:
+                readers.append(connection.sock)
+            if connection.output:
+                writers.append(connection.sock)
+
+        try:
+            readable, writable, _ = select.select(
+                readers, writers, [], self._heartbeat_timeout())
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+
+        for sock in readable:
+            if sock is self._listener:
+                self._accept()
+            elif sock is self._wakeup[0]:
+                sock.recv(64)
+            else:
+                connection = self._connections.get(sock)
+                if connection is not None:
+                    connection.read()
+
+        for sock in writable:
+            connection = self._connections.get(sock)
+            if connection is not None:
+                self._dirty.discard(connection)
+                connection.flush()
+
+        # Send what was queued while handling reads straight away rather
+        # than waiting for the next select()
+        while self._dirty:
+            self._dirty.pop().flush()
+
+        self._check_heartbeats()
+
+    def _accept(self):
+        '''
+        Accept a client connection.
+        '''
+        try:
+            sock, _address = self._listener.accept()
+        except EnvironmentError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            raise
+        sock.setblocking(0)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._connections[sock] = _BrokerConnection(self, sock)
+        self._stats['connections'] += 1
+
+    def _heartbeat_timeout(self):
+        '''
+        Return the number of seconds until a connection is next due a
+        heartbeat, or None if no connection uses them.
+        '''
+        timeout = None
+        now = None
+        for connection in self._connections.itervalues():
+            if connection.heartbeat:
+                if now is None:
+                    now = monotonic()
+                due = connection.last_write + connection.heartbeat / 2.0
+                if timeout is None or due - now < timeout:
+                    timeout = max(due - now, 0)
+        return timeout
+
+    def _check_heartbeats(self):
+        '''
+        Send heartbeats on idle connections and close any from which nothing
+        has been read for two heartbeat intervals.
+        '''
+        now = None
+        for connection in self._connections.values():
+            if not connection.heartbeat:
+                continue
+            if now is None:
+                now = monotonic()
+            if now - connection.last_read >= 2 * connection.heartbeat:
+                self._logger.warning(
+                    'broker closing connection without heartbeats')
+                connection.close()
+            elif now - connection.last_write >= connection.heartbeat / 2.0:
+                connection.send(HeartbeatFrame(0))
+                connection.flush()
+
+    ###
+    # Exchanges, queues and routing
+    ###
+    def _generate_name(self, prefix):
+        return '%s%d' % (prefix, next(self._names))
+
+    def _exchange(self, name):
+        '''
+        Return an exchange or raise NOT_FOUND.
+        '''
+        exchange = self._exchanges.get(name)
+        if exchange is None:
+            raise _ChannelError(404, "NOT_FOUND - no exchange '%s'" % (name))
+        return exchange
+
+    def _delete_exchange(self, exchange):
+        '''
+        Delete an exchange and all of its bindings.
+        '''
+        self._exchanges.pop(exchange.name, None)
+        for routing_key, destination in exchange.bindings():
+            exchange.unbind(destination, routing_key)
+            destination.sources.discard((exchange, routing_key))
+        for source, routing_key in list(exchange.sources):
+            self._unbind(source, exchange, routing_key)
+
+    def _bind(self, source, destination, routing_key):
+        source.bind(destination, routing_key)
+        destination.sources.add((source, routing_key))
+
+    def _unbind(self, source, destination, routing_key):
+        '''
+        Remove a binding, and the source exchange if it is auto-delete and
+        that was its last binding.
+        '''
+        source.unbind(destination, routing_key)
+        destination.sources.discard((source, routing_key))
+        if source.auto_delete and not len(source):
+            self._delete_exchange(source)
+
+    def _delete_queue(self, queue):
+        '''
+        Delete a queue, its bindings and its consumers. Returns the number of
+        messages which were in it.
+        '''
+        if self._queues.get(queue.name) is not queue:
+            return 0
+        del self._queues[queue.name]
+        for source, routing_key in list(queue.sources):
+            self._unbind(source, queue, routing_key)
+        for consumer in list(queue.consumers):
+            consumer.channel.consumer_cancelled(consumer)
+        count = len(queue.messages)
+        queue.messages.clear()
+        return count
+
+    def _route(self, exchange_name, routing_key):
+        '''
+        Return the list of queues to which a message should be delivered.
+        '''
+        if exchange_name == '':
+            queue = self._queues.get(routing_key)
+            return [queue] if queue is not None else []
+
+        exchange = self._exchanges.get(exchange_name)
+        if exchange is None:
+            return []
+        queues = []
+        seen = set([exchange])
+        pending = [exchange]
+        while pending:
+            for destination in pending.pop().route(routing_key):
+                if destination in seen:
+                    continue
+                seen.add(destination)
+                if isinstance(destination, _Queue):
+                    queues.append(destination)
+                else:
+                    pending.append(destination)
+        return queues
+
+
+class _AMQPError(Exception):
+
+    '''
+    An error which closes a channel or the connection.
+    '''
+
+    def __init__(self, reply_code, reply_text, class_id=None, method_id=None):
+        super(_AMQPError, self).__init__(reply_code, reply_text)
+        self.reply_code = reply_code
+        self.reply_text = reply_text
+        self.class_id = class_id
+        self.method_id = method_id
+
+
+class _ChannelError(_AMQPError):
+    pass
+
+
+class _ConnectionError(_AMQPError):
+    pass
+
+
+class _Exchange(object):
+
+    '''
+    An exchange and its bindings. Routing results are cached by routing key
+    until the bindings change.
+    '''
+
+    def __init__(self, name, exchange_type, auto_delete=False,
+                 internal=False):
+        self.name = name
+        self.type = exchange_type
+        self.auto_delete = auto_delete
+        self.internal = internal
+        # Exchange to exchange bindings of which this is the destination
+        self.sources = set()
+        self._bindings = OrderedDict()
+        self._routes = {}
+
+    def __len__(self):
+        return sum(len(dests) for dests in self._bindings.itervalues())
+
+    def bindings(self):
+        '''
+        Return a list of (routing_key, destination) pairs.
+        '''
+        return [(routing_key, destination)
+                for routing_key, dests in self._bindings.items()
+                for destination in dests]
+
+    def bind(self, destination, routing_key):
+        self._bindings.setdefault(routing_key, OrderedDict())[destination] = \
+            True
+        self._routes.clear()
+
+    def unbind(self, destination, routing_key):
+        dests = self._bindings.get(routing_key)
+        if dests is not None and dests.pop(destination, None):
+            if not dests:
+                del self._bindings[routing_key]
+            self._routes.clear()
+
+    def route(self, routing_key):
+        '''
+        Return the destinations to which a message with `routing_key` is
+        routed.
+        '''
+        if self.type == 'direct':
+            dests = self._bindings.get(routing_key)
+            return dests.keys() if dests else ()
+
+        destinations = self._routes.get(routing_key)
+        if destinations is None:
+            destinations = []
+            words = routing_key.split('.')
+            for key, dests in self._bindings.iteritems():
+                if self.type == 'fanout' or \
+                        _topic_matches(key.split('.'), words):
+                    destinations.extend(dests)
+            self._routes[routing_key] = destinations
+        return destinations
+
+
+def _topic_matches(pattern, words):
+    '''
+    Return whether a list of routing key words matches the words of a topic
+    binding, where "*" matches exactly one word and "#" matches zero or more.
+    '''
+    def skip_hashes(positions):
+        for i in list(positions):
+            while i < len(pattern) and pattern[i] == '#':
+                i += 1
+                positions.add(i)
+        return positions
+
+    positions = skip_hashes(set([0]))
+    for word in words:
+        matched = set()
+        for i in positions:
+            if i < len(pattern):
+                if pattern[i] == '#':
+                    matched.add(i)
+                elif pattern[i] == '*' or pattern[i] == word:
+                    matched.add(i + 1)
+        if not matched:
+            return False
+        positions = skip_hashes(matched)
+    return len(pattern) in positions
+
+
+class _Queue(object):
+
+    '''
+    A queue, its messages and its consumers, which are delivered to in turn.
+    '''
+
+    def __init__(self, name, owner=None, auto_delete=False):
+        self.name = name
+        self.owner = owner
+        self.auto_delete = auto_delete
+        self.sources = set()
+        self.messages = deque()
+        self.consumers = deque()
+
+    def dispatch(self):
+        '''
+        Deliver messages to consumers until either runs out or no consumer
+        can take any more.
+        '''
+        messages = self.messages
+        consumers = self.consumers
+        while messages and consumers:
+            for _ in xrange(len(consumers)):
+                consumer = consumers[0]
+                consumers.rotate(-1)
+                if consumer.channel.can_deliver(consumer):
+                    consumer.channel.deliver(
+                        consumer, self, messages.popleft())
+                    break
+            else:
+                return
+
+
+class _Message(object):
+
+    '''
+    A published message.
+    '''
+
+    __slots__ = ('exchange', 'routing_key', 'properties', 'body',
+                 'redelivered')
+
+    def __init__(self, exchange, routing_key, properties, body,
+                 redelivered=False):
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.properties = properties
+        self.body = body
+        self.redelivered = redelivered
+
+    def copy(self):
+        return _Message(self.exchange, self.routing_key, self.properties,
+                        self.body, self.redelivered)
+
+
+class _Consumer(object):
+
+    '''
+    A consumer on a queue.
+    '''
+
+    def __init__(self, channel, tag, queue, no_ack, exclusive):
+        self.channel = channel
+        self.tag = tag
+        self.queue = queue
+        self.no_ack = no_ack
+        self.exclusive = exclusive
+        self.outstanding = 0
+
+
+class _Delivery(object):
+
+    '''
+    A message delivered on a channel which hasn't been acked yet.
+    '''
+
+    __slots__ = ('queue', 'message', 'consumer')
+
+    def __init__(self, queue, message, consumer):
+        self.queue = queue
+        self.message = message
+        self.consumer = consumer
+
+
+class _BrokerConnection(object):
+
+    '''
+    The broker side of a client connection. Reads are parsed into frames and
+    handled immediately; frames to send are appended to `output` until the
+    socket is writable.
+    '''
+
+    def __init__(self, broker, sock):
+        self.broker = broker
+        self.sock = sock
+        self.input = ''
+        self.output = bytearray()
+        self.started = False
+        self.closing = False
+        self.closed = False
+        self.channels = {}
+        self.frame_max = broker._frame_max
+        self.heartbeat = 0
+        self.capabilities = {}
+        self.last_read = self.last_write = monotonic()
+
+    def read(self):
+        '''
+        Read from the socket and handle all the complete frames.
+        '''
+        try:
+            data = self.sock.recv(self.broker.READ_SIZE)
+        except EnvironmentError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            self.close()
+            return
+        if not data:
+            self.close()
+            return
+        self.last_read = monotonic()
+
+        # Frame payloads are Readers over this string, so it is never
+        # modified.
+        data = self.input + data if self.input else data
+        if not self.started:
+            if len(data) < len(PROTOCOL_HEADER):
+                self.input = data
+                return
+            if not data.startswith(PROTOCOL_HEADER):
+                self.output.extend(PROTOCOL_HEADER)
+                self.closing = True
+                self.broker._dirty.add(self)
+                return
+            self.started = True
+            data = data[len(PROTOCOL_HEADER):]
+            self._send_start()
+
+        reader = Reader(data)
+        try:
+            frames = Frame.read_frames(reader)
+        except Frame.FrameError as e:
+            self._close_with_error(
+                _ConnectionError(501, 'FRAME_ERROR - %s' % (e), 0, 0))
+            return
+        self.input = data[reader.tell():]
+
+        for frame in frames:
+            if self.closing:
+                break
+            try:
+                self._dispatch(frame)
+            except _ConnectionError as e:
+                self._close_with_error(e)
+
+    def send(self, frame):
+        '''
+        Queue a frame to be sent.
+        '''
+        frame.write_frame(self.output)
+        self.broker._dirty.add(self)
+
+    def send_method(self, channel_id, class_id, method_id, args=None):
+        self.send(MethodFrame(channel_id, class_id, method_id, args))
+
+    def flush(self):
+        '''
+        Send as much output as the socket will take.
+        '''
+        if self.closed:
+            return
+        throttled = len(self.output) >= self.broker.OUTPUT_HIGH_WATER
+        while self.output:
+            try:
+                sent = self.sock.send(self.output)
+            except EnvironmentError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    break
+                self.close()
+                return
+            del self.output[:sent]
+            self.last_write = monotonic()
+
+        if self.closing and not self.output:
+            self.close()
+        elif throttled and \
+                len(self.output) < self.broker.OUTPUT_HIGH_WATER:
+            for channel in self.channels.values():
+                channel.dispatch_queues()
+
+    def close(self):
+        '''
+        Close the socket and release everything held by the connection.
+        '''
+        if self.closed:
+            return
+        self.closed = self.closing = True
+        self.broker._connections.pop(self.sock, None)
+        self.broker._dirty.discard(self)
+        for channel in self.channels.values():
+            channel.cleanup()
+        self.channels.clear()
+        for queue in self.broker._queues.values():
+            if queue.owner is self:
+                self.broker._delete_queue(queue)
+        try:
+            self.sock.close()
+        except EnvironmentError:
+            pass
+
+    def _dispatch(self, frame):
+        '''
+        Handle a frame.
+        '''
+        if frame.type() == HeartbeatFrame.type():
+            return
+
+        if frame.channel_id == 0:
+            if frame.type() != MethodFrame.type():
+                raise _ConnectionError(
+                    505, 'UNEXPECTED_FRAME - on channel 0', 0, 0)
+            self._dispatch_method(frame)
+            return
+
+        channel = self.channels.get(frame.channel_id)
+        if channel is not None:
+            channel.dispatch(frame)
+        elif frame.type() == MethodFrame.type() and \
+                (frame.class_id, frame.method_id) == (20, 10):
+            if frame.channel_id > self.broker._channel_max:
+                raise _ConnectionError(
+                    530, 'NOT_ALLOWED - channel id over channel_max',
+                    20, 10)
+            self.channels[frame.channel_id] = _BrokerChannel(
+                self, frame.channel_id)
+            self.send_method(frame.channel_id, 20, 11,
+                             Writer().write_longstr(''))
+        elif frame.type() == MethodFrame.type() and \
+                (frame.class_id, frame.method_id) == (20, 41):
+            # close-ok for a channel the broker already released
+            pass
+        else:
+            raise _ConnectionError(
+                504, 'CHANNEL_ERROR - channel %d not open' %
+                (frame.channel_id), 0, 0)
+
+    def _dispatch_method(self, frame):
+        '''
+        Handle a method on channel 0.
+        '''
+        args = frame.args
+        method = (frame.class_id, frame.method_id)
+        if method == (10, 11):
+            client_properties = args.read_table()
+            self.capabilities = client_properties.get('capabilities') or {}
+            broker = self.broker
+            self.send_method(0, 10, 30, Writer().
+                             write_short(broker._channel_max).
+                             write_long(broker._frame_max).
+                             write_short(broker._heartbeat))
+
+        elif method == (10, 31):
+            args.read_short()
+            self.frame_max = min(args.read_long() or self.frame_max,
+                                 self.frame_max)
+            self.heartbeat = args.read_short()
+
+        elif method == (10, 40):
+            self.send_method(0, 10, 41, Writer().write_shortstr(''))
+
+        elif method == (10, 50):
+            self.send_method(0, 10, 51)
+            self.closing = True
+
+        elif method == (10, 51):
+            self.close()
+
+        else:
+            raise _ConnectionError(
+                540, 'NOT_IMPLEMENTED - method %d.%d on channel 0' % method,
+                *method)
+
+    def _send_start(self):
+        args = Writer()
+        args.write_octet(0).write_octet(9)
+        args.write_table(self.broker.SERVER_PROPERTIES)
+        args.write_longstr('AMQPLAIN PLAIN').write_longstr('en_US')
+        self.send_method(0, 10, 10, args)
+
+    def _close_with_error(self, error):
+        '''
+        Close the connection because of an error. The client is sent
+        connection.close, and the socket is closed once that is flushed.
+        '''
+        self.broker.logger.warning(
+            'broker closing connection: %d %s',
+            error.reply_code, error.reply_text)
+        for channel in self.channels.values():
+            channel.cleanup()
+        self.channels.clear()
+        self.send_method(0, 10, 50, Writer().
+                         write_short(error.reply_code).
+                         write_shortstr(error.reply_text[:255]).
+                         write_short(error.class_id or 0).
+                         write_short(error.method_id or 0))
+        self.closing = True
+
+
+class _BrokerChannel(object):
+
+    '''
+    The broker side of a channel.
+    '''
+
+    def __init__(self, connection, channel_id):
+        self.connection = connection
+        self.broker = connection.broker
+        self.channel_id = channel_id
+        self.closing = False
+        self.active = True
+
+        self.prefetch_count = 0
+        self.prefetch_global = False
+        self.consumers = OrderedDict()
+        self.unacked = OrderedDict()
+        self.outstanding = 0
+        self.delivery_tag = 0
+        self.last_queue = None
+        self.reply_queue = None
+
+        self.confirm = False
+        self.publish_seq = 0
+        self.transactional = False
+        self.tx_publishes = []
+        self.tx_settles = []
+
+        # [exchange, routing_key, mandatory, properties, size, body parts]
+        # while a published message's content is arriving
+        self.publishing = None
+
+        self._methods = {
+            (20, 20): self._channel_flow,
+            (20, 40): self._channel_close,
+            (20, 41): self._channel_close_ok,
+            (40, 10): self._exchange_declare,
+            (40, 20): self._exchange_delete,
+            (40, 30): self._exchange_bind,
+            (40, 40): self._exchange_unbind,
+            (50, 10): self._queue_declare,
+            (50, 20): self._queue_bind,
+            (50, 30): self._queue_purge,
+            (50, 40): self._queue_delete,
+            (50, 50): self._queue_unbind,
+            (60, 10): self._basic_qos,
+            (60, 20): self._basic_consume,
+            (60, 30): self._basic_cancel,
+            (60, 40): self._basic_publish,
+            (60, 70): self._basic_get,
+            (60, 80): self._basic_ack,
+            (60, 90): self._basic_reject,
+            (60, 100): self._basic_recover_async,
+            (60, 110): self._basic_recover,
+            (60, 120): self._basic_nack,
+            (85, 10): self._confirm_select,
+            (90, 10): self._tx_select,
+            (90, 20): self._tx_commit,
+            (90, 30): self._tx_rollback,
+        }
+
+    def send_method(self, class_id, method_id, args=None):
+        self.connection.send_method(self.channel_id, class_id, method_id,
+                                    args)
+
+    def dispatch(self, frame):
+        '''
+        Handle a frame for this channel.
+        '''
+        frame_type = frame.type()
+        if self.closing:
+            # Everything but close and close-ok is dropped until the client
+            # acknowledges the close.
+            if frame_type == MethodFrame.type() and \
+                    (frame.class_id, frame.method_id) in ((20, 40), (20, 41)):
+                self._methods[(frame.class_id, frame.method_id)](frame.args)
+            return
+
+        if frame_type == MethodFrame.type():
+            if self.publishing is not None:
+                raise _ConnectionError(
+                    505, 'UNEXPECTED_FRAME - expected content header',
+                    frame.class_id, frame.method_id)
+            method = (frame.class_id, frame.method_id)
+            handler = self._methods.get(method)
+            if handler is None:
+                raise _ConnectionError(
+                    540, 'NOT_IMPLEMENTED - method %d.%d' % method, *method)
+            try:
+                handler(frame.args)
+            except _ChannelError as e:
+                if e.class_id is None:
+                    e.class_id, e.method_id = method
+                self._close_with_error(e)
+
+        elif frame_type == HeaderFrame.type():
+            if self.publishing is None or self.publishing[3] is not None:
+                raise _ConnectionError(
+                    505, 'UNEXPECTED_FRAME - content header', 60, 40)
+            self.publishing[3] = frame.properties
+            self.publishing[4] = frame.size
+            if frame.size == 0:
+                self._published()
+
+        elif frame_type == ContentFrame.type():
+            if self.publishing is None or self.publishing[3] is None:
+                raise _ConnectionError(
+                    505, 'UNEXPECTED_FRAME - content body', 60, 40)
+            self.publishing[5].append(str(frame.payload.buffer()))
+            self.publishing[4] -= len(frame.payload)
+            if self.publishing[4] <= 0:
+                self._published()
+
+    def cleanup(self):
+        '''
+        Release everything held by the channel: cancel its consumers and
+        requeue its unacked messages.
+        '''
+        self.publishing = None
+        for consumer in self.consumers.values():
+            self._remove_consumer(consumer)
+        deliveries = self.unacked.values()
+        deliveries.extend(delivery for _, delivery, _ in self.tx_settles)
+        self.unacked.clear()
+        self.tx_settles = []
+        self.tx_publishes = []
+        self._requeue(deliveries)
+        if self.reply_queue is not None:
+            queue = self.broker._queues.get(self.reply_queue)
+            if queue is not None:
+                self.broker._delete_queue(queue)
+            self.reply_queue = None
+
+    ###
+    # Delivery
+    ###
+    def can_deliver(self, consumer):
+        '''
+        Return whether a message can be delivered to a consumer now.
+        '''
+        if not self.active or self.closing or \
+                len(self.connection.output) >= \
+                self.broker.OUTPUT_HIGH_WATER:
+            return False
+        if consumer.no_ack or not self.prefetch_count:
+            return True
+        if self.prefetch_global:
+            return self.outstanding < self.prefetch_count
+        return consumer.outstanding < self.prefetch_count
+
+    def deliver(self, consumer, queue, message):
+        '''
+        Send basic.deliver for a message.
+        '''
+        self.delivery_tag += 1
+        if not consumer.no_ack:
+            self.unacked[self.delivery_tag] = _Delivery(
+                queue, message, consumer)
+            self.outstanding += 1
+            consumer.outstanding += 1
+        args = Writer()
+        args.write_shortstr(consumer.tag).\
+            write_longlong(self.delivery_tag).\
+            write_bit(message.redelivered).\
+            write_shortstr(message.exchange).\
+            write_shortstr(message.routing_key)
+        self._send_message(60, 60, args, message)
+        self.broker._stats['delivered'] += 1
+
+    def dispatch_queues(self):
+        '''
+        Try to deliver to all the queues this channel consumes from, such as
+        after acks free up some of the prefetch window.
+        '''
+        for queue in set(consumer.queue for consumer in
+                         self.consumers.itervalues()):
+            queue.dispatch()
+
+    def consumer_cancelled(self, consumer):
+        '''
+        Called when a consumer's queue is deleted. Clients which support it
+        are sent basic.cancel.
+        '''
+        self._remove_consumer(consumer, delete_queue=False)
+        if self.connection.capabilities.get('consumer_cancel_notify'):
+            self.send_method(60, 30, Writer().
+                             write_shortstr(consumer.tag).write_bit(True))
+
+    def _send_message(self, class_id, method_id, args, message):
+        '''
+        Send a method followed by a message's header and body.
+        '''
+        connection = self.connection
+        connection.send_method(self.channel_id, class_id, method_id, args)
+        connection.send(HeaderFrame(self.channel_id, 60, 0,
+                                    len(message.body), message.properties))
+        for frame in ContentFrame.create_frames(
+                self.channel_id, message.body, connection.frame_max):
+            connection.send(frame)
+
+    def _remove_consumer(self, consumer, delete_queue=True):
+        self.consumers.pop(consumer.tag, None)
+        queue = consumer.queue
+        try:
+            queue.consumers.remove(consumer)
+        except ValueError:
+            return
+        if delete_queue and queue.auto_delete and not queue.consumers:
+            self.broker._delete_queue(queue)
+
+    def _requeue(self, deliveries):
+        '''
+        Put messages back at the head of their queues, in order, and try to
+        deliver them again.
+        '''
+        queues = set()
+        for delivery in reversed(deliveries):
+            if delivery.consumer is not None:
+                delivery.consumer.outstanding -= 1
+            self.outstanding -= 1
+            queue = delivery.queue
+            if self.broker._queues.get(queue.name) is queue:
+                delivery.message.redelivered = True
+                queue.messages.appendleft(delivery.message)
+                queues.add(queue)
+        for queue in queues:
+            queue.dispatch()
+
+    def _settle(self, deliveries, requeue=False):
+        '''
+        Finish with messages which have been acked, rejected or nacked.
+        '''
+        if requeue:
+            self._requeue(deliveries)
+        else:
+            for delivery in deliveries:
+                if delivery.consumer is not None:
+                    delivery.consumer.outstanding -= 1
+                self.outstanding -= 1
+            self.broker._stats['acked'] += len(deliveries)
+        self.dispatch_queues()
+
+    def _take_deliveries(self, delivery_tag, multiple):
+        '''
+        Remove the unacked deliveries for an ack, reject or nack, and return
+        a list of (delivery_tag, delivery) pairs.
+        '''
+        if delivery_tag and delivery_tag not in self.unacked:
+            raise _ChannelError(
+                406, 'PRECONDITION_FAILED - unknown delivery tag %d' %
+                (delivery_tag))
+
+        if multiple:
+            taken = []
+            while self.unacked:
+                tag = next(iter(self.unacked))
+                if delivery_tag and tag > delivery_tag:
+                    break
+                taken.append((tag, self.unacked.pop(tag)))
+            return taken
+
+        if not delivery_tag:
+            raise _ChannelError(
+                406, 'PRECONDITION_FAILED - unknown delivery tag 0')
+        return [(delivery_tag, self.unacked.pop(delivery_tag))]
+
+    def _finish(self, taken, requeue=False):
+        '''
+        Settle deliveries taken for an ack, reject or nack, or hold them
+        until the transaction is committed.
+        '''
+        if self.transactional:
+            self.tx_settles.extend((tag, delivery, requeue)
+                                   for tag, delivery in taken)
+        else:
+            self._settle([delivery for _, delivery in taken], requeue)
+
+    ###
+    # Publishing
+    ###
+    def _published(self):
+        '''
+        Called when all of a published message's content has arrived.
+        '''
+        exchange, routing_key, mandatory, properties, _size, body = \
+            self.publishing
+        self.publishing = None
+
+        reply_to = properties.get('reply_to')
+        if reply_to == DIRECT_REPLY_TO:
+            if self.reply_queue is None:
+                self._close_with_error(_ChannelError(
+                    406, 'PRECONDITION_FAILED - fast reply consumer does '
+                    'not exist', 60, 40))
+                return
+            properties = dict(properties, reply_to=self.reply_queue)
+
+        message = _Message(exchange, routing_key, properties, ''.join(body))
+        self.broker._stats['published'] += 1
+        if self.transactional:
+            self.tx_publishes.append((message, mandatory))
+        else:
+            self._route(message, mandatory)
+
+        if self.confirm:
+            self.publish_seq += 1
+            self.send_method(60, 80, Writer().
+                             write_longlong(self.publish_seq).
+                             write_bit(False))
+
+    def _route(self, message, mandatory):
+        queues = self.broker._route(message.exchange, message.routing_key)
+        if not queues:
+            if mandatory:
+                args = Writer()
+                args.write_short(312).\
+                    write_shortstr('NO_ROUTE').\
+                    write_shortstr(message.exchange).\
+                    write_shortstr(message.routing_key)
+                self._send_message(60, 50, args, message)
+                self.broker._stats['returned'] += 1
+            return
+
+        for i, queue in enumerate(queues):
+            queue.messages.append(message if i == 0 else message.copy())
+            queue.dispatch()
+
+    ###
+    # Channel class
+    ###
+    def _close_with_error(self, error):
+        '''
+        Close the channel because of an error. Frames other than close and
+        close-ok are ignored until the client acknowledges.
+        '''
+        self.broker.logger.warning(
+            'broker closing channel %d: %d %s', self.channel_id,
+            error.reply_code, error.reply_text)
+        self.cleanup()
+        self.closing = True
+        self.send_method(20, 40, Writer().
+                         write_short(error.reply_code).
+                         write_shortstr(error.reply_text[:255]).
+                         write_short(error.class_id or 0).
+                         write_short(error.method_id or 0))
+
+    def _channel_flow(self, args):
+        self.active = bool(args.read_bit())
+        self.send_method(20, 21, Writer().write_bit(self.active))
+        if self.active:
+            self.dispatch_queues()
+
+    def _channel_close(self, args):
+        self.cleanup()
+        self.connection.channels.pop(self.channel_id, None)
+        self.send_method(20, 41)
+
+    def _channel_close_ok(self, args):
+        self.cleanup()
+        self.connection.channels.pop(self.channel_id, None)
+
+    ###
+    # Exchange class
+    ###
+    def _exchange_declare(self, args):
+        args.read_short()
+        name = args.read_shortstr()
+        exchange_type = args.read_shortstr()
+        passive, _durable, auto_delete, internal, nowait = args.read_bits(5)
+        args.read_table()
+
+        exchange = self.broker._exchanges.get(name)
+        if passive:
+            self.broker._exchange(name)
+        elif exchange is None:
+            if exchange_type not in ('direct', 'fanout', 'topic'):
+                raise _ConnectionError(
+                    503, "COMMAND_INVALID - unknown exchange type '%s'" %
+                    (exchange_type), 40, 10)
+            self.broker._exchanges[name] = _Exchange(
+                name, exchange_type, auto_delete, internal)
+        elif exchange.type != exchange_type:
+            raise _ChannelError(
+                406, "PRECONDITION_FAILED - inequivalent arg 'type' for "
+                "exchange '%s': received '%s' but current is '%s'" %
+                (name, exchange_type, exchange.type))
+
+        if not nowait:
+            self.send_method(40, 11)
+
+    def _exchange_delete(self, args):
+        args.read_short()
+        name = args.read_shortstr()
+        if_unused, nowait = args.read_bits(2)
+
+        exchange = self.broker._exchanges.get(name)
+        if exchange is not None:
+            if name == '' or name.startswith('amq.'):
+                raise _ChannelError(
+                    403, "ACCESS_REFUSED - cannot delete exchange '%s'" %
+                    (name))
+            if if_unused and len(exchange):
+                raise _ChannelError(
+                    406, "PRECONDITION_FAILED - exchange '%s' in use" %
+                    (name))
+            self.broker._delete_exchange(exchange)
+
+        if not nowait:
+            self.send_method(40, 21)
+
+    def _exchange_bind(self, args):
+        args.read_short()
+        destination = self.broker._exchange(args.read_shortstr())
+        source = self.broker._exchange(args.read_shortstr())
+        routing_key = args.read_shortstr()
+        nowait = args.read_bit()
+        args.read_table()
+
+        self.broker._bind(source, destination, routing_key)
+        if not nowait:
+            self.send_method(40, 31)
+
+    def _exchange_unbind(self, args):
+        args.read_short()
+        destination = self.broker._exchange(args.read_shortstr())
+        source = self.broker._exchange(args.read_shortstr())
+        routing_key = args.read_shortstr()
+        nowait = args.read_bit()
+        args.read_table()
+
+        self.broker._unbind(source, destination, routing_key)
+        if not nowait:
+            self.send_method(40, 51)
+
+    ###
+    # Queue class
+    ###
+    def _queue(self, name):
+        '''
+        Return a queue or raise NOT_FOUND. An empty name means the last
+        queue declared on the channel.
+        '''
+        name = name or self.last_queue
+        queue = self.broker._queues.get(name)
+        if queue is None:
+            raise _ChannelError(404, "NOT_FOUND - no queue '%s'" % (name))
+        if queue.owner is not None and queue.owner is not self.connection:
+            raise _ChannelError(
+                405, "RESOURCE_LOCKED - cannot obtain exclusive access to "
+                "locked queue '%s'" % (name))
+        return queue
+
+    def _queue_declare(self, args):
+        args.read_short()
+        name = args.read_shortstr()
+        passive, _durable, exclusive, auto_delete, nowait = args.read_bits(5)
+        args.read_table()
+
+        if passive:
+            queue = self._queue(name)
+        else:
+            if not name:
+                name = self.broker._generate_name('amq.gen-')
+            elif name.startswith('amq.') and \
+                    name not in self.broker._queues:
+                raise _ChannelError(
+                    403, "ACCESS_REFUSED - queue name '%s' contains "
+                    "reserved prefix 'amq.'" % (name))
+            queue = self.broker._queues.get(name)
+            if queue is None:
+                queue = _Queue(name, self.connection if exclusive else None,
+                               auto_delete)
+                self.broker._queues[name] = queue
+            else:
+                queue = self._queue(name)
+        self.last_queue = queue.name
+
+        if not nowait:
+            self.send_method(50, 11, Writer().
+                             write_shortstr(queue.name).
+                             write_long(len(queue.messages)).
+                             write_long(len(queue.consumers)))
+
+    def _queue_bind(self, args):
+        args.read_short()
+        queue = self._queue(args.read_shortstr())
+        exchange = self.broker._exchange(args.read_shortstr())
+        routing_key = args.read_shortstr()
+        nowait = args.read_bit()
+        args.read_table()
+
+        if exchange.name == '':
+            raise _ChannelError(
+                403, 'ACCESS_REFUSED - operation not permitted on the '
+                'default exchange')
+        self.broker._bind(exchange, queue, routing_key)
+        if not nowait:
+            self.send_method(50, 21)
+
+    def _queue_unbind(self, args):
+        args.read_short()
+        queue = self._queue(args.read_shortstr())
+        exchange = self.broker._exchange(args.read_shortstr())
+        routing_key = args.read_shortstr()
+        args.read_table()
+
+        self.broker._unbind(exchange, queue, routing_key)
+        self.send_method(50, 51)
+
+    def _queue_purge(self, args):
+        args.read_short()
+        queue = self._queue(args.read_shortstr())
+        nowait = args.read_bit()
+
+        count = len(queue.messages)
+        queue.messages.clear()
+        if not nowait:
+            self.send_method(50, 31, Writer().write_long(count))
+
+    def _queue_delete(self, args):
+        args.read_short()
+        name = args.read_shortstr() or self.last_queue
+        if_unused, if_empty, nowait = args.read_bits(3)
+
+        count = 0
+        if name in self.broker._queues:
+            queue = self._queue(name)
+            if if_unused and queue.consumers:
+                raise _ChannelError(
+                    406, "PRECONDITION_FAILED - queue '%s' in use" % (name))
+            if if_empty and queue.messages:
+                raise _ChannelError(
+                    406, "PRECONDITION_FAILED - queue '%s' not empty" %
+                    (name))
+            count = self.broker._delete_queue(queue)
+
+        if not nowait:
+            self.send_method(50, 41, Writer().write_long(count))
+
+    ###
+    # Basic class
+    ###
+    def _basic_qos(self, args):
+        args.read_long()
+        self.prefetch_count = args.read_short()
+        self.prefetch_global = bool(args.read_bit())
+        self.send_method(60, 11)
+        self.dispatch_queues()
+
+    def _basic_consume(self, args):
+        args.read_short()
+        name = args.read_shortstr()
+        tag = args.read_shortstr()
+        _no_local, no_ack, exclusive, nowait = args.read_bits(4)
+        args.read_table()
+
+        if name == DIRECT_REPLY_TO:
+            if not no_ack:
+                raise _ChannelError(
+                    406, 'PRECONDITION_FAILED - reply consumer cannot '
+                    'acknowledge')
+            if self.reply_queue is not None:
+                raise _ChannelError(
+                    406, 'PRECONDITION_FAILED - reply consumer already set')
+            queue = _Queue(self.broker._generate_name(DIRECT_REPLY_TO + '.'),
+                           self.connection, auto_delete=True)
+            self.broker._queues[queue.name] = queue
+            self.reply_queue = queue.name
+        else:
+            queue = self._queue(name)
+
+        if not tag:
+            tag = self.broker._generate_name('amq.ctag-')
+        elif tag in self.consumers:
+            raise _ConnectionError(
+                530, "NOT_ALLOWED - attempt to reuse consumer tag '%s'" %
+                (tag), 60, 20)
+        if queue.consumers and (
+                exclusive or any(c.exclusive for c in queue.consumers)):
+            raise _ChannelError(
+                403, "ACCESS_REFUSED - queue '%s' in exclusive use" %
+                (queue.name))
+
+        consumer = _Consumer(self, tag, queue, bool(no_ack), bool(exclusive))
+        self.consumers[tag] = consumer
+        queue.consumers.append(consumer)
+        if not nowait:
+            self.send_method(60, 21, Writer().write_shortstr(tag))
+        queue.dispatch()
+
+    def _basic_cancel(self, args):
+        tag = args.read_shortstr()
+        nowait = args.read_bit()
+
+        consumer = self.consumers.get(tag)
+        if consumer is not None:
+            self._remove_consumer(consumer)
+        if not nowait:
+            self.send_method(60, 31, Writer().write_shortstr(tag))
+
+    def _basic_publish(self, args):
+        args.read_short()
+        exchange = args.read_shortstr()
+        routing_key = args.read_shortstr()
+        mandatory, immediate = args.read_bits(2)
+
+        if immediate:
+            raise _ConnectionError(
+                540, 'NOT_IMPLEMENTED - immediate=true', 60, 40)
+        if self.broker._exchange(exchange).internal:
+            raise _ChannelError(
+                403, "ACCESS_REFUSED - cannot publish to internal exchange "
+                "'%s'" % (exchange))
+        self.publishing = [exchange, routing_key, mandatory, None, 0, []]
+
+    def _basic_get(self, args):
+        args.read_short()
+        queue = self._queue(args.read_shortstr())
+        no_ack = args.read_bit()
+
+        if not queue.messages:
+            self.send_method(60, 72, Writer().write_shortstr(''))
+            return
+
+        message = queue.messages.popleft()
+        self.delivery_tag += 1
+        if not no_ack:
+            self.unacked[self.delivery_tag] = _Delivery(queue, message, None)
+            self.outstanding += 1
+        args = Writer()
+        args.write_longlong(self.delivery_tag).\
+            write_bit(message.redelivered).\
+            write_shortstr(message.exchange).\
+            write_shortstr(message.routing_key).\
+            write_long(len(queue.messages))
+        self._send_message(60, 71, args, message)
+        self.broker._stats['delivered'] += 1
+
+    def _basic_ack(self, args):
+        delivery_tag = args.read_longlong()
+        multiple = args.read_bit()
+        self._finish(self._take_deliveries(delivery_tag, multiple))
+
+    def _basic_reject(self, args):
+        delivery_tag = args.read_longlong()
+        requeue = args.read_bit()
+        self._finish(self._take_deliveries(delivery_tag, False), requeue)
+
+    def _basic_nack(self, args):
+        delivery_tag = args.read_longlong()
+        multiple, requeue = args.read_bits(2)
+        self._finish(self._take_deliveries(delivery_tag, multiple), requeue)
+
+    def _basic_recover_async(self, args):
+        args.read_bit()
+        deliveries = self.unacked.values()
+        self.unacked.clear()
+        self._requeue(deliveries)
+
+    def _basic_recover(self, args):
+        self._basic_recover_async(args)
+        self.send_method(60, 111)
+
+    ###
+    # Confirm class
+    ###
+    def _confirm_select(self, args):
+        nowait = args.read_bit()
+        if self.transactional:
+            raise _ChannelError(
+                406, 'PRECONDITION_FAILED - cannot switch from tx to '
+                'confirm mode')
+        self.confirm = True
+        if not nowait:
+            self.send_method(85, 11)
+
+    ###
+    # Tx class
+    ###
+    def _tx_select(self, args):
+        if self.confirm:
+            raise _ChannelError(
+                406, 'PRECONDITION_FAILED - cannot switch from confirm to '
+                'tx mode')
+        self.transactional = True
+        self.send_method(90, 11)
+
+    def _tx_commit(self, args):
+        if not self.transactional:
+            raise _ChannelError(
+                406, 'PRECONDITION_FAILED - channel is not transactional')
+        publishes, self.tx_publishes = self.tx_publishes, []
+        settles, self.tx_settles = self.tx_settles, []
+        for message, mandatory in publishes:
+            self._route(message, mandatory)
+        for _tag, delivery, requeue in settles:
+            self._settle([delivery], requeue)
+        self.send_method(90, 21)
+
+    def _tx_rollback(self, args):
+        if not self.transactional:
+            raise _ChannelError(
+                406, 'PRECONDITION_FAILED - channel is not transactional')
+        self.tx_publishes = []
+        # Acks are forgotten, and the messages are unacked again
+        if self.tx_settles:
+            for tag, delivery, _requeue in self.tx_settles:
+                self.unacked[tag] = delivery
+            self.unacked = OrderedDict(sorted(self.unacked.iteritems()))
+            self.tx_settles = []
+        self.send_method(90, 31)
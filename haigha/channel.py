@@ -12,6 +12,7 @@ from haigha.frames.content_frame import ContentFrame
 from haigha.frames.header_frame import HeaderFrame
 from haigha.frames.method_frame import MethodFrame
 from haigha.exceptions import ChannelError, ChannelClosed, ConnectionClosed
+from haigha.topology import Topology
 
 # Defined here so it's easier to test
 
@@ -70,6 +71,10 @@ class Channel(object):
         # Out-bound mix of pending frames and synchronous callbacks
         self._pending_events = deque()
 
+        # Set while synchronous methods are pipelined; frames are sent
+        # immediately and callbacks queued without waiting. See `Topology`.
+        self._pipelining = False
+
         # Incoming frame buffer
         self._frame_buffer = deque()
 
@@ -211,6 +216,12 @@ class Channel(object):
         self.basic.publish(*args, **kwargs)
         self.tx.commit(cb=cb)
 
+    def topology(self):
+        '''
+        Start a batch of pipelined declarations. See Topology.
+        '''
+        return Topology(self)
+
     def dispatch(self, method_frame):
         '''
         Dispatch a method.
@@ -257,7 +268,7 @@ class Channel(object):
             try:
                 self.dispatch(frame)
             except ProtocolClass.FrameUnderflow:
-                return
+                break
             except (ConnectionClosed, ChannelClosed):
                 # Immediately raise if connection or channel is closed
                 raise
@@ -284,6 +295,12 @@ class Channel(object):
                         self.logger.exception("Channel close failed")
                         pass
 
+        # Deliver partial batches to batch consumers; everything which was
+        # available in this read has now been dispatched.
+        basic = getattr(self, 'basic', None)
+        if basic is not None and basic._batch_consumers:
+            basic.flush_batches()
+
     def next_frame(self):
         '''
         Pop the next frame off the input queue. If the queue is empty, will
@@ -320,7 +337,7 @@ class Channel(object):
         # and the remaining item(s) starts with a sync callback. After careful
         # consideration, it seems that it's safe to assume the len>0 means to
         # buffer the frame. The other advantage here is
-        if not len(self._pending_events):
+        if not len(self._pending_events) or self._pipelining:
             if not self._active and \
                     isinstance(frame, (ContentFrame, HeaderFrame)):
                 raise Channel.Inactive(
@@ -333,7 +350,9 @@ class Channel(object):
         '''
         Add an expectation of a callback to release a synchronous transaction.
         '''
-        if self.connection.synchronous or self._synchronous:
+        if self._pipelining:
+            self._pending_events.append(cb)
+        elif self.connection.synchronous or self._synchronous:
             wrapper = SyncWrapper(cb)
             self._pending_events.append(wrapper)
             while wrapper._read:
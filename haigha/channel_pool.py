@@ -22,24 +22,59 @@ class ChannelPool(object):
     with a max size, as each channel consumes memory on the broker and it is
     possible to exercise memory limit protection seems on the broker due to
     number of channels.
+
+    The pool also honors backpressure on the connection. While the
+    connection is not writable, messages are queued locally and they are
+    sent once the transport has drained to its low watermark.
+
+    If `confirms` is True, the pool uses RabbitMQ publisher confirms instead
+    of transactions and so requires a RabbitConnection. Each channel is put
+    in confirm mode when it is created and carries many messages in flight
+    rather than one transaction at a time, so durable publishing no longer
+    costs a broker round trip per message. The optional `window` caps the
+    number of unconfirmed messages on each channel; a full channel is taken
+    out of the pool until the broker confirms some of its messages. The
+    callback passed to `publish()` is fired when the message is acked. If a
+    channel closes, callbacks for its unconfirmed messages are never fired.
     '''
 
-    def __init__(self, connection, size=None):
+    def __init__(self, connection, size=None, confirms=False, window=None):
         '''Initialize the channel on a connection.'''
         self._connection = connection
         self._free_channels = set()
         self._size = size
+        self._confirms = confirms
+        self._window = window
         self._queue = deque()
         self._channels = 0
 
+        connection.add_writable_listener(self._writable_cb)
+
+    @property
+    def load(self):
+        '''
+        Number of channels which are busy publishing plus the number of
+        messages waiting for a channel.
+        '''
+        return self._channels - len(self._free_channels) + len(self._queue)
+
     def publish(self, *args, **kwargs):
         '''
         Publish a message. Caller can supply an optional callback which will
-        be fired when the transaction is committed. Tries very hard to avoid
+        be fired when the transaction is committed, or when the message is
+        acked in confirm mode. In confirm mode, an optional `nack_cb` will be
+        fired if the broker nacks the message. Tries very hard to avoid
         closed and inactive channels, but a ChannelError or ConnectionError
         may still be raised.
         '''
+        # Stop writing to the connection if the transport has more bytes
+        # buffered than its high watermark allows.
+        if not self._connection.writable:
+            self._queue.append((args, kwargs))
+            return
+
         user_cb = kwargs.pop('cb', None)
+        nack_cb = kwargs.pop('nack_cb', None)
 
         # If the first channel we grab is inactive, continue fetching until
         # we get an active channel, then put the inactive channels back in
@@ -65,19 +100,58 @@ class ChannelPool(object):
             if user_cb is not None:
                 user_cb()
 
-        if channel:
+        if channel and self._confirms:
+            self._publish_confirmed(channel, user_cb, nack_cb, args, kwargs)
+        elif channel:
             channel.publish_synchronous(*args, cb=committed, **kwargs)
         else:
             kwargs['cb'] = user_cb
+            if nack_cb is not None:
+                kwargs['nack_cb'] = nack_cb
             self._queue.append((args, kwargs))
 
+    def _publish_confirmed(self, channel, user_cb, nack_cb, args, kwargs):
+        '''
+        Publish a message on a channel in confirm mode. The channel goes
+        straight back into the pool unless its window is full, in which case
+        it is returned once the broker confirms one of its messages.
+        '''
+        def confirmed(_msg_id, acked):
+            if channel not in self._free_channels and self._has_room(channel):
+                self._free_channels.add(channel)
+                if channel.active:
+                    self._process_queue()
+            if acked:
+                if user_cb is not None:
+                    user_cb()
+            elif nack_cb is not None:
+                nack_cb()
+
+        channel.publish(*args, confirm_cb=confirmed, **kwargs)
+        if self._has_room(channel):
+            self._free_channels.add(channel)
+
+    def _has_room(self, channel):
+        '''
+        Return whether a channel in confirm mode can take another message.
+        '''
+        if channel.closed:
+            return False
+        return not self._window or channel.basic.unconfirmed < self._window
+
     def _process_queue(self):
         '''
-        If there are any message in the queue, process one of them.
+        If there are any message in the queue, process one of them. Nothing
+        is sent while the connection is not writable, and a message which
+        can't be sent goes back to the head of the queue, so that messages
+        always go out in the order they were published.
         '''
-        if len(self._queue):
+        if len(self._queue) and self._connection.writable:
             args, kwargs = self._queue.popleft()
+            queued = len(self._queue)
             self.publish(*args, **kwargs)
+            if len(self._queue) > queued:
+                self._queue.appendleft(self._queue.pop())
 
     def _get_channel(self):
         '''
@@ -97,8 +171,27 @@ class ChannelPool(object):
             rval = self._connection.channel()
             self._channels += 1
             rval.add_close_listener(self._channel_closed_cb)
+            if self._confirms:
+                rval.confirm.select()
             return rval
 
+    def _writable_cb(self, connection):
+        '''
+        Callback when the writable state of the connection changes. Resumes
+        sending queued messages on as many channels as are available. Stops
+        once a message goes back on the queue, such as when every channel is
+        inactive.
+        '''
+        for _ in xrange(len(self._queue)):
+            if not (connection.writable and
+                    (len(self._free_channels) or not self._size or
+                     self._channels < self._size)):
+                break
+            queued = len(self._queue)
+            self._process_queue()
+            if len(self._queue) >= queued:
+                break
+
     def _channel_closed_cb(self, channel):
         '''
         Callback when channel closes.
@@ -6,7 +6,7 @@ https://github.com/agoragames/haigha/blob/master/LICENSE.txt
 
 from collections import deque
 
-from haigha.message import Message
+from haigha.message import DeliveryInfo, Message
 from haigha.writer import Writer
 from haigha.frames.method_frame import MethodFrame
 from haigha.frames.header_frame import HeaderFrame
@@ -35,7 +35,11 @@ class BasicClass(ProtocolClass):
 
         self._consumer_tag_id = 0
         self._pending_consumers = deque()
-        self._consumer_cb = {}
+        # Index of ConsumerRecords by tag, of the lists of tags by the user's
+        # consumer, oldest first, and of the tags which have a batch consumer.
+        self._consumers = {}
+        self._consumer_tags = {}
+        self._batch_consumers = {}
         self._get_cb = deque()
         self._recover_cb = deque()
         self._cancel_cb = deque()
@@ -50,7 +54,11 @@ class BasicClass(ProtocolClass):
         Cleanup all the local data.
         '''
         self._pending_consumers = None
-        self._consumer_cb = None
+        self._consumers = None
+        self._consumer_tags = None
+        for batch in self._batch_consumers.itervalues():
+            batch.clear()
+        self._batch_consumers = None
         self._get_cb = None
         self._recover_cb = None
         self._cancel_cb = None
@@ -81,6 +89,14 @@ class BasicClass(ProtocolClass):
                              'a callable, but got: %r' % (cb,))
         self._return_listener = cb
 
+    @property
+    def consumers(self):
+        '''
+        Return a dict of the ConsumerRecords of the active consumers on this
+        channel, keyed by consumer tag.
+        '''
+        return dict(self._consumers)
+
     def _generate_consumer_tag(self):
         '''
         Generate the next consumer tag.
@@ -111,13 +127,29 @@ class BasicClass(ProtocolClass):
 
     def consume(self, queue, consumer, consumer_tag='', no_local=False,
                 no_ack=True, exclusive=False, nowait=True, ticket=None,
-                cb=None):
+                cb=None, batch_size=None, batch_timeout=None, cancel_cb=None):
         '''
         Start a queue consumer. If `cb` is supplied, will be called when
-        broker confirms that consumer is registered.
+        broker confirms that consumer is registered. `cancel_cb` is recorded
+        with the consumer for brokers which can cancel consumers; see
+        RabbitBasicClass.consume().
+
+        If `batch_size` is supplied, the consumer will be called with a list
+        of up to that many Messages rather than a single one. A batch is
+        delivered once it is full, or otherwise at the end of the read in
+        which its messages arrived. If `batch_timeout` is also supplied, a
+        partial batch is instead held for up to that many seconds across
+        reads while it fills, and any remainder is delivered when the
+        consumer is cancelled. The timeout is a timer on the connection's
+        timers, so it also bounds how long a blocking read waits.
         '''
         nowait = nowait and self.allow_nowait() and not cb
 
+        callback = consumer
+        if batch_size:
+            callback = BatchConsumer(consumer, batch_size, batch_timeout,
+                                     self.channel.connection.timers)
+
         if nowait and consumer_tag == '':
             consumer_tag = self._generate_consumer_tag()
 
@@ -129,25 +161,53 @@ class BasicClass(ProtocolClass):
             write_table({})  # unused according to spec
         self.send_frame(MethodFrame(self.channel_id, 60, 20, args))
 
+        record = ConsumerRecord(consumer_tag, consumer, callback, cancel_cb)
         if not nowait:
-            self._pending_consumers.append((consumer, cb))
+            self._pending_consumers.append((record, cb))
             self.channel.add_synchronous_cb(self._recv_consume_ok)
         else:
-            self._consumer_cb[consumer_tag] = consumer
+            self._add_consumer(record)
 
     def _recv_consume_ok(self, method_frame):
         consumer_tag = method_frame.args.read_shortstr()
-        consumer, cb = self._pending_consumers.popleft()
+        record, cb = self._pending_consumers.popleft()
 
-        self._consumer_cb[consumer_tag] = consumer
+        record.consumer_tag = consumer_tag
+        self._add_consumer(record)
         if cb:
             cb()
 
+    def _add_consumer(self, record):
+        '''
+        Add a consumer record to the index.
+        '''
+        consumer_tag = record.consumer_tag
+        self._consumers[consumer_tag] = record
+        try:
+            self._consumer_tags.setdefault(record.consumer, []).append(
+                consumer_tag)
+        except TypeError:
+            # Unhashable consumers are found by a scan in
+            # _lookup_consumer_tag_by_consumer
+            pass
+
+        if isinstance(record.callback, BatchConsumer):
+            self._batch_consumers[consumer_tag] = record.callback
+
+    def flush_batches(self):
+        '''
+        Deliver the partial batches of any batch consumers which are due.
+        Called by the channel after it has processed the frames from a read.
+        '''
+        for consumer in self._batch_consumers.values():
+            if consumer.due():
+                consumer.flush()
+
     def cancel(self, consumer_tag='', nowait=True, consumer=None, cb=None):
         '''
         Cancel a consumer. Can choose to delete based on a consumer tag or
-        the function which is consuming.  If deleting by function, take care
-        to only use a consumer once per channel.
+        the function which is consuming.  If deleting by function and the
+        function consumes under several tags, the oldest is cancelled.
         '''
         if consumer:
             tag = self._lookup_consumer_tag_by_consumer(consumer)
@@ -183,12 +243,16 @@ class BasicClass(ProtocolClass):
 
         :param callable consumer: consumer function
 
-        :returns: matching consumer tag or None
+        :returns: the oldest matching consumer tag or None
         :rtype: str or None
         '''
-        for (tag, func) in self._consumer_cb.iteritems():
-            if func == consumer:
-                return tag
+        try:
+            tags = self._consumer_tags.get(consumer)
+            return tags[0] if tags else None
+        except TypeError:
+            for (tag, record) in self._consumers.iteritems():
+                if record.consumer == consumer:
+                    return tag
 
     def _purge_consumer_by_tag(self, consumer_tag):
         '''Purge consumer entry from this basic instance
@@ -197,13 +261,26 @@ class BasicClass(ProtocolClass):
 
         :param str consumer_tag:
         '''
-        try:
-            del self._consumer_cb[consumer_tag]
-        except KeyError:
+        record = self._consumers.pop(consumer_tag, None)
+        if record is None:
             self.logger.warning(
                 'no callback registered for consumer tag " %s "', consumer_tag)
-        else:
-            self.logger.info('purged consumer with tag " %s "', consumer_tag)
+            return
+
+        try:
+            tags = self._consumer_tags.get(record.consumer)
+        except TypeError:
+            tags = None
+        if tags and consumer_tag in tags:
+            tags.remove(consumer_tag)
+            if not tags:
+                del self._consumer_tags[record.consumer]
+
+        batch = self._batch_consumers.pop(consumer_tag, None)
+        if batch is not None:
+            batch.flush()
+
+        self.logger.info('purged consumer with tag " %s "', consumer_tag)
 
     def publish(self, msg, exchange, routing_key, mandatory=False,
                 immediate=False, ticket=None):
@@ -259,9 +336,10 @@ class BasicClass(ProtocolClass):
         msg = self._read_msg(method_frame,
                              with_consumer_tag=True, with_message_count=False)
 
-        func = self._consumer_cb.get(msg.delivery_info['consumer_tag'], None)
-        if func:
-            func(msg)
+        record = self._consumers.get(msg.delivery_info['consumer_tag'])
+        if record:
+            record.delivered += 1
+            record.callback(msg)
 
     def get(self, queue, consumer=None, no_ack=True, ticket=None):
         '''
@@ -376,17 +454,12 @@ class BasicClass(ProtocolClass):
         if with_message_count:
             message_count = method_frame.args.read_long()
 
-        delivery_info = {
-            'channel': self.channel,
-            'delivery_tag': delivery_tag,
-            'redelivered': redelivered,
-            'exchange': exchange,
-            'routing_key': routing_key,
-        }
+        delivery_info = DeliveryInfo(self.channel, delivery_tag, redelivered,
+                                     exchange, routing_key)
         if with_consumer_tag:
-            delivery_info['consumer_tag'] = consumer_tag
+            delivery_info.consumer_tag = consumer_tag
         if with_message_count:
-            delivery_info['message_count'] = message_count
+            delivery_info.message_count = message_count
 
         return Message(body=body, delivery_info=delivery_info,
                        **header_frame.properties)
@@ -450,3 +523,88 @@ class BasicClass(ProtocolClass):
             raise self.FrameUnderflow()
 
         return (header_frame, body)
+
+
+class ConsumerRecord(object):
+
+    '''
+    Bookkeeping for a consumer on a channel. `consumer` is the callable that
+    the user passed to consume(), and `callback` is what deliveries are
+    dispatched to, which differs if the consumer is wrapped, e.g. in a
+    BatchConsumer. `delivered` counts the messages dispatched to it.
+    '''
+
+    def __init__(self, consumer_tag, consumer, callback=None, cancel_cb=None):
+        self.consumer_tag = consumer_tag
+        self.consumer = consumer
+        self.callback = consumer if callback is None else callback
+        self.cancel_cb = cancel_cb
+        self.delivered = 0
+
+    def __repr__(self):
+        return '%s[tag: %s, consumer: %r, delivered: %d]' % (
+            self.__class__.__name__, self.consumer_tag, self.consumer,
+            self.delivered)
+
+
+class BatchConsumer(object):
+
+    '''
+    Collects deliveries for a consumer that takes a list of Messages. See
+    BasicClass.consume(). With a `batch_timeout`, a timer on `timers` is
+    scheduled when the first message of a batch arrives and delivers the
+    batch when it expires, unless it has been delivered by then.
+    '''
+
+    def __init__(self, consumer, batch_size, batch_timeout=None,
+                 timers=None):
+        self.consumer = consumer
+        self._batch_size = batch_size
+        self._batch_timeout = batch_timeout
+        self._timers = timers
+        self._messages = []
+        self._timer = None
+
+    def __call__(self, msg):
+        if not self._messages and self._batch_timeout:
+            self._timer = self._timers.schedule(
+                self._batch_timeout, self.flush)
+        self._messages.append(msg)
+        if len(self._messages) >= self._batch_size:
+            self.flush()
+
+    def __len__(self):
+        return len(self._messages)
+
+    def due(self):
+        '''
+        Return whether the partial batch should be delivered at the end of
+        a read, which is when there is no timeout to wait for.
+        '''
+        return bool(self._messages) and not self._batch_timeout
+
+    def flush(self):
+        '''
+        Deliver the current batch, if any.
+        '''
+        self._cancel_timer()
+        if self._messages:
+            messages = self._messages
+            self._messages = []
+            self.consumer(messages)
+
+    def clear(self):
+        '''
+        Drop the current batch without delivering it, such as when the
+        channel has closed.
+        '''
+        self._cancel_timer()
+        self._messages = []
+
+    def _cancel_timer(self):
+        '''
+        Cancel the timeout, if there is one.
+        '''
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
@@ -47,6 +47,16 @@ class ExchangeClass(ProtocolClass):
         exchange - The name of the exchange to declare
         type - One of
         """
+        cache = self.channel.connection.declaration_cache
+        if cache is not None and not passive:
+            key = cache.exchange_key(
+                exchange, type, durable, False, False, arguments)
+            if key in cache:
+                if cb:
+                    cb()
+                return
+            cache.add(key, self.channel_id)
+
         nowait = nowait and self.allow_nowait() and not cb
 
         args = Writer()
@@ -74,6 +84,10 @@ class ExchangeClass(ProtocolClass):
         '''
         Delete an exchange.
         '''
+        cache = self.channel.connection.declaration_cache
+        if cache is not None:
+            cache.discard_exchange(exchange)
+
         nowait = nowait and self.allow_nowait() and not cb
 
         args = Writer()
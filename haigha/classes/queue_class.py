@@ -62,6 +62,17 @@ class QueueClass(ProtocolClass):
         '''
         nowait = nowait and self.allow_nowait() and not cb
 
+        # Server-named queues are new each time, so are never cached. The
+        # counts in a declare-ok change as the queue is used, so a repeat
+        # is only skipped if the caller doesn't need them.
+        cache = self.channel.connection.declaration_cache
+        if cache is not None and queue and not passive:
+            key = cache.queue_key(
+                queue, durable, exclusive, auto_delete, arguments)
+            if nowait and key in cache:
+                return
+            cache.add(key, self.channel_id)
+
         args = Writer()
         args.write_short(ticket or self.default_ticket).\
             write_shortstr(queue).\
@@ -88,6 +99,15 @@ class QueueClass(ProtocolClass):
         '''
         bind to a queue.
         '''
+        cache = self.channel.connection.declaration_cache
+        if cache is not None:
+            key = cache.queue_bind_key(queue, exchange, routing_key, arguments)
+            if key in cache:
+                if cb:
+                    cb()
+                return
+            cache.add(key, self.channel_id)
+
         nowait = nowait and self.allow_nowait() and not cb
 
         args = Writer()
@@ -114,6 +134,11 @@ class QueueClass(ProtocolClass):
         '''
         Unbind a queue from an exchange.  This is always synchronous.
         '''
+        cache = self.channel.connection.declaration_cache
+        if cache is not None:
+            cache.discard(cache.queue_bind_key(
+                queue, exchange, routing_key, arguments))
+
         args = Writer()
         args.write_short(ticket or self.default_ticket).\
             write_shortstr(queue).\
@@ -159,6 +184,10 @@ class QueueClass(ProtocolClass):
         '''
         queue delete.
         '''
+        cache = self.channel.connection.declaration_cache
+        if cache is not None:
+            cache.discard_queue(queue)
+
         nowait = nowait and self.allow_nowait() and not cb
 
         args = Writer()
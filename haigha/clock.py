@@ -0,0 +1,84 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+import sys
+import time
+import warnings
+
+# CLOCK_MONOTONIC by platform, for clock_gettime(2)
+_CLOCK_IDS = {
+    'linux': 1,
+    'darwin': 6,
+    'freebsd': 4,
+}
+
+
+def _clock_gettime(clock_id):
+    '''
+    Return a function which reads a POSIX clock through ctypes, or None if
+    clock_gettime() isn't available.
+    '''
+    try:
+        import ctypes
+        import ctypes.util
+    except ImportError:
+        return None
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    for name in ('rt', 'c'):
+        path = ctypes.util.find_library(name)
+        if path is None:
+            continue
+        try:
+            clock_gettime = ctypes.CDLL(path, use_errno=True).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        clock_gettime.restype = ctypes.c_int
+
+        if clock_gettime(clock_id, ctypes.byref(timespec())) != 0:
+            return None
+
+        # ctypes releases the GIL around the call, so each call needs a
+        # timespec of its own or concurrent readers could see torn values.
+        def gettime():
+            ts = timespec()
+            if clock_gettime(clock_id, ctypes.byref(ts)) != 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, 'clock_gettime failed')
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+        return gettime
+    return None
+
+
+def _find_monotonic():
+    '''
+    Return the best monotonic clock available.
+    '''
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+
+    try:
+        from monotonic import monotonic as backport
+        return backport
+    except ImportError:
+        pass
+
+    for prefix, clock_id in _CLOCK_IDS.iteritems():
+        if sys.platform.startswith(prefix):
+            gettime = _clock_gettime(clock_id)
+            if gettime is not None:
+                return gettime
+
+    warnings.warn('No monotonic clock available, using time.time()')
+    return time.time
+
+
+# Seconds from an arbitrary point which doesn't change, unaffected by changes
+# to the system clock. Use for measuring intervals, never as a timestamp.
+monotonic = _find_monotonic()
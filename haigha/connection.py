@@ -13,13 +13,14 @@ from haigha.classes.channel_class import ChannelClass
 from haigha.classes.exchange_class import ExchangeClass
 from haigha.classes.queue_class import QueueClass
 from haigha.classes.transaction_class import TransactionClass
+from haigha.declaration_cache import DeclarationCache
+from haigha.timers import TimerService
 from haigha.writer import Writer
 from haigha.reader import Reader
 from haigha.transports.transport import Transport
 from exceptions import ConnectionError, ConnectionClosed
 
 import haigha
-import time
 
 from logging import root as root_logger
 
@@ -67,6 +68,12 @@ class Connection(object):
         self._heartbeat = kwargs.get('heartbeat')
         self._open_cb = kwargs.get('open_cb')
         self._close_cb = kwargs.get('close_cb')
+        self._writable_listeners = set()
+
+        if kwargs.get('declaration_cache'):
+            self._declaration_cache = DeclarationCache()
+        else:
+            self._declaration_cache = None
 
         self._login_method = kwargs.get('login_method', 'AMQPLAIN')
         self._locale = kwargs.get('locale', 'en_US')
@@ -98,7 +105,11 @@ class Connection(object):
             0: ConnectionChannel(self, 0, {})
         }
 
-        self._last_octet_time = None
+        # A TimerService may be shared with the connections which replace
+        # this one, so that timers outlive it
+        self._timers = kwargs.get('timers')
+        if self._timers is None:
+            self._timers = TimerService()
 
         # Login response seems a total hack of protocol
         # Skip the length at the beginning
@@ -119,17 +130,17 @@ class Connection(object):
         if not isinstance(transport, Transport):
             if transport == 'event':
                 from haigha.transports.event_transport import EventTransport
-                self._transport = EventTransport(self)
+                self._transport = EventTransport(self, **kwargs)
             elif transport == 'gevent':
                 from haigha.transports.gevent_transport import GeventTransport
-                self._transport = GeventTransport(self)
+                self._transport = GeventTransport(self, **kwargs)
             elif transport == 'gevent_pool':
                 from haigha.transports.gevent_transport import \
                     GeventPoolTransport
                 self._transport = GeventPoolTransport(self, **kwargs)
             elif transport == 'socket':
                 from haigha.transports.socket_transport import SocketTransport
-                self._transport = SocketTransport(self)
+                self._transport = SocketTransport(self, **kwargs)
         else:
             self._transport = transport
 
@@ -182,11 +193,35 @@ class Connection(object):
         return self._close_info if (
             self._closed or not self._connected) else None
 
+    @property
+    def declaration_cache(self):
+        '''
+        The DeclarationCache if the `declaration_cache` option is set, else
+        None.
+        '''
+        return self._declaration_cache
+
+    @property
+    def timers(self):
+        '''The TimerService which runs on each read_frames().'''
+        return self._timers
+
     @property
     def transport(self):
         '''Get the value of the current transport.'''
         return self._transport
 
+    @property
+    def writable(self):
+        '''
+        False if the transport has more unsent bytes buffered than its write
+        high watermark allows, True otherwise. Publishers should stop writing
+        until the connection is writable again. See add_writable_listener().
+        '''
+        if self._transport is None:
+            return True
+        return self._transport.writable
+
     @property
     def synchronous(self):
         '''
@@ -225,8 +260,6 @@ class Connection(object):
         self._transport.connect((host, port))
         self._transport.write(PROTOCOL_HEADER)
 
-        self._last_octet_time = time.time()
-
         if self._synchronous_connect:
             # Have to queue this callback just after connect, it can't go
             # into the constructor because the channel needs to be
@@ -301,9 +334,39 @@ class Connection(object):
         # Call back to a user-provided close function
         self._callback_close()
 
+    def transport_writable_changed(self, writable):
+        '''
+        Called by Transports when their unsent bytes cross the high watermark
+        (writable=False) or drain to the low watermark (writable=True).
+        '''
+        if self._debug:
+            self.logger.debug('transport to %s writable: %s',
+                              self._host, writable)
+        self._notify_writable_listeners()
+
     ###
     # Connection methods
     ###
+    def add_writable_listener(self, listener):
+        '''
+        Add a listener for changes to the writable state of this connection.
+        The listener should be a callable that can take one argument, the
+        connection. Listeners will not be called in any particular order.
+        '''
+        self._writable_listeners.add(listener)
+
+    def remove_writable_listener(self, listener):
+        '''
+        Remove a writable listener. Will do nothing if the listener is not
+        registered.
+        '''
+        self._writable_listeners.discard(listener)
+
+    def _notify_writable_listeners(self):
+        '''Call all the writable listeners.'''
+        for listener in list(self._writable_listeners):
+            listener(self)
+
     def _next_channel_id(self):
         '''Return the next possible channel id.  Is a circular enumeration.'''
         self._channel_counter += 1
@@ -355,6 +418,8 @@ class Connection(object):
             del self._channels[channel.channel_id]
         except KeyError:
             pass
+        if self._declaration_cache is not None:
+            self._declaration_cache.channel_closed(channel)
 
     def close(self, reply_code=0, reply_text='', class_id=0, method_id=0,
               disconnect=False):
@@ -387,6 +452,8 @@ class Connection(object):
         Callback to any close handler that was provided in the ctor. Handler is
         responsible for exceptions.
         '''
+        if self._declaration_cache is not None:
+            self._declaration_cache.clear()
         if self._close_cb:
             self._close_cb()
 
@@ -405,22 +472,22 @@ class Connection(object):
         if self._transport is None:
             return
 
-        # Send a heartbeat (if needed)
-        self._channels[0].send_heartbeat()
-
-        data = self._transport.read(self._heartbeat)
-        current_time = time.time()
+        # Fire any timers which are due, such as heartbeats, and read no
+        # longer than until the next one. If any fired, it may have done what
+        # the caller is waiting for, so don't block on the read.
+        fired = self._timers.fired
+        timeout = self._timers.run()
+        if self._timers.fired != fired:
+            timeout = self._timers.RESOLUTION
 
+        data = self._transport.read(timeout)
         if data is None:
-            # Wait for 2 heartbeat intervals before giving up. See AMQP 4.2.7:
-            # "If a peer detects no incoming traffic (i.e. received octets) for two heartbeat intervals or longer,
-            # it should close the connection"
-            if self._heartbeat and (current_time-self._last_octet_time > 2*self._heartbeat):
-                msg = 'Heartbeats not received from %s for %d seconds' % (self._host, 2*self._heartbeat)
-                self.transport_closed(msg=msg)
-                raise ConnectionClosed('Connection is closed: ' + msg)
+            # Only a read which came back empty shows that the broker has
+            # gone quiet, since its heartbeats may be waiting unread after
+            # the application spent a while away from read_frames().
+            if self._heartbeat:
+                self._channels[0].check_heartbeat()
             return
-        self._last_octet_time = current_time
         reader = Reader(data)
         p_channels = set()
 
@@ -529,7 +596,8 @@ class ConnectionChannel(Channel):
             50: self._recv_close,
             51: self._recv_close_ok,
         }
-        self._last_heartbeat_send = 0
+        self._send_timer = None
+        self._check_timer = None
 
     def dispatch(self, frame):
         '''
@@ -537,7 +605,9 @@ class ConnectionChannel(Channel):
         the stack.
         '''
         if frame.type() == HeartbeatFrame.type():
-            self.send_heartbeat()
+            # Receiving anything counts as a heartbeat, see
+            # _heartbeat_check_cb
+            pass
 
         elif frame.type() == MethodFrame.type():
             if frame.class_id == 10:
@@ -567,20 +637,97 @@ class ConnectionChannel(Channel):
 
     def send_heartbeat(self):
         '''
-        Send a heartbeat if needed. Tracks last heartbeat send time.
+        Send a heartbeat if heartbeats are enabled.
         '''
-        # Note that this does not take into account the time that we last
-        # sent a frame. Hearbeats are so small the effect should be quite
-        # limited. Also note that we're looking for something near to our
-        # scheduled interval, because if this is exact, then we'll likely
-        # actually send a heartbeat at twice the period, which could cause
-        # a broker to kill the connection if the period is large enough. The
-        # 90% bound is arbitrary but seems a sensible enough default.
         if self.connection._heartbeat:
-            if time.time() >= (self._last_heartbeat_send + 0.9 *
-                               self.connection._heartbeat):
-                self.send_frame(HeartbeatFrame(self.channel_id))
-                self._last_heartbeat_send = time.time()
+            self.send_frame(HeartbeatFrame(self.channel_id))
+
+    def _start_heartbeat(self):
+        '''
+        Schedule sending heartbeats and checking for the broker's. Any frame
+        counts as a heartbeat (AMQP 4.2.7), so one is only sent once nothing
+        has been written for 90% of the interval, and a busy connection never
+        sends them. The margin is because if this is exact then the
+        connection may be late reading and sending by up to a period, which
+        could cause a broker to kill the connection if the period is large
+        enough. The 90% bound is arbitrary but seems a sensible enough
+        default.
+        '''
+        self._stop_heartbeat()
+        if self.connection._heartbeat:
+            self.send_heartbeat()
+            self._heartbeat_send_cb()
+            self._heartbeat_check_cb()
+            self.connection.transport.start_heartbeat(
+                self.connection._heartbeat)
+
+    def _stop_heartbeat(self):
+        '''
+        Cancel the heartbeat timers.
+        '''
+        for timer in (self._send_timer, self._check_timer):
+            if timer is not None:
+                timer.cancel()
+        self._send_timer = self._check_timer = None
+
+    def _heartbeat_send_cb(self):
+        '''
+        Send a heartbeat if the connection has been idle for long enough,
+        and schedule this again for when it next could be.
+        '''
+        connection = self.connection
+        transport = connection.transport
+        if transport is None:
+            self._send_timer = None
+            return
+
+        interval = 0.9 * connection._heartbeat
+        idle = connection.timers.clock() - transport.last_write
+        if idle >= interval:
+            self.send_heartbeat()
+            idle = 0
+        self._send_timer = connection.timers.schedule(
+            interval - idle, self._heartbeat_send_cb)
+
+    def _heartbeat_check_cb(self):
+        '''
+        Schedule this again for when nothing could have been read for two
+        heartbeat intervals. Firing bounds the connection's next read, and
+        if that read comes back empty then check_heartbeat() closes the
+        connection.
+        '''
+        connection = self.connection
+        transport = connection.transport
+        if transport is None:
+            self._check_timer = None
+            return
+
+        timeout = 2 * connection._heartbeat
+        silence = connection.timers.clock() - transport.last_read
+        self._check_timer = connection.timers.schedule(
+            max(timeout - silence, 0), self._heartbeat_check_cb)
+
+    def check_heartbeat(self):
+        '''
+        Close the connection if nothing has been read for two heartbeat
+        intervals. The connection calls this when a read comes back empty,
+        so data waiting on the socket is never mistaken for silence. See
+        AMQP 4.2.7: "If a peer detects no incoming traffic (i.e. received
+        octets) for two heartbeat intervals or longer, it should close the
+        connection".
+        '''
+        connection = self.connection
+        transport = connection.transport
+        if self._check_timer is None or transport is None:
+            return
+
+        timeout = 2 * connection._heartbeat
+        if connection.timers.clock() - transport.last_read >= timeout:
+            self._stop_heartbeat()
+            msg = 'Heartbeats not received from %s for %d seconds' % (
+                connection._host, timeout)
+            connection.transport_closed(msg=msg)
+            raise ConnectionClosed('Connection is closed: ' + msg)
 
     def _recv_start(self, method_frame):
         self.connection._closed = False
@@ -612,7 +759,7 @@ class ConnectionChannel(Channel):
 
         # 4.2.7: The client should start sending heartbeats after receiving a
         # Connection.Tune method
-        self.send_heartbeat()
+        self._start_heartbeat()
 
     def _send_tune_ok(self):
         args = Writer()
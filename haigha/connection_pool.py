@@ -0,0 +1,280 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+import errno
+import select
+
+from haigha.channel_pool import ChannelPool
+from haigha.clock import monotonic
+from haigha.connection import Connection
+from haigha.exceptions import ConnectionClosed
+
+
+class ConnectionPool(object):
+
+    '''
+    Spreads channels and publishing over several broker connections, so
+    that throughput isn't bound by a single socket and read loop. The pool
+    keeps `size` connections open, assigned round robin to `hosts`, which
+    may name several nodes of a cluster as "host" or "host:port" strings;
+    by default every connection goes to the `host` and `port` options. The
+    remaining keyword arguments are passed to `connection_class`.
+
+    Each connection has a ChannelPool for `publish()`, which is configured
+    with `channel_pool_size`, `confirms` and `window`. Channels from
+    `channel()` belong to the caller. Which connection serves a call
+    depends on the `policy`:
+
+      least_loaded - the connection with the fewest channels in use and
+                     messages waiting to be published
+      hash         - a connection chosen by hashing a key, which for
+                     publish() is the routing key, so that all the messages
+                     with the same key go through one connection in order
+
+    When a connection closes other than through `close()`, it is replaced
+    with a new connection to the same host. If that fails, the slot is
+    retried every `retry_interval` seconds from `publish()`, `channel()`
+    and `read_frames()`, and is skipped until then; the hash policy moves
+    the keys of a missing connection to the next one. Channels and
+    unpublished messages of the failed connection are lost, as with a
+    single connection.
+
+    With a blocking transport call `read_frames()`, which waits on all the
+    connections at once and reads from those with data. Other transports
+    read in the background as usual.
+    '''
+
+    LEAST_LOADED = 'least_loaded'
+    HASH = 'hash'
+
+    def __init__(self, size=2, hosts=None, policy='least_loaded',
+                 channel_pool_size=None, confirms=False, window=None,
+                 retry_interval=1.0, connection_class=Connection, **kwargs):
+        '''
+        Initialize the pool and open its connections.
+        '''
+        if policy not in (self.LEAST_LOADED, self.HASH):
+            raise ValueError('unknown policy %s' % (policy))
+
+        self._size = size
+        self._policy = policy
+        self._channel_pool_size = channel_pool_size
+        self._confirms = confirms
+        self._window = window
+        self._retry_interval = retry_interval
+        self._connection_class = connection_class
+        self._logger = kwargs.get('logger')
+        self._user_close_cb = kwargs.pop('close_cb', None)
+        self._kwargs = kwargs
+
+        if hosts:
+            self._hosts = [self._parse_host(host) for host in hosts]
+        else:
+            self._hosts = [(kwargs.get('host', 'localhost'),
+                            kwargs.get('port', 5672))]
+
+        self._closed = False
+        self._connections = [None] * size
+        self._channel_pools = [None] * size
+        self._channels = [0] * size
+        self._retry_at = [0] * size
+        self._connecting = set()
+
+        for index in xrange(size):
+            self._connect(index)
+
+    @property
+    def connections(self):
+        '''The open connections.'''
+        return [c for c in self._connections if c is not None]
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def publish(self, *args, **kwargs):
+        '''
+        Publish a message through a connection's ChannelPool. Takes the
+        arguments of ChannelPool.publish(). Raises ConnectionClosed if there
+        is no open connection.
+        '''
+        if self._policy == self.HASH:
+            if 'routing_key' in kwargs:
+                key = kwargs['routing_key']
+            else:
+                key = args[2] if len(args) > 2 else ''
+            index = self._index_for(key)
+        else:
+            index = self._index_for(None)
+        self._channel_pools[index].publish(*args, **kwargs)
+
+    def channel(self, key=None, synchronous=False):
+        '''
+        Open a channel on one of the connections. `key` is used with the hash
+        policy. Raises ConnectionClosed if there is no open connection.
+        '''
+        index = self._index_for(key)
+        connection = self._connections[index]
+        channel = connection.channel(synchronous=synchronous)
+        self._channels[index] += 1
+
+        def closed(_channel):
+            if self._connections[index] is connection:
+                self._channels[index] -= 1
+        channel.add_close_listener(closed)
+        return channel
+
+    def read_frames(self, timeout=None):
+        '''
+        Read frames on each of the connections, and retry those which failed.
+        Connections with a blocking transport are waited on together, for up
+        to `timeout` seconds or until a timer of one of them is due, and only
+        those with data are read, so that a quiet connection doesn't hold up
+        the others. The timers of the rest are run.
+        '''
+        self._retry()
+
+        waiting = {}
+        for connection in self._connections:
+            if connection is None or connection.closed:
+                continue
+            transport = connection.transport
+            fileno = None
+            if transport is not None and transport.synchronous:
+                fileno = transport.fileno()
+            if fileno is None:
+                connection.read_frames()
+                continue
+
+            waiting[fileno] = connection
+            due = connection.timers.timeout()
+            if due is not None and (timeout is None or due < timeout):
+                timeout = due
+
+        if not waiting:
+            return
+        try:
+            readable = select.select(waiting.keys(), [], [], timeout)[0]
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            readable = []
+
+        for fileno, connection in waiting.iteritems():
+            if fileno in readable:
+                connection.read_frames()
+            else:
+                connection.timers.run()
+
+    def close(self, reply_code=0, reply_text='', class_id=0, method_id=0):
+        '''
+        Close all the connections.
+        '''
+        self._closed = True
+        for connection in self._connections:
+            if connection is not None and not connection.closed:
+                connection.close(reply_code, reply_text, class_id, method_id)
+
+    def _parse_host(self, host):
+        '''
+        Return (host, port) for an entry in `hosts`.
+        '''
+        if isinstance(host, tuple):
+            return host
+        if ':' in host:
+            host, port = host.rsplit(':', 1)
+            return host, int(port)
+        return host, self._kwargs.get('port', 5672)
+
+    def _connect(self, index):
+        '''
+        Open the connection for a slot. Returns whether it succeeded.
+        '''
+        host, port = self._hosts[index % len(self._hosts)]
+        kwargs = dict(self._kwargs, host=host, port=port,
+                      close_cb=lambda: self._connection_closed(index))
+        self._connecting.add(index)
+        try:
+            connection = self._connection_class(**kwargs)
+            if connection.closed or connection.transport is None:
+                raise ConnectionClosed(connection.close_info['reply_text'])
+        except Exception:
+            if self._logger:
+                self._logger.exception(
+                    'failed to connect to %s:%s', host, port)
+            self._connections[index] = None
+            self._channel_pools[index] = None
+            self._retry_at[index] = monotonic() + self._retry_interval
+            return False
+        finally:
+            self._connecting.discard(index)
+
+        self._connections[index] = connection
+        self._channel_pools[index] = ChannelPool(
+            connection, size=self._channel_pool_size,
+            confirms=self._confirms, window=self._window)
+        self._channels[index] = 0
+        return True
+
+    def _retry(self):
+        '''
+        Reconnect the slots whose retry interval has passed.
+        '''
+        now = None
+        for index, connection in enumerate(self._connections):
+            if connection is None and not self._closed:
+                now = now or monotonic()
+                if now >= self._retry_at[index]:
+                    self._connect(index)
+
+    def _live(self, index):
+        connection = self._connections[index]
+        return connection is not None and not connection.closed
+
+    def _index_for(self, key):
+        '''
+        Return the slot of the connection which should serve a key, or the
+        least loaded one if the key is None or the policy isn't hash.
+        '''
+        self._retry()
+
+        if self._policy == self.HASH and key is not None:
+            start = hash(key) % self._size
+            for offset in xrange(self._size):
+                index = (start + offset) % self._size
+                if self._live(index):
+                    return index
+        else:
+            best = None
+            best_load = None
+            for index in xrange(self._size):
+                if self._live(index):
+                    load = self._channels[index] + \
+                        self._channel_pools[index].load
+                    if best is None or load < best_load:
+                        best = index
+                        best_load = load
+            if best is not None:
+                return best
+
+        raise ConnectionClosed('no connection is open in the pool')
+
+    def _connection_closed(self, index):
+        '''
+        Close callback of the connection in a slot. Replaces the connection
+        unless the pool is being closed.
+        '''
+        self._connections[index] = None
+        self._channel_pools[index] = None
+        self._channels[index] = 0
+        self._retry_at[index] = monotonic() + self._retry_interval
+
+        # A connection which closes while it is being opened is retried
+        # later rather than recursively.
+        if not self._closed and index not in self._connecting:
+            self._connect(index)
+        if self._user_close_cb:
+            self._user_close_cb()
@@ -4,13 +4,14 @@ Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
 https://github.com/agoragames/haigha/blob/master/LICENSE.txt
 '''
 
-from collections import deque
+from collections import deque, OrderedDict
 import copy
 
 from haigha.connection import Connection
 from haigha.classes.basic_class import BasicClass
 from haigha.classes.exchange_class import ExchangeClass
 from haigha.classes.protocol_class import ProtocolClass
+from haigha.exceptions import ChannelClosed
 from haigha.writer import Writer
 from haigha.frames.method_frame import MethodFrame
 
@@ -74,6 +75,16 @@ class RabbitExchangeClass(ExchangeClass):
         exchange - The name of the exchange to declare
         type - One of
         """
+        cache = self.channel.connection.declaration_cache
+        if cache is not None and not passive:
+            key = cache.exchange_key(
+                exchange, type, durable, auto_delete, internal, arguments)
+            if key in cache:
+                if cb:
+                    cb()
+                return
+            cache.add(key, self.channel_id)
+
         nowait = nowait and self.allow_nowait() and not cb
 
         args = Writer()
@@ -93,6 +104,16 @@ class RabbitExchangeClass(ExchangeClass):
         '''
         Bind an exchange to another.
         '''
+        cache = self.channel.connection.declaration_cache
+        if cache is not None:
+            key = cache.exchange_bind_key(
+                exchange, source, routing_key, arguments)
+            if key in cache:
+                if cb:
+                    cb()
+                return
+            cache.add(key, self.channel_id)
+
         nowait = nowait and self.allow_nowait() and not cb
 
         args = Writer()
@@ -119,6 +140,11 @@ class RabbitExchangeClass(ExchangeClass):
         '''
         Unbind an exchange from another.
         '''
+        cache = self.channel.connection.declaration_cache
+        if cache is not None:
+            cache.discard(cache.exchange_bind_key(
+                exchange, source, routing_key, arguments))
+
         nowait = nowait and self.allow_nowait() and not cb
 
         args = Writer()
@@ -155,12 +181,14 @@ class RabbitBasicClass(BasicClass):
 
         self._ack_listener = None
         self._nack_listener = None
+        self._ack_range_listener = None
+        self._nack_range_listener = None
 
         self._msg_id = 0
         self._last_ack_id = 0
-
-        # Mapping of active consumer tags to user's consumer cancel callbacks
-        self._broker_cancel_cb_map = dict()
+        self._confirms = ConfirmTracker()
+        self._confirm_window = None
+        self._window_queue = deque()
 
     def _cleanup(self):
         '''
@@ -168,9 +196,105 @@ class RabbitBasicClass(BasicClass):
         '''
         self._ack_listener = None
         self._nack_listener = None
-        self._broker_cancel_cb_map = None
+        self._ack_range_listener = None
+        self._nack_range_listener = None
+        self._confirms = None
+        self._window_queue = None
         super(RabbitBasicClass, self)._cleanup()
 
+    @property
+    def unconfirmed(self):
+        '''
+        Number of messages published in confirm mode which have not yet been
+        acked or nacked by the broker.
+        '''
+        return self._confirms.outstanding
+
+    @property
+    def confirm_window(self):
+        '''
+        Maximum number of unconfirmed messages allowed in flight, or None if
+        publishing is not limited.
+        '''
+        return self._confirm_window
+
+    @property
+    def pending_publishes(self):
+        '''
+        Number of publishes held back because the confirm window is full.
+        '''
+        return len(self._window_queue)
+
+    def set_confirm_window(self, window):
+        '''
+        Limit the number of unconfirmed messages in flight on this channel
+        when it is in publisher confirm mode. Once `window` messages are
+        waiting on an ack or nack, further publishes are held back until the
+        broker confirms earlier ones. On a synchronous channel, publish()
+        reads frames until there is room in the window; otherwise the message
+        is queued, publish() returns None, and it is sent in order as soon as
+        the window allows. Use a `confirm_cb` to learn the id of a queued
+        message. A window of None or 0 removes the limit and sends any queued
+        messages immediately. Queued messages are discarded if the channel
+        closes.
+        '''
+        self._confirm_window = window or None
+        self._release_window()
+
+    # Probably a better solution here, like functools
+    def publish(self, *args, **kwargs):
+        '''
+        Publish a message. Will return the id of the message if publisher
+        confirmations are enabled, else will return 0. If a confirm window
+        is set and full, the message is queued and None is returned; see
+        set_confirm_window().
+
+        Accepts an optional `confirm_cb` keyword argument in confirm mode,
+        which will be called when the broker acks or nacks this message.
+
+        confirm_cb(message_id, acked)
+        '''
+        if self._confirm_window and self.channel.confirm._enabled:
+            if self.channel.synchronous:
+                self._wait_for_window()
+            elif self._window_queue or \
+                    self._confirms.outstanding >= self._confirm_window:
+                self._window_queue.append((args, kwargs))
+                return None
+        return self._publish(*args, **kwargs)
+
+    def _publish(self, *args, **kwargs):
+        '''
+        Assign the message an id if in confirm mode and send it.
+        '''
+        confirm_cb = kwargs.pop('confirm_cb', None)
+        if self.channel.confirm._enabled:
+            self._msg_id += 1
+            self._confirms.add(self._msg_id, confirm_cb)
+        super(RabbitBasicClass, self).publish(*args, **kwargs)
+        return self._msg_id
+
+    def _wait_for_window(self):
+        '''
+        Read frames until the confirm window has room for another message.
+        '''
+        while True:
+            if self.channel.closed:
+                raise ChannelClosed()
+            if self._confirms.outstanding < self._confirm_window:
+                break
+            self.channel.connection.read_frames()
+
+    def _release_window(self):
+        '''
+        Send queued publishes while the confirm window has room.
+        '''
+        while self._window_queue and (
+                not self._confirm_window or
+                self._confirms.outstanding < self._confirm_window):
+            args, kwargs = self._window_queue.popleft()
+            self._publish(*args, **kwargs)
+
     def set_ack_listener(self, cb):
         '''
         Set a callback for ack listening, to be used when the channel is
@@ -192,29 +316,44 @@ class RabbitBasicClass(BasicClass):
         '''
         self._nack_listener = cb
 
-    # Probably a better solution here, like functools
-    def publish(self, *args, **kwargs):
+    def set_ack_range_listener(self, cb):
         '''
-        Publish a message. Will return the id of the message if publisher
-        confirmations are enabled, else will return 0.
+        Set a callback for ack listening which is called once per contiguous
+        range of message ids that the broker acked, rather than once per
+        message. Will be called with the first and last ids of the range,
+        inclusive. A multiple ack covering any number of messages results in
+        a single call unless some of those messages were confirmed earlier.
+
+        cb(first_message_id, last_message_id)
         '''
-        if self.channel.confirm._enabled:
-            self._msg_id += 1
-        super(RabbitBasicClass, self).publish(*args, **kwargs)
-        return self._msg_id
+        self._ack_range_listener = cb
+
+    def set_nack_range_listener(self, cb):
+        '''
+        Set a callback for nack listening which is called once per contiguous
+        range of message ids that the broker nacked. See
+        set_ack_range_listener().
+
+        cb(first_message_id, last_message_id, requeue)
+        '''
+        self._nack_range_listener = cb
 
     def _recv_ack(self, method_frame):
         '''Receive an ack from the broker.'''
-        if self._ack_listener:
+        if self._ack_listener or self._ack_range_listener or \
+                self._confirms.outstanding:
             delivery_tag = method_frame.args.read_longlong()
             multiple = method_frame.args.read_bit()
-            if multiple:
-                while self._last_ack_id < delivery_tag:
-                    self._last_ack_id += 1
+            self._confirm(delivery_tag, multiple, True, False)
+
+            if self._ack_listener:
+                if multiple:
+                    while self._last_ack_id < delivery_tag:
+                        self._last_ack_id += 1
+                        self._ack_listener(self._last_ack_id)
+                else:
+                    self._last_ack_id = delivery_tag
                     self._ack_listener(self._last_ack_id)
-            else:
-                self._last_ack_id = delivery_tag
-                self._ack_listener(self._last_ack_id)
 
     def nack(self, delivery_tag, multiple=False, requeue=False):
         '''Send a nack to the broker.'''
@@ -226,20 +365,43 @@ class RabbitBasicClass(BasicClass):
 
     def _recv_nack(self, method_frame):
         '''Receive a nack from the broker.'''
-        if self._nack_listener:
+        if self._nack_listener or self._nack_range_listener or \
+                self._confirms.outstanding:
             delivery_tag = method_frame.args.read_longlong()
             multiple, requeue = method_frame.args.read_bits(2)
-            if multiple:
-                while self._last_ack_id < delivery_tag:
-                    self._last_ack_id += 1
+            self._confirm(delivery_tag, multiple, False, requeue)
+
+            if self._nack_listener:
+                if multiple:
+                    while self._last_ack_id < delivery_tag:
+                        self._last_ack_id += 1
+                        self._nack_listener(self._last_ack_id, requeue)
+                else:
+                    self._last_ack_id = delivery_tag
                     self._nack_listener(self._last_ack_id, requeue)
-            else:
-                self._last_ack_id = delivery_tag
-                self._nack_listener(self._last_ack_id, requeue)
+
+    def _confirm(self, delivery_tag, multiple, acked, requeue):
+        '''
+        Mark published messages as confirmed and call the range listener and
+        any per-message callbacks.
+        '''
+        ranges, callbacks = self._confirms.confirm(delivery_tag, multiple)
+
+        if acked and self._ack_range_listener:
+            for first, last in ranges:
+                self._ack_range_listener(first, last)
+        elif not acked and self._nack_range_listener:
+            for first, last in ranges:
+                self._nack_range_listener(first, last, requeue)
+
+        for msg_id, cb in callbacks:
+            cb(msg_id, acked)
+
+        self._release_window()
 
     def consume(self, queue, consumer, consumer_tag='', no_local=False,
                 no_ack=True, exclusive=False, nowait=True, ticket=None,
-                cb=None, cancel_cb=None):
+                cb=None, cancel_cb=None, batch_size=None, batch_timeout=None):
         '''Start a queue consumer.
 
         Accepts the following optional arg in addition to those of
@@ -258,18 +420,18 @@ class RabbitBasicClass(BasicClass):
         if not consumer_tag:
             consumer_tag = self._generate_consumer_tag()
 
-        self._broker_cancel_cb_map[consumer_tag] = cancel_cb
-
         # Start consumer
         super(RabbitBasicClass, self).consume(queue, consumer, consumer_tag,
                                               no_local, no_ack, exclusive,
-                                              nowait, ticket, cb)
+                                              nowait, ticket, cb,
+                                              batch_size, batch_timeout,
+                                              cancel_cb)
 
     def cancel(self, consumer_tag='', nowait=True, consumer=None, cb=None):
         '''
         Cancel a consumer. Can choose to delete based on a consumer tag or
-        the function which is consuming.  If deleting by function, take care
-        to only use a consumer once per channel.
+        the function which is consuming.  If deleting by function and the
+        function consumes under several tags, the oldest is cancelled.
         '''
         # Remove the consumer's broker-cancel callback entry
         if consumer:
@@ -277,9 +439,10 @@ class RabbitBasicClass(BasicClass):
             if tag:
                 consumer_tag = tag
 
-        try:
-            del self._broker_cancel_cb_map[consumer_tag]
-        except KeyError:
+        record = self._consumers.get(consumer_tag)
+        if record is not None:
+            record.cancel_cb = None
+        else:
             self.logger.warning(
                 'cancel: no broker-cancel-cb entry for consumer tag %r '
                 '(consumer %r)', consumer_tag, consumer)
@@ -300,14 +463,15 @@ class RabbitBasicClass(BasicClass):
         # broker
 
         # Remove consumer from this basic instance
-        try:
-            cancel_cb = self._broker_cancel_cb_map.pop(consumer_tag)
-        except KeyError:
+        record = self._consumers.get(consumer_tag)
+        if record is None:
             # Must be a race condition between user's cancel and broker's cancel
             self.logger.warning(
                 '_recv_cancel: no broker-cancel-cb entry for consumer tag %r',
                 consumer_tag)
         else:
+            cancel_cb = record.cancel_cb
+            record.cancel_cb = None
             if callable(cancel_cb):
                 # Purge from base class only when user supplies cancel_cb
                 self._purge_consumer_by_tag(consumer_tag)
@@ -335,16 +499,22 @@ class RabbitConfirmClass(ProtocolClass):
     def name(self):
         return 'confirm'
 
-    def select(self, nowait=True, cb=None):
+    def select(self, nowait=True, cb=None, window=None):
         '''
-        Set this channel to use publisher confirmations.
+        Set this channel to use publisher confirmations. If `window` is set,
+        at most that many messages may be unconfirmed at once; see
+        RabbitBasicClass.set_confirm_window().
         '''
         nowait = nowait and self.allow_nowait() and not cb
 
+        if window is not None:
+            self.channel.basic.set_confirm_window(window)
+
         if not self._enabled:
             self._enabled = True
             self.channel.basic._msg_id = 0
             self.channel.basic._last_ack_id = 0
+            self.channel.basic._confirms = ConfirmTracker()
             args = Writer()
             args.write_bit(nowait)
 
@@ -358,3 +528,96 @@ class RabbitConfirmClass(ProtocolClass):
         cb = self._select_cb.popleft()
         if cb:
             cb()
+
+
+class ConfirmTracker(object):
+
+    '''
+    Tracks the ids of messages published in confirm mode until the broker
+    acks or nacks them. Outstanding ids are stored as a sorted list of
+    disjoint [first, last] ranges; since ids are assigned sequentially and
+    the broker almost always confirms in order, this is nearly always a
+    single range and both publishing and confirming any number of messages
+    are O(1). Optional per-message callbacks are kept in publish order so
+    that only the messages which have one cost anything extra.
+    '''
+
+    def __init__(self):
+        self._ranges = []
+        self._outstanding = 0
+        self._callbacks = OrderedDict()
+
+    @property
+    def outstanding(self):
+        '''Number of messages which have not been confirmed.'''
+        return self._outstanding
+
+    def add(self, msg_id, cb=None):
+        '''
+        Track a newly published message. Ids must be added in increasing
+        order.
+        '''
+        if self._ranges and self._ranges[-1][1] == msg_id - 1:
+            self._ranges[-1][1] = msg_id
+        else:
+            self._ranges.append([msg_id, msg_id])
+        self._outstanding += 1
+        if cb is not None:
+            self._callbacks[msg_id] = cb
+
+    def confirm(self, delivery_tag, multiple=False):
+        '''
+        Confirm `delivery_tag`, or every outstanding message up to and
+        including it if `multiple`. Returns a tuple of the list of
+        (first, last) ranges that were outstanding and are now confirmed, and
+        the list of (msg_id, cb) pairs for those which had a callback.
+        '''
+        if multiple:
+            ranges = self._confirm_through(delivery_tag)
+            callbacks = []
+            while self._callbacks:
+                msg_id = next(iter(self._callbacks))
+                if msg_id > delivery_tag:
+                    break
+                callbacks.append(self._callbacks.popitem(last=False))
+        else:
+            ranges = self._confirm_one(delivery_tag)
+            cb = self._callbacks.pop(delivery_tag, None)
+            callbacks = [(delivery_tag, cb)] if cb is not None else []
+
+        for first, last in ranges:
+            self._outstanding -= last - first + 1
+        return ranges, callbacks
+
+    def _confirm_through(self, delivery_tag):
+        '''Remove all outstanding ids up to and including delivery_tag.'''
+        confirmed = []
+        while self._ranges and self._ranges[0][0] <= delivery_tag:
+            first, last = self._ranges[0]
+            if last <= delivery_tag:
+                del self._ranges[0]
+                confirmed.append((first, last))
+            else:
+                self._ranges[0][0] = delivery_tag + 1
+                confirmed.append((first, delivery_tag))
+        return confirmed
+
+    def _confirm_one(self, delivery_tag):
+        '''Remove a single outstanding id.'''
+        for i, (first, last) in enumerate(self._ranges):
+            if delivery_tag < first:
+                break
+            if delivery_tag > last:
+                continue
+
+            if first == last:
+                del self._ranges[i]
+            elif delivery_tag == first:
+                self._ranges[i][0] = first + 1
+            elif delivery_tag == last:
+                self._ranges[i][1] = last - 1
+            else:
+                self._ranges[i][1] = delivery_tag - 1
+                self._ranges.insert(i + 1, [delivery_tag + 1, last])
+            return [(delivery_tag, delivery_tag)]
+        return []
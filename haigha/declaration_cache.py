@@ -0,0 +1,128 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+
+class DeclarationCache(object):
+
+    '''
+    Remembers the exchanges, queues and bindings which have been declared on
+    a connection, so that declaring one again with identical arguments can
+    be skipped instead of costing a frame and often a round trip. Enable it
+    with the `declaration_cache` connection option.
+
+    Entries are keyed on the kind of declaration and all of its arguments,
+    so a declaration which differs in any way is still sent, and the broker
+    can still reject it. Passive declarations and server-named queues are
+    never cached. A repeat queue.declare is only skipped when the caller
+    doesn't need its result; one made with a callback or nowait=False is
+    always sent, because the message and consumer counts it returns are
+    live values which the cache can't keep current.
+
+    The entries made on a channel are dropped when it closes, since the
+    broker may delete auto-delete and exclusive objects with it. If the
+    broker closes a channel with 404 (not found) or 406 (precondition
+    failed), something declared may no longer exist or may differ from what
+    was cached, so the whole cache is cleared. Deleting an exchange or queue
+    drops it and its bindings, and unbinding drops the binding. The cache is
+    cleared when the connection closes.
+    '''
+
+    INVALIDATING_CODES = (404, 406)
+
+    def __init__(self):
+        # key -> channel_id
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    @staticmethod
+    def exchange_key(exchange, type, durable, auto_delete, internal,
+                     arguments):
+        return ('exchange', exchange, type, bool(durable), bool(auto_delete),
+                bool(internal), _freeze(arguments))
+
+    @staticmethod
+    def queue_key(queue, durable, exclusive, auto_delete, arguments):
+        return ('queue', queue, bool(durable), bool(exclusive),
+                bool(auto_delete), _freeze(arguments))
+
+    @staticmethod
+    def queue_bind_key(queue, exchange, routing_key, arguments):
+        return ('queue_bind', queue, exchange, routing_key,
+                _freeze(arguments))
+
+    @staticmethod
+    def exchange_bind_key(exchange, source, routing_key, arguments):
+        return ('exchange_bind', exchange, source, routing_key,
+                _freeze(arguments))
+
+    def add(self, key, channel_id):
+        '''
+        Record a declaration made on a channel.
+        '''
+        self._entries.setdefault(key, channel_id)
+
+    def discard(self, key):
+        '''
+        Forget a declaration.
+        '''
+        self._entries.pop(key, None)
+
+    def discard_exchange(self, exchange):
+        '''
+        Forget an exchange and all the bindings to and from it.
+        '''
+        for key in self._entries.keys():
+            kind = key[0]
+            if (kind == 'exchange' and key[1] == exchange) or \
+                    (kind == 'queue_bind' and key[2] == exchange) or \
+                    (kind == 'exchange_bind' and exchange in key[1:3]):
+                del self._entries[key]
+
+    def discard_queue(self, queue):
+        '''
+        Forget a queue and all its bindings.
+        '''
+        for key in self._entries.keys():
+            if key[0] in ('queue', 'queue_bind') and key[1] == queue:
+                del self._entries[key]
+
+    def clear(self):
+        '''
+        Forget everything.
+        '''
+        self._entries.clear()
+
+    def channel_closed(self, channel):
+        '''
+        Called when a channel on the connection closes.
+        '''
+        if channel.close_info and \
+                channel.close_info['reply_code'] in self.INVALIDATING_CODES:
+            self.clear()
+            return
+
+        channel_id = channel.channel_id
+        for key, entry in self._entries.items():
+            if entry == channel_id:
+                del self._entries[key]
+
+
+def _freeze(value):
+    '''
+    Return a hashable copy of a declaration argument.
+    '''
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.iteritems()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if value is None:
+        return ()
+    return value
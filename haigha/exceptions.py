@@ -23,3 +23,13 @@ class ChannelError(Exception):
 class ChannelClosed(ChannelError):
 
     '''The channel is closed. Fatal.'''
+
+
+class RpcError(Exception):
+
+    '''Base class for all rpc errors.'''
+
+
+class RpcTimeout(RpcError):
+
+    '''An rpc call did not receive a reply in time.'''
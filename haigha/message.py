@@ -11,6 +11,8 @@ class Message(object):
     Represents an AMQP message.
     '''
 
+    __slots__ = ('_body', '_delivery_info', '_return_info', '_properties')
+
     def __init__(self, body='', delivery_info=None, return_info=None,
                  **properties):
         '''
@@ -51,8 +53,8 @@ class Message(object):
 
     @property
     def delivery_info(self):
-        '''delivery_info dict if message was received via basic.deliver or
-        basic.get_ok; None otherwise.
+        '''DeliveryInfo if message was received via basic.deliver or
+        basic.get_ok; None otherwise. Can be used as a dict.
         '''
         return self._delivery_info
 
@@ -74,8 +76,133 @@ class Message(object):
     def properties(self):
         return self._properties
 
+    def __getstate__(self):
+        return (self._body, self._delivery_info, self._return_info,
+                self._properties)
+
+    def __setstate__(self, state):
+        (self._body, self._delivery_info, self._return_info,
+         self._properties) = state
+
     def __str__(self):
         return ("Message[body: %s, delivery_info: %s, return_info: %s, "
                 "properties: %s]") %\
             (str(self._body).encode('string_escape'),
              self._delivery_info, self.return_info, self._properties)
+
+
+class DeliveryInfo(object):
+
+    '''
+    The delivery information of a received message. This is a compact,
+    slotted record which supports the read-only dict interface, and item
+    assignment of its fields, so that it can be used in place of the dict
+    that was previously built for every message. The `consumer_tag` key is
+    only present for messages received via basic.deliver, and the
+    `message_count` key only for those received via basic.get_ok. Any other
+    key can be assigned too, and is kept in a dict which is only created
+    when one is. A pickled DeliveryInfo leaves out the channel.
+    '''
+
+    _FIELDS = ('channel', 'delivery_tag', 'redelivered', 'exchange',
+               'routing_key', 'consumer_tag', 'message_count')
+
+    __slots__ = _FIELDS + ('_extra',)
+
+    def __init__(self, channel, delivery_tag, redelivered, exchange,
+                 routing_key, **kwargs):
+        self.channel = channel
+        self.delivery_tag = delivery_tag
+        self.redelivered = redelivered
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self._extra = None
+        for key, value in kwargs.iteritems():
+            self[key] = value
+
+    def __getitem__(self, key):
+        if key in self._FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                pass
+        elif self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self._FIELDS:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __contains__(self, key):
+        if key in self._FIELDS:
+            return hasattr(self, key)
+        return self._extra is not None and key in self._extra
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if isinstance(other, (DeliveryInfo, dict)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        rval = self.__eq__(other)
+        if rval is NotImplemented:
+            return rval
+        return not rval
+
+    __hash__ = None
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        keys = [key for key in self._FIELDS if hasattr(self, key)]
+        if self._extra:
+            keys.extend(self._extra)
+        return keys
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def copy(self):
+        '''Return a dict of the delivery information.'''
+        return dict(self.items())
+
+    def __getstate__(self):
+        state = self.copy()
+        state.pop('channel', None)
+        return state
+
+    def __setstate__(self, state):
+        self.channel = None
+        self._extra = None
+        for key, value in state.iteritems():
+            self[key] = value
+
+    def __repr__(self):
+        return repr(self.copy())
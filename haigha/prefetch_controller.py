@@ -0,0 +1,159 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+from haigha.clock import monotonic
+
+
+class PrefetchController(object):
+
+    '''
+    Adapts the prefetch count of a channel to the speed of its consumers.
+    The controller wraps the consumer callbacks to measure how long they
+    take, and counts deliveries and acks to track how many messages are
+    unacked. Every `interval` seconds it picks the prefetch count which
+    would take the consumers about `target_delay` seconds to work through,
+    clamped to [`min_prefetch`, `max_prefetch`], and re-issues basic.qos if
+    that differs from the current value. Fast consumers get a deep window
+    that hides the broker round trip; slow consumers get a shallow one so
+    that messages don't pile up in memory.
+
+    The prefetch count only grows if the window was full at some point in
+    the interval, since a larger window can't help while the broker isn't
+    being throttled by it. It at most doubles or halves per adjustment.
+
+    Acks and rejects must go through the controller so that it can track
+    the unacked depth. It forwards them to `acker`, which defaults to the
+    channel's basic class and may instead be an AckBatcher.
+
+    Adjustments are made by a repeating timer on the connection's timers,
+    which fires from read_frames(), so that basic.qos is never sent from
+    within a consumer callback, and which bounds how long a blocking read
+    waits.
+    '''
+
+    def __init__(self, channel, min_prefetch=1, max_prefetch=1000,
+                 initial_prefetch=None, target_delay=0.5, interval=1.0,
+                 acker=None):
+        '''
+        Initialize the controller on a channel and send the initial
+        basic.qos. Defaults to starting at `min_prefetch`.
+        '''
+        self._channel = channel
+        self._min_prefetch = min_prefetch
+        self._max_prefetch = max_prefetch
+        self._target_delay = target_delay
+        self._interval = interval
+        self._acker = acker or channel.basic
+
+        self._prefetch = None
+        self._unacked = 0
+        self._peak_unacked = 0
+        self._callbacks = 0
+        self._callback_time = 0.0
+
+        self.set_prefetch(initial_prefetch or min_prefetch)
+
+        self._adjust_timer = channel.connection.timers.repeat(
+            interval, self.adjust)
+        channel.add_close_listener(self._closed_cb)
+
+    @property
+    def prefetch(self):
+        '''The current prefetch count.'''
+        return self._prefetch
+
+    @property
+    def unacked(self):
+        '''Number of delivered messages which have not been acked.'''
+        return self._unacked
+
+    def consumer(self, consumer):
+        '''
+        Wrap a consumer callback so that its deliveries and latency are
+        measured. Pass the result to basic.consume().
+        '''
+        def wrapper(msg):
+            self._unacked += 1
+            if self._unacked > self._peak_unacked:
+                self._peak_unacked = self._unacked
+            start = monotonic()
+            try:
+                consumer(msg)
+            finally:
+                self._callbacks += 1
+                self._callback_time += monotonic() - start
+        return wrapper
+
+    def ack(self, delivery_tag):
+        '''
+        Acknowledge a delivery.
+        '''
+        self._acker.ack(delivery_tag)
+        self._settled()
+
+    def reject(self, delivery_tag, requeue=False):
+        '''
+        Reject a delivery.
+        '''
+        self._acker.reject(delivery_tag, requeue=requeue)
+        self._settled()
+
+    def set_prefetch(self, prefetch_count):
+        '''
+        Send basic.qos with a new prefetch count.
+        '''
+        self._prefetch = prefetch_count
+        self._channel.basic.qos(prefetch_count=prefetch_count)
+
+    def target_prefetch(self):
+        '''
+        Return the prefetch count the controller would choose based on the
+        measurements since the last adjustment, or None if no consumer
+        callback completed in that time.
+        '''
+        if not self._callbacks:
+            return None
+
+        latency = self._callback_time / self._callbacks
+        if latency > 0:
+            target = int(self._target_delay / latency)
+        else:
+            target = self._max_prefetch
+
+        if target > self._prefetch:
+            if self._peak_unacked < self._prefetch:
+                return self._prefetch
+            target = min(target, self._prefetch * 2)
+        elif target < self._prefetch:
+            target = max(target, self._prefetch // 2)
+        return min(max(target, self._min_prefetch), self._max_prefetch)
+
+    def adjust(self):
+        '''
+        Re-issue basic.qos if the target prefetch count has changed, and
+        start a new measurement interval.
+        '''
+        target = self.target_prefetch()
+        self._peak_unacked = self._unacked
+        self._callbacks = 0
+        self._callback_time = 0.0
+
+        if target is not None and target != self._prefetch:
+            self.set_prefetch(target)
+
+    def _settled(self):
+        '''
+        Record that a delivery has been acked or rejected.
+        '''
+        if self._unacked > 0:
+            self._unacked -= 1
+
+    def _closed_cb(self, channel):
+        '''
+        Callback when the channel closes.
+        '''
+        self._adjust_timer.cancel()
+        self._unacked = 0
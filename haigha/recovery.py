@@ -0,0 +1,801 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+from collections import deque, OrderedDict
+from logging import root as root_logger
+import time
+
+from haigha.clock import monotonic
+from haigha.connection import Connection
+from haigha.exceptions import ChannelClosed, ConnectionClosed
+from haigha.timers import TimerService
+
+
+class RecoveringConnection(object):
+
+    '''
+    A connection which reconnects when its transport drops or the broker
+    closes it, and restores what was set up on it, so that applications
+    don't have to rebuild their channels, topology and consumers by hand.
+    Keyword arguments are passed to `connection_class`, which may be a
+    RabbitConnection.
+
+    Channels from `channel()` are RecoveringChannels, which keep working
+    across reconnects. They record the exchanges, queues and bindings
+    declared through them, their qos and publisher confirm settings and
+    their consumers. After reconnecting, the topology is declared again in
+    its original order, pipelined on a channel of its own, and then each
+    channel is re-opened with its qos, confirms and consumers. Messages
+    published in confirm mode which were not acked or nacked before the
+    connection dropped are published again, so they may be delivered twice.
+    Messages published while disconnected are held and sent on recovery.
+
+    Delivery tags start again from 1 on a new channel, so the channels
+    offset them to keep them increasing across reconnects. Acks, rejects
+    and nacks for messages delivered before a reconnect are dropped, since
+    the broker has already requeued those messages.
+
+    A reconnect is attempted as soon as the connection closes, then with
+    exponential backoff from `initial_delay` up to `max_delay` seconds
+    whenever `read_frames()` or `recover()` is called. On a blocking
+    transport read_frames() sleeps until the next attempt. After
+    `max_attempts` failed attempts, if set, the connection gives up and
+    closes. `recover_cb` is called with the connection after each recovery,
+    and `recovery_time` is how long the last one took from the connection
+    dropping to the consumers being restored.
+
+    Every Connection shares the TimerService in `timers`, so that timers
+    scheduled on it carry over across reconnects. While disconnected they
+    are run by read_frames().
+
+    Server-named queues, transactions and passive declarations are not
+    recovered. A channel which the broker closes because of an error is not
+    re-opened.
+    '''
+
+    def __init__(self, connection_class=Connection, initial_delay=0.5,
+                 max_delay=30.0, max_attempts=None, recover_cb=None,
+                 **kwargs):
+        '''
+        Initialize and open the connection.
+        '''
+        self._connection_class = connection_class
+        self._initial_delay = initial_delay
+        self._max_delay = max_delay
+        self._max_attempts = max_attempts
+        self._recover_cb = recover_cb
+        self._close_cb = kwargs.pop('close_cb', None)
+        self._logger = kwargs.get('logger', root_logger)
+        self._kwargs = kwargs
+
+        transport = kwargs.get('transport', 'socket')
+        self._blocking = transport == 'socket' or \
+            getattr(transport, 'synchronous', False)
+
+        self._channels = []
+        self._topology = OrderedDict()
+        self._writable_listeners = set()
+        self._timers = TimerService()
+
+        self._closed = False
+        self._connection = None
+        self._generation = 0
+        self._connecting = False
+        self._attempts = 0
+        self._next_attempt = 0
+        self._disconnected_at = None
+        self._recoveries = 0
+        self._recovery_time = None
+
+        self._connection = self._connect()
+
+    @property
+    def connection(self):
+        '''The current Connection, or None while disconnected.'''
+        return self._connection
+
+    @property
+    def logger(self):
+        return self._logger
+
+    @property
+    def timers(self):
+        '''The TimerService shared by each Connection.'''
+        return self._timers
+
+    @property
+    def closed(self):
+        '''Whether the connection was closed and will not recover.'''
+        return self._closed
+
+    @property
+    def recovering(self):
+        '''Whether the connection is down and waiting to reconnect.'''
+        return self._connection is None and not self._closed
+
+    @property
+    def synchronous(self):
+        if self._connection is None:
+            return self._blocking
+        return self._connection.synchronous
+
+    @property
+    def writable(self):
+        return self._connection is not None and self._connection.writable
+
+    @property
+    def recoveries(self):
+        '''Number of times the connection has recovered.'''
+        return self._recoveries
+
+    @property
+    def recovery_time(self):
+        '''Seconds the last recovery took, or None if there was none.'''
+        return self._recovery_time
+
+    def channel(self, synchronous=False):
+        '''
+        Open a RecoveringChannel.
+        '''
+        channel = RecoveringChannel(self, synchronous)
+        self._channels.append(channel)
+        return channel
+
+    def add_writable_listener(self, listener):
+        '''
+        Add a writable listener which moves to each new connection.
+        '''
+        self._writable_listeners.add(listener)
+        if self._connection is not None:
+            self._connection.add_writable_listener(listener)
+
+    def remove_writable_listener(self, listener):
+        self._writable_listeners.discard(listener)
+        if self._connection is not None:
+            self._connection.remove_writable_listener(listener)
+
+    def read_frames(self):
+        '''
+        Read frames from the connection, or try to reconnect if it is down.
+        '''
+        if self._connection is not None:
+            self._connection.read_frames()
+        elif not self._closed:
+            fired = self._timers.fired
+            timeout = self._timers.run()
+            delay = self._next_attempt - monotonic()
+            if delay > 0:
+                if not self._blocking or self._timers.fired != fired:
+                    return
+                if timeout is not None and timeout < delay:
+                    time.sleep(timeout)
+                    return
+                time.sleep(delay)
+            self.recover()
+
+    def recover(self):
+        '''
+        Try to reconnect now if the connection is down. Returns whether the
+        connection is up.
+        '''
+        if self._connection is not None:
+            return True
+        if self._closed:
+            return False
+
+        self._attempts += 1
+        try:
+            connection = self._connect()
+        except Exception:
+            self._logger.exception('failed to reconnect, attempt %d',
+                                   self._attempts)
+            if self._max_attempts and self._attempts >= self._max_attempts:
+                self._give_up()
+            else:
+                delay = min(self._initial_delay * 2 ** (self._attempts - 1),
+                            self._max_delay)
+                self._next_attempt = monotonic() + delay
+            return False
+
+        self._connection = connection
+        self._attempts = 0
+        self._restore()
+        return True
+
+    def close(self, reply_code=0, reply_text='', class_id=0, method_id=0):
+        '''
+        Close the connection without recovering.
+        '''
+        self._closed = True
+        if self._connection is not None:
+            self._connection.close(reply_code, reply_text, class_id,
+                                   method_id)
+        elif self._close_cb:
+            self._close_cb()
+
+    def _connect(self):
+        '''
+        Open a new Connection and move the listeners to it.
+        '''
+        self._generation += 1
+        generation = self._generation
+        kwargs = dict(self._kwargs, timers=self._timers,
+                      close_cb=lambda: self._connection_closed(generation))
+
+        self._connecting = True
+        try:
+            connection = self._connection_class(**kwargs)
+        finally:
+            self._connecting = False
+        if connection.closed or connection.transport is None or \
+                generation != self._generation:
+            raise ConnectionClosed('connection closed while opening')
+
+        for listener in self._writable_listeners:
+            connection.add_writable_listener(listener)
+        return connection
+
+    def _connection_closed(self, generation):
+        '''
+        Close callback of each Connection.
+        '''
+        if generation != self._generation:
+            return
+        if self._connecting:
+            # Fails the attempt in _connect()
+            self._generation += 1
+            return
+
+        connection = self._connection
+        self._connection = None
+        if self._closed:
+            if self._close_cb:
+                self._close_cb()
+            return
+
+        self._logger.warning('connection lost: %s, recovering',
+                             (connection.close_info or {}).get('reply_text'))
+        self._disconnected_at = monotonic()
+        self._attempts = 0
+        self._next_attempt = 0
+        for channel in self._channels:
+            channel._abandon(connection)
+        self.recover()
+
+    def _give_up(self):
+        '''
+        Stop recovering and close.
+        '''
+        self._logger.error('giving up after %d attempts to reconnect',
+                           self._attempts)
+        self._closed = True
+        for channel in self._channels[:]:
+            channel._closed_cb(None)
+        if self._close_cb:
+            self._close_cb()
+
+    def _restore(self):
+        '''
+        Restore the topology and channels on a new connection.
+        '''
+        connection = self._connection
+        for channel in self._channels:
+            channel._open(connection)
+
+        if not self._topology:
+            self._restored(None)
+            return
+
+        channel = connection.channel()
+        topology = channel.topology()
+        for method, args, kwargs in self._topology.itervalues():
+            getattr(topology, method)(*args, **kwargs)
+        try:
+            topology.execute(
+                cb=lambda _results: self._restored(channel),
+                err_cb=lambda error: self._restored(channel, error))
+        except ChannelClosed:
+            # Synchronous connections raise after calling err_cb
+            pass
+
+    def _restored(self, channel, error=None):
+        '''
+        Called when the topology has been restored. Restores the consumers
+        and unconfirmed messages.
+        '''
+        if error is not None:
+            self._logger.error('failed to restore topology: %s', error)
+        elif channel is not None:
+            channel.close()
+
+        for recovering_channel in self._channels:
+            recovering_channel._resume()
+
+        self._recoveries += 1
+        if self._disconnected_at is not None:
+            self._recovery_time = monotonic() - self._disconnected_at
+            self._logger.info('recovered in %.3fs', self._recovery_time)
+        if self._recover_cb:
+            self._recover_cb(self)
+
+    def _record(self, key, method, args, kwargs):
+        '''
+        Record a declaration for recovery. See Topology for the methods.
+        '''
+        self._topology[key] = (method, args, kwargs)
+
+    def _forget(self, match):
+        '''
+        Forget the declarations whose keys satisfy `match`.
+        '''
+        for key in self._topology.keys():
+            if match(key):
+                del self._topology[key]
+
+    def _channel_closed(self, channel):
+        '''
+        Called when a RecoveringChannel closes for good.
+        '''
+        if channel in self._channels:
+            self._channels.remove(channel)
+
+
+class RecoveringChannel(object):
+
+    '''
+    A channel of a RecoveringConnection. It has the same interface as a
+    Channel and records what is needed to restore it on a new connection.
+    Attributes which aren't recorded are those of the current Channel.
+    '''
+
+    def __init__(self, connection, synchronous=False):
+        self._connection = connection
+        self._synchronous = synchronous
+        self._channel = None
+        self._closed = False
+        self._close_listeners = set()
+
+        self._qos = None
+        self._confirm = None
+        self._consumers = OrderedDict()
+        self._consumer_tag_id = 0
+
+        self._msg_id = 0
+        self._unconfirmed = OrderedDict()
+        self._held = deque()
+
+        # Delivery tags seen on the current Channel are offset by the tags
+        # seen on all the previous ones.
+        self._tag_offset = 0
+        self._last_tag = 0
+
+        self.exchange = _RecoveringExchange(self)
+        self.queue = _RecoveringQueue(self)
+        self.basic = _RecoveringBasic(self)
+        self.confirm = _RecoveringConfirm(self)
+
+        if connection.connection is not None:
+            self._open(connection.connection)
+
+    def __getattr__(self, name):
+        channel = self.__dict__.get('_channel')
+        if channel is None:
+            raise AttributeError(name)
+        return getattr(channel, name)
+
+    @property
+    def connection(self):
+        return self._connection
+
+    @property
+    def logger(self):
+        return self._connection.logger
+
+    @property
+    def closed(self):
+        '''Whether the channel was closed and will not recover.'''
+        return self._closed
+
+    @property
+    def active(self):
+        return self._channel is None or self._channel.active
+
+    @property
+    def synchronous(self):
+        return self._synchronous or self._connection.synchronous
+
+    def add_close_listener(self, listener):
+        '''
+        Add a listener for when the channel closes for good.
+        '''
+        self._close_listeners.add(listener)
+
+    def remove_close_listener(self, listener):
+        self._close_listeners.discard(listener)
+
+    def close(self, reply_code=0, reply_text='', class_id=0, method_id=0):
+        '''
+        Close the channel without recovering it.
+        '''
+        if self._channel is not None:
+            self._channel.close(reply_code, reply_text, class_id, method_id)
+        else:
+            self._closed_cb(None)
+
+    def publish(self, *args, **kwargs):
+        '''
+        Standard publish. See basic.publish.
+        '''
+        return self.basic.publish(*args, **kwargs)
+
+    def topology(self):
+        '''
+        Start a batch of pipelined declarations, which are recorded.
+        '''
+        return _RecoveringTopology(self)
+
+    def _open(self, connection):
+        '''
+        Open a Channel on a connection and restore its settings.
+        '''
+        channel = connection.channel(synchronous=self._synchronous)
+        channel.add_close_listener(self._closed_cb)
+        self._channel = channel
+
+        self._tag_offset += self._last_tag
+        self._last_tag = 0
+
+        if self._qos is not None:
+            channel.basic.qos(**self._qos)
+        if self._confirm is not None:
+            channel.confirm.select(**self._confirm)
+
+    def _resume(self):
+        '''
+        Restore the consumers and send the messages which are unconfirmed or
+        were published while disconnected.
+        '''
+        basic = self._channel.basic
+        for consumer_tag, (_consumer, wrapped, queue, kwargs) in \
+                self._consumers.iteritems():
+            basic.consume(queue, wrapped, consumer_tag=consumer_tag, **kwargs)
+
+        for msg_id in self._unconfirmed.keys():
+            self._send_confirmed(msg_id)
+        while self._held:
+            args, kwargs = self._held.popleft()
+            basic.publish(*args, **kwargs)
+
+    def _abandon(self, connection):
+        '''
+        Drop the Channel of a connection which has closed. It is marked as
+        closed so that anything waiting on it fails rather than waiting for
+        frames which won't arrive.
+        '''
+        channel = self._channel
+        self._channel = None
+        if channel is None or channel.closed:
+            return
+        channel._closed = True
+        channel._close_info = connection.close_info or {
+            'reply_code': 0, 'reply_text': 'connection lost',
+            'class_id': 0, 'method_id': 0}
+        channel._closed_cb()
+
+    def _closed_cb(self, channel):
+        '''
+        Close listener of each Channel, which is also called when the
+        connection gives up.
+        '''
+        if channel is not None and channel is not self._channel:
+            return
+        self._channel = None
+        self._closed = True
+        self._connection._channel_closed(self)
+        for listener in self._close_listeners:
+            listener(self)
+
+    def _wrap_consumer(self, consumer):
+        '''
+        Return a consumer which offsets the delivery tags of its messages.
+        '''
+        def wrapped(msg):
+            if isinstance(msg, list):
+                for m in msg:
+                    self._offset_tag(m)
+            else:
+                self._offset_tag(msg)
+            consumer(msg)
+        return wrapped
+
+    def _offset_tag(self, msg):
+        if msg is not None and msg.delivery_info is not None:
+            tag = msg.delivery_info['delivery_tag']
+            if tag > self._last_tag:
+                self._last_tag = tag
+            msg.delivery_info['delivery_tag'] = tag + self._tag_offset
+        return msg
+
+    def _current_tag(self, delivery_tag):
+        '''
+        Return the tag on the current Channel for an offset tag, or None if
+        the message was delivered on an earlier one.
+        '''
+        if self._channel is None or delivery_tag <= self._tag_offset:
+            return None
+        return delivery_tag - self._tag_offset
+
+    def _send_confirmed(self, msg_id):
+        '''
+        Publish an unconfirmed message on the current Channel.
+        '''
+        args, kwargs = self._unconfirmed[msg_id]
+        kwargs = dict(kwargs)
+        confirm_cb = kwargs.pop('confirm_cb', None)
+
+        def confirmed(_channel_msg_id, acked):
+            self._unconfirmed.pop(msg_id, None)
+            if confirm_cb:
+                confirm_cb(msg_id, acked)
+        self._channel.basic.publish(*args, confirm_cb=confirmed, **kwargs)
+
+
+class _RecoveringClass(object):
+
+    '''
+    Base for the protocol classes of a RecoveringChannel. Methods which
+    aren't recorded are those of the current Channel.
+    '''
+
+    name = None
+
+    def __init__(self, channel):
+        self._recovering = channel
+
+    def __getattr__(self, name):
+        channel = self._recovering._channel
+        if channel is None:
+            raise ConnectionClosed('connection is recovering')
+        return getattr(getattr(channel, self.name), name)
+
+    def _current(self):
+        '''
+        Return the protocol class of the current Channel, or None while
+        disconnected.
+        '''
+        channel = self._recovering._channel
+        if channel is None:
+            return None
+        return getattr(channel, self.name)
+
+    def _record(self, key, method, args, kwargs):
+        kwargs = dict(kwargs)
+        kwargs.pop('nowait', None)
+        kwargs.pop('cb', None)
+        self._recovering._connection._record(key, method, args, kwargs)
+
+    def _forget(self, match):
+        self._recovering._connection._forget(match)
+
+
+class _RecoveringExchange(_RecoveringClass):
+
+    name = 'exchange'
+
+    def declare(self, exchange, type, **kwargs):
+        if not kwargs.get('passive'):
+            self._record(('exchange', exchange), 'declare_exchange',
+                         (exchange, type), kwargs)
+        current = self._current()
+        if current is not None:
+            return current.declare(exchange, type, **kwargs)
+
+    def delete(self, exchange, **kwargs):
+        self._forget(lambda key: key[0] == 'exchange' and key[1] == exchange
+                     or key[0] == 'queue_bind' and key[2] == exchange
+                     or key[0] == 'exchange_bind' and exchange in key[1:3])
+        current = self._current()
+        if current is not None:
+            return current.delete(exchange, **kwargs)
+
+    def bind(self, exchange, source, routing_key='', **kwargs):
+        self._record(('exchange_bind', exchange, source, routing_key),
+                     'bind_exchange', (exchange, source, routing_key), kwargs)
+        current = self._current()
+        if current is not None:
+            return current.bind(exchange, source, routing_key, **kwargs)
+
+    def unbind(self, exchange, source, routing_key='', **kwargs):
+        self._forget(
+            lambda key: key == ('exchange_bind', exchange, source,
+                                routing_key))
+        current = self._current()
+        if current is not None:
+            return current.unbind(exchange, source, routing_key, **kwargs)
+
+
+class _RecoveringQueue(_RecoveringClass):
+
+    name = 'queue'
+
+    def declare(self, queue='', **kwargs):
+        if queue and not kwargs.get('passive'):
+            self._record(('queue', queue), 'declare_queue', (queue,), kwargs)
+        current = self._current()
+        if current is not None:
+            return current.declare(queue, **kwargs)
+
+    def bind(self, queue, exchange, routing_key='', **kwargs):
+        self._record(('queue_bind', queue, exchange, routing_key),
+                     'bind_queue', (queue, exchange, routing_key), kwargs)
+        current = self._current()
+        if current is not None:
+            return current.bind(queue, exchange, routing_key, **kwargs)
+
+    def unbind(self, queue, exchange, routing_key='', **kwargs):
+        self._forget(
+            lambda key: key == ('queue_bind', queue, exchange, routing_key))
+        current = self._current()
+        if current is not None:
+            return current.unbind(queue, exchange, routing_key, **kwargs)
+
+    def delete(self, queue, **kwargs):
+        self._forget(lambda key: key[0] in ('queue', 'queue_bind') and
+                     key[1] == queue)
+        current = self._current()
+        if current is not None:
+            return current.delete(queue, **kwargs)
+
+
+class _RecoveringBasic(_RecoveringClass):
+
+    name = 'basic'
+
+    def qos(self, prefetch_size=0, prefetch_count=0, is_global=False):
+        self._recovering._qos = {'prefetch_size': prefetch_size,
+                                 'prefetch_count': prefetch_count,
+                                 'is_global': is_global}
+        current = self._current()
+        if current is not None:
+            return current.qos(prefetch_size, prefetch_count, is_global)
+
+    def consume(self, queue, consumer, consumer_tag='', **kwargs):
+        channel = self._recovering
+        if not consumer_tag:
+            channel._consumer_tag_id += 1
+            consumer_tag = 'recovering-%d' % (channel._consumer_tag_id)
+        wrapped = channel._wrap_consumer(consumer)
+
+        # The registration callback only applies to the first consume
+        replay = dict(kwargs)
+        replay.pop('cb', None)
+        channel._consumers[consumer_tag] = (consumer, wrapped, queue, replay)
+
+        current = self._current()
+        if current is not None:
+            return current.consume(queue, wrapped, consumer_tag=consumer_tag,
+                                   **kwargs)
+
+    def cancel(self, consumer_tag='', nowait=True, consumer=None, cb=None):
+        consumers = self._recovering._consumers
+        if consumer is not None:
+            for tag, record in consumers.items():
+                if record[0] == consumer:
+                    consumer_tag = tag
+                    break
+        consumers.pop(consumer_tag, None)
+
+        current = self._current()
+        if current is not None:
+            return current.cancel(consumer_tag=consumer_tag, nowait=nowait,
+                                  cb=cb)
+
+    def get(self, queue, consumer=None, **kwargs):
+        channel = self._recovering
+        current = self._current()
+        if current is None:
+            raise ConnectionClosed('connection is recovering')
+        if consumer is not None:
+            consumer = channel._wrap_consumer(consumer)
+        msg = current.get(queue, consumer=consumer, **kwargs)
+        if consumer is None:
+            channel._offset_tag(msg)
+        return msg
+
+    def ack(self, delivery_tag, multiple=False):
+        tag = self._recovering._current_tag(delivery_tag)
+        if tag is not None:
+            self._current().ack(tag, multiple=multiple)
+
+    def reject(self, delivery_tag, requeue=False):
+        tag = self._recovering._current_tag(delivery_tag)
+        if tag is not None:
+            self._current().reject(tag, requeue=requeue)
+
+    def nack(self, delivery_tag, multiple=False, requeue=False):
+        tag = self._recovering._current_tag(delivery_tag)
+        if tag is not None:
+            self._current().nack(tag, multiple=multiple, requeue=requeue)
+
+    def publish(self, *args, **kwargs):
+        '''
+        Publish a message. In confirm mode, returns an id which, unlike the
+        ids of a Channel, stays the same if the message is published again
+        on recovery; `confirm_cb` is called with it.
+        '''
+        channel = self._recovering
+        if channel._confirm is not None:
+            channel._msg_id += 1
+            channel._unconfirmed[channel._msg_id] = (args, kwargs)
+            if channel._channel is not None:
+                channel._send_confirmed(channel._msg_id)
+            return channel._msg_id
+
+        current = self._current()
+        if current is None:
+            channel._held.append((args, kwargs))
+            return 0
+        return current.publish(*args, **kwargs)
+
+
+class _RecoveringConfirm(_RecoveringClass):
+
+    name = 'confirm'
+
+    def select(self, nowait=True, cb=None, window=None):
+        self._recovering._confirm = {'window': window}
+        current = self._current()
+        if current is not None:
+            return current.select(nowait=nowait, cb=cb, window=window)
+
+
+class _RecoveringTopology(object):
+
+    '''
+    A Topology whose declarations are recorded for recovery.
+    '''
+
+    def __init__(self, channel):
+        self._recovering = channel
+        self._topology = channel._channel.topology()
+
+    def __getattr__(self, name):
+        return getattr(self._topology, name)
+
+    def declare_exchange(self, exchange, type, **kwargs):
+        if not kwargs.get('passive'):
+            self._recovering.exchange._record(
+                ('exchange', exchange), 'declare_exchange', (exchange, type),
+                kwargs)
+        self._topology.declare_exchange(exchange, type, **kwargs)
+        return self
+
+    def declare_queue(self, queue='', **kwargs):
+        if queue and not kwargs.get('passive'):
+            self._recovering.queue._record(
+                ('queue', queue), 'declare_queue', (queue,), kwargs)
+        self._topology.declare_queue(queue, **kwargs)
+        return self
+
+    def bind_queue(self, queue, exchange, routing_key='', **kwargs):
+        self._recovering.queue._record(
+            ('queue_bind', queue, exchange, routing_key), 'bind_queue',
+            (queue, exchange, routing_key), kwargs)
+        self._topology.bind_queue(queue, exchange, routing_key, **kwargs)
+        return self
+
+    def bind_exchange(self, exchange, source, routing_key='', **kwargs):
+        self._recovering.exchange._record(
+            ('exchange_bind', exchange, source, routing_key),
+            'bind_exchange', (exchange, source, routing_key), kwargs)
+        self._topology.bind_exchange(exchange, source, routing_key, **kwargs)
+        return self
+
+    def unbind_queue(self, queue, exchange, routing_key='', **kwargs):
+        self._recovering.queue._forget(
+            lambda key: key == ('queue_bind', queue, exchange, routing_key))
+        self._topology.unbind_queue(queue, exchange, routing_key, **kwargs)
+        return self
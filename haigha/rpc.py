@@ -0,0 +1,383 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+import uuid
+
+from haigha.ack_batcher import AckBatcher
+from haigha.exceptions import ChannelClosed, RpcTimeout
+from haigha.message import Message
+from haigha.worker_pool import WorkerPool
+
+
+class RpcClient(object):
+
+    '''
+    Makes rpc calls over a channel, with any number of calls in flight at
+    once. Each call is published with a unique `correlation_id` and the
+    `reply_to` of a single reply queue which the client consumes from, and
+    replies are matched to their calls through a table keyed on the
+    correlation id. By default the client uses RabbitMQ's direct reply-to
+    pseudo queue, which needs no declaration and is the fastest option;
+    pass `direct_reply_to=False` to declare an exclusive, server-named
+    reply queue instead. Calls made before that queue is declared are held
+    and published once it is.
+
+    Each call may have a timeout, after which it fails with RpcTimeout. The
+    timeouts are scheduled on the connection's timers, so they fire from
+    read_frames(), which waits no longer than the next one. A reply that
+    arrives after its call timed out is dropped. If the channel closes, all the
+    pending calls fail with ChannelClosed.
+    '''
+
+    DIRECT_REPLY_TO = 'amq.rabbitmq.reply-to'
+
+    def __init__(self, channel, exchange='', routing_key='', timeout=None,
+                 direct_reply_to=True):
+        '''
+        Initialize the client on a channel. `exchange` and `routing_key` are
+        the defaults for call(), and `timeout` is the default timeout in
+        seconds, or None for no timeout.
+        '''
+        self._channel = channel
+        self._exchange = exchange
+        self._routing_key = routing_key
+        self._timeout = timeout
+
+        self._prefix = uuid.uuid4().hex
+        self._counter = 0
+        self._pending = {}
+        self._timers = {}
+        self._unsent = []
+        self._reply_queue = None
+
+        channel.add_close_listener(self._closed_cb)
+
+        if direct_reply_to:
+            self._start_consuming(self.DIRECT_REPLY_TO)
+        else:
+            channel.queue.declare(exclusive=True, auto_delete=True,
+                                  cb=self._declared_cb)
+
+    @property
+    def channel(self):
+        '''The channel this client calls on.'''
+        return self._channel
+
+    @property
+    def reply_queue(self):
+        '''Name of the reply queue, or None if it is not declared yet.'''
+        return self._reply_queue
+
+    @property
+    def pending(self):
+        '''Number of calls waiting on a reply.'''
+        return len(self._pending)
+
+    def call(self, msg, routing_key=None, exchange=None, timeout=None,
+             cb=None):
+        '''
+        Make an rpc call and return an RpcCall for it. `msg` may be a
+        Message or a body string. If `cb` is supplied, it will be called with
+        the RpcCall once it has a reply or has failed. `timeout` overrides
+        the client's default.
+        '''
+        self._counter += 1
+        correlation_id = '%s.%d' % (self._prefix, self._counter)
+
+        if isinstance(msg, Message):
+            properties = dict(msg.properties)
+            properties['correlation_id'] = correlation_id
+            msg = Message(msg.body, **properties)
+        else:
+            msg = Message(msg, correlation_id=correlation_id)
+
+        rpc_call = RpcCall(self, correlation_id, cb)
+        self._pending[correlation_id] = rpc_call
+
+        if timeout is None:
+            timeout = self._timeout
+        if timeout is not None:
+            self._timers[correlation_id] = \
+                self._channel.connection.timers.schedule(
+                    timeout, self._expire, correlation_id)
+
+        if exchange is None:
+            exchange = self._exchange
+        if routing_key is None:
+            routing_key = self._routing_key
+
+        if self._reply_queue is None:
+            self._unsent.append((msg, exchange, routing_key))
+        else:
+            self._publish(msg, exchange, routing_key)
+        return rpc_call
+
+    def wait(self, rpc_call):
+        '''
+        Read frames until an RpcCall is done.
+        '''
+        connection = self._channel.connection
+        while not rpc_call.done:
+            if self._channel.closed:
+                raise ChannelClosed()
+            connection.read_frames()
+
+    def _publish(self, msg, exchange, routing_key):
+        '''
+        Publish a call on the reply queue.
+        '''
+        msg.properties['reply_to'] = self._reply_queue
+        self._channel.basic.publish(msg, exchange, routing_key)
+
+    def _start_consuming(self, queue):
+        '''
+        Start consuming replies and publish any calls that were held.
+        '''
+        self._reply_queue = queue
+        self._channel.basic.consume(queue, self._reply_cb, no_ack=True)
+
+        unsent = self._unsent
+        self._unsent = []
+        for msg, exchange, routing_key in unsent:
+            self._publish(msg, exchange, routing_key)
+
+    def _declared_cb(self, queue, _msg_count, _consumer_count):
+        '''
+        Callback when the reply queue has been declared.
+        '''
+        self._start_consuming(queue)
+
+    def _reply_cb(self, msg):
+        '''
+        Consumer for replies.
+        '''
+        correlation_id = msg.properties.get('correlation_id')
+        rpc_call = self._pending.pop(correlation_id, None)
+        if rpc_call is not None:
+            timer = self._timers.pop(correlation_id, None)
+            if timer is not None:
+                timer.cancel()
+            rpc_call._complete(msg, None)
+
+    def _expire(self, correlation_id):
+        '''
+        Timer callback when a call times out.
+        '''
+        self._timers.pop(correlation_id, None)
+        rpc_call = self._pending.pop(correlation_id, None)
+        if rpc_call is not None:
+            rpc_call._complete(None, RpcTimeout(
+                'no reply to %s within timeout' % (correlation_id)))
+
+    def _closed_cb(self, channel):
+        '''
+        Callback when the channel closes. Fails all the pending calls.
+        '''
+        for timer in self._timers.itervalues():
+            timer.cancel()
+        pending = self._pending
+        self._pending = {}
+        self._timers = {}
+        self._unsent = []
+        for rpc_call in pending.itervalues():
+            rpc_call._complete(None, ChannelClosed())
+
+
+class RpcCall(object):
+
+    '''
+    The handle for a single call made through an RpcClient.
+    '''
+
+    __slots__ = ('_client', '_correlation_id', '_cb', '_reply', '_exception',
+                 '_done')
+
+    def __init__(self, client, correlation_id, cb=None):
+        self._client = client
+        self._correlation_id = correlation_id
+        self._cb = cb
+        self._reply = None
+        self._exception = None
+        self._done = False
+
+    @property
+    def correlation_id(self):
+        return self._correlation_id
+
+    @property
+    def done(self):
+        '''Whether the call has a reply or has failed.'''
+        return self._done
+
+    @property
+    def reply(self):
+        '''The reply Message, or None if there is none yet.'''
+        return self._reply
+
+    @property
+    def exception(self):
+        '''The exception the call failed with, if any.'''
+        return self._exception
+
+    def result(self):
+        '''
+        Return the reply Message, reading frames until it arrives. Raises
+        the exception the call failed with, if any.
+        '''
+        if not self._done:
+            self._client.wait(self)
+        if self._exception is not None:
+            raise self._exception
+        return self._reply
+
+    def _complete(self, reply, exception):
+        '''
+        Record the outcome of the call and notify the callback.
+        '''
+        self._reply = reply
+        self._exception = exception
+        self._done = True
+        if self._cb is not None:
+            self._cb(self)
+
+
+class RpcServer(object):
+
+    '''
+    Serves rpc requests from a queue, running the handler for many requests
+    at once on a WorkerPool. `handler` is called with each request Message
+    and returns the reply, either a Message or a body string, or None to
+    send no reply. The reply is published to the request's `reply_to` with
+    its `correlation_id`. If the handler raises, the error is logged and the
+    request is rejected without requeue.
+
+    The workers hand their replies back to the connection's thread, which
+    publishes all those that are ready back-to-back, so that a transport
+    which coalesces writes can send them together, and then acks the
+    requests through an AckBatcher. A request is only acked after its reply
+    has been published. Replies go out with the WorkerPool's acks, which
+    it sends from a timer on the connection's timers while requests are in
+    progress, so they aren't held back by an idle connection.
+
+    The server should have a channel of its own, since all the acks on the
+    channel must go through its AckBatcher.
+    '''
+
+    def __init__(self, channel, queue, handler, workers=4, prefetch=100,
+                 ack_size=None, ack_interval=0.1, green=False):
+        '''
+        Initialize the server. `prefetch` bounds the number of requests that
+        are in progress, and `ack_size` defaults to a quarter of it.
+        '''
+        self._channel = channel
+        self._logger = channel.logger
+        self._queue = queue
+        self._handler = handler
+        self._prefetch = prefetch
+
+        if ack_size is None:
+            ack_size = max(prefetch // 4, 1)
+        self._acker = AckBatcher(channel, size=ack_size,
+                                 interval=ack_interval)
+        # The pool sends its acks and rejects through the server, so that
+        # each reply is published just before its request is acked
+        self._pool = WorkerPool(channel, workers=workers,
+                                max_pending=prefetch, acker=self,
+                                green=green)
+        self._consumer = self._pool.consumer(self._handle)
+        # Replies by the delivery tag of their request
+        self._replies = {}
+        self._consuming = False
+
+        channel.add_close_listener(self._closed_cb)
+
+    @property
+    def channel(self):
+        '''The channel the server consumes on.'''
+        return self._channel
+
+    @property
+    def pending(self):
+        '''Number of finished requests whose replies have not been sent.'''
+        return len(self._replies)
+
+    def start(self):
+        '''
+        Start the workers and start consuming requests.
+        '''
+        self._pool.start()
+        self._channel.basic.qos(prefetch_count=self._prefetch)
+        self._channel.basic.consume(self._queue, self._consumer, no_ack=False)
+        self._consuming = True
+
+    def stop(self, timeout=None):
+        '''
+        Stop consuming, wait for the workers to finish the requests they
+        have, and send their replies and acks.
+        '''
+        if self._consuming:
+            self._channel.basic.cancel(consumer=self._consumer)
+            self._consuming = False
+        self._pool.stop(timeout)
+        self._acker.flush()
+
+    def flush(self):
+        '''
+        Publish the replies which are ready and ack their requests. Must be
+        called from the connection's thread.
+        '''
+        self._pool.flush()
+
+    def ack(self, delivery_tag):
+        '''
+        Publish the reply to a request, if it has one, and ack the request.
+        Called by the pool on the connection's thread.
+        '''
+        reply = self._replies.pop(delivery_tag, None)
+        if reply is not None:
+            self._channel.basic.publish(reply[0], '', reply[1])
+        self._acker.ack(delivery_tag)
+
+    def reject(self, delivery_tag, requeue=False):
+        '''
+        Reject a request. Called by the pool on the connection's thread.
+        '''
+        self._acker.reject(delivery_tag, requeue=requeue)
+
+    def _handle(self, msg):
+        '''
+        Run the handler on a request. Called on a worker.
+        '''
+        delivery_tag = msg.delivery_info['delivery_tag']
+        try:
+            result = self._handler(msg)
+        except Exception:
+            self._logger.exception('rpc handler failed on %s', msg)
+            self._pool.reject(delivery_tag, requeue=False)
+            return
+
+        reply_to = msg.properties.get('reply_to')
+        if result is None or reply_to is None:
+            self._pool.ack(delivery_tag)
+            return
+
+        properties = {}
+        if isinstance(result, Message):
+            properties.update(result.properties)
+            result = result.body
+        correlation_id = msg.properties.get('correlation_id')
+        if correlation_id is not None:
+            properties['correlation_id'] = correlation_id
+        self._replies[delivery_tag] = (Message(result, **properties), reply_to)
+        self._pool.ack(delivery_tag)
+
+    def _closed_cb(self, channel):
+        '''
+        Callback when the channel closes. The broker requeues the requests
+        which were not acked, so drop the pending replies.
+        '''
+        self._replies.clear()
+        self._consuming = False
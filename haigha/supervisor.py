@@ -0,0 +1,244 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+import multiprocessing
+import os
+import time
+
+from Queue import Empty
+
+from haigha.connection import Connection
+
+
+class ConsumerSupervisor(object):
+
+    '''
+    Fans consumption of a single queue out across several worker processes.
+    Each worker owns its own Connection and Channel, so nothing is shared
+    between processes and consumption is no longer bound to one interpreter.
+    The total `prefetch_count` is split evenly between the workers through
+    basic.qos, so it must be at least the number of workers, and each worker periodically reports its counters back to the
+    supervisor, which aggregates them in `stats`.
+
+    The consumer is called in the worker process with a single Message
+    argument. If `no_ack` is False, the message is acked once the consumer
+    returns; if the consumer raises, the message is rejected and requeued.
+
+    Each worker bounds its reads with a timer on its connection's timers,
+    so that it notices a stop request within `stop_interval` seconds even
+    on an idle queue. Workers which don't exit within the stop timeout are
+    terminated.
+    '''
+
+    # How often the supervisor drains stats reports while it waits for the
+    # workers to exit, since a worker can't exit until its reports are read
+    JOIN_INTERVAL = 0.1
+
+    def __init__(self, queue, consumer, workers=None, prefetch_count=0,
+                 no_ack=True, stats_interval=1.0, stop_interval=0.1,
+                 connection_class=Connection, **connection_args):
+        '''
+        Initialize the supervisor. Any keyword arguments not consumed here
+        are passed to `connection_class` in each worker. Defaults to one
+        worker per core. Raises ValueError if `prefetch_count` is set but is
+        less than the number of workers.
+        '''
+        self._queue = queue
+        self._consumer = consumer
+        self._workers = workers or multiprocessing.cpu_count()
+        if 0 < prefetch_count < self._workers:
+            raise ValueError(
+                'prefetch_count %d is less than the %d workers' % (
+                    prefetch_count, self._workers))
+        self._prefetch_count = prefetch_count
+        self._no_ack = no_ack
+        self._stats_interval = stats_interval
+        self._stop_interval = stop_interval
+        self._connection_class = connection_class
+        self._connection_args = connection_args
+
+        self._processes = []
+        self._stop_event = multiprocessing.Event()
+        self._stats_queue = multiprocessing.Queue()
+        self._worker_stats = {}
+
+    @property
+    def workers(self):
+        '''Number of worker processes managed by this supervisor.'''
+        return self._workers
+
+    @property
+    def processes(self):
+        '''The list of worker processes.'''
+        return list(self._processes)
+
+    @property
+    def stats(self):
+        '''
+        Return a dict of the counters reported by the workers, summed across
+        all of them, along with the last report of each worker keyed by pid.
+        '''
+        self.poll_stats()
+        rval = {
+            'consumed': 0,
+            'errors': 0,
+            'workers': dict(self._worker_stats),
+        }
+        for stats in self._worker_stats.itervalues():
+            rval['consumed'] += stats['consumed']
+            rval['errors'] += stats['errors']
+        return rval
+
+    def worker_prefetch(self, index):
+        '''
+        Return the prefetch count for the worker at `index`, distributing any
+        remainder over the first workers. Returns 0 (unlimited) if no
+        prefetch count was configured.
+        '''
+        if not self._prefetch_count:
+            return 0
+        share, remainder = divmod(self._prefetch_count, self._workers)
+        if index < remainder:
+            share += 1
+        return share
+
+    def start(self):
+        '''
+        Start all the workers.
+        '''
+        self._stop_event.clear()
+        for index in xrange(self._workers):
+            proc = multiprocessing.Process(
+                target=_run_worker,
+                name='haigha-consumer-%d' % (index),
+                args=(self._queue, self._consumer,
+                      self.worker_prefetch(index), self._no_ack,
+                      self._stats_interval, self._stop_interval,
+                      self._stop_event,
+                      self._stats_queue, self._connection_class,
+                      self._connection_args))
+            proc.daemon = True
+            proc.start()
+            self._processes.append(proc)
+
+    def stop(self, timeout=None):
+        '''
+        Ask all the workers to stop and wait up to `timeout` seconds for them
+        to exit, terminating any that are still running.
+        '''
+        self._stop_event.set()
+        deadline = None if timeout is None else time.time() + timeout
+        for proc in self._processes:
+            self._join_process(proc, deadline)
+            if proc.is_alive():
+                proc.terminate()
+                proc.join()
+        self.poll_stats()
+        self._processes = []
+
+    def join(self, timeout=None):
+        '''
+        Wait for all the workers to exit.
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        for proc in self._processes:
+            self._join_process(proc, deadline)
+        self.poll_stats()
+
+    def _join_process(self, proc, deadline):
+        '''
+        Wait for a worker to exit until `deadline`, draining the stats
+        reports meanwhile. A worker which has put reports on the queue
+        doesn't exit until they have been read.
+        '''
+        while proc.is_alive():
+            if deadline is None:
+                wait = self.JOIN_INTERVAL
+            else:
+                wait = min(deadline - time.time(), self.JOIN_INTERVAL)
+                if wait <= 0:
+                    break
+            proc.join(wait)
+            self.poll_stats()
+
+    def poll_stats(self):
+        '''
+        Drain all pending stats reports from the workers.
+        '''
+        while True:
+            try:
+                stats = self._stats_queue.get_nowait()
+            except Empty:
+                break
+            self._worker_stats[stats['pid']] = stats
+
+
+class _WorkerConsumer(object):
+
+    '''
+    Wraps the user's consumer in a worker process to count deliveries and
+    to ack or reject them when acknowledgements are enabled.
+    '''
+
+    def __init__(self, consumer, no_ack, logger):
+        self._consumer = consumer
+        self._no_ack = no_ack
+        self._logger = logger
+        self.consumed = 0
+        self.errors = 0
+
+    def __call__(self, msg):
+        try:
+            self._consumer(msg)
+        except Exception:
+            self.errors += 1
+            self._logger.exception('consumer failed on %s', msg)
+            if not self._no_ack:
+                msg.delivery_info['channel'].basic.reject(
+                    msg.delivery_info['delivery_tag'], requeue=True)
+        else:
+            if not self._no_ack:
+                msg.delivery_info['channel'].basic.ack(
+                    msg.delivery_info['delivery_tag'])
+        self.consumed += 1
+
+
+def _run_worker(queue, consumer, prefetch_count, no_ack, stats_interval,
+                stop_interval, stop_event, stats_queue, connection_class,
+                connection_args):
+    '''
+    Main loop of a worker process. Connects, consumes and reports stats until
+    the stop event is set or the connection is closed.
+    '''
+    connection = connection_class(**connection_args)
+    wrapper = _WorkerConsumer(consumer, no_ack, connection.logger)
+    pid = os.getpid()
+
+    def report():
+        stats_queue.put({
+            'pid': pid,
+            'consumed': wrapper.consumed,
+            'errors': wrapper.errors,
+            'frames_read': connection.frames_read,
+            'frames_written': connection.frames_written,
+        })
+
+    try:
+        channel = connection.channel()
+        if prefetch_count:
+            channel.basic.qos(prefetch_count=prefetch_count)
+        channel.basic.consume(queue, wrapper, no_ack=no_ack)
+
+        # The stop timer does nothing but bound each read
+        connection.timers.repeat(stats_interval, report)
+        connection.timers.repeat(stop_interval, lambda: None)
+        while not stop_event.is_set() and not connection.closed and \
+                connection.transport is not None:
+            connection.read_frames()
+    finally:
+        report()
+        if not connection.closed and connection.transport is not None:
+            connection.close(disconnect=True)
@@ -0,0 +1,185 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+import heapq
+
+from haigha.clock import monotonic
+
+
+class TimerService(object):
+
+    '''
+    Schedules callbacks to run after a delay. Every Connection has one,
+    available as `connection.timers`, which it runs at the start of each
+    read_frames(). The time until the next deadline is passed to the
+    transport as the read timeout, so that a blocking read returns in time
+    to fire it without any polling. Heartbeats are driven by it, as are
+    any channel features which need a deadline.
+
+    Deadlines are kept in a heap. Cancelled timers stay in it until they
+    come due or until they make up most of it, so cancelling is O(1). The
+    clock is read once per run(), and not at all while no timers are
+    scheduled. Callbacks run in whichever context calls read_frames(), and
+    any exception they raise propagates to the caller. By default the
+    clock is monotonic, so that deadlines aren't moved by changes to the
+    system clock.
+    '''
+
+    # Shortest timeout returned by run(), since transports treat a timeout
+    # of 0 as no timeout at all
+    RESOLUTION = 0.001
+
+    # Cancelled timers are purged once there are at least this many and they
+    # make up over half of the heap
+    COMPACT_THRESHOLD = 64
+
+    def __init__(self, clock=monotonic):
+        self._clock = clock
+        self._heap = []
+        self._counter = 0
+        self._cancelled = 0
+        self._fired = 0
+
+    def __len__(self):
+        return len(self._heap) - self._cancelled
+
+    @property
+    def fired(self):
+        '''Number of callbacks which have been fired.'''
+        return self._fired
+
+    @property
+    def clock(self):
+        '''The function which returns the current time.'''
+        return self._clock
+
+    def schedule(self, delay, cb, *args):
+        '''
+        Call `cb(*args)` once after `delay` seconds. Returns a Timer.
+        '''
+        return self._push(Timer(self, self._clock() + delay, None, cb, args))
+
+    def repeat(self, interval, cb, *args):
+        '''
+        Call `cb(*args)` every `interval` seconds until the Timer which is
+        returned is cancelled. A run which is late by more than an interval
+        is not caught up.
+        '''
+        return self._push(
+            Timer(self, self._clock() + interval, interval, cb, args))
+
+    def run(self):
+        '''
+        Fire all the timers which are due. Returns the number of seconds
+        until the next deadline, or None if no timers are scheduled.
+        '''
+        heap = self._heap
+        if not heap:
+            return None
+
+        now = self._clock()
+        while heap and heap[0][0] <= now:
+            timer = heapq.heappop(heap)[2]
+            timer._scheduled = False
+            if timer._cancelled:
+                self._cancelled -= 1
+                continue
+
+            if timer._interval is not None:
+                timer._deadline += timer._interval
+                if timer._deadline <= now:
+                    timer._deadline = now + timer._interval
+                self._push(timer)
+            self._fired += 1
+            timer._cb(*timer._args)
+
+        return self.timeout(now)
+
+    def timeout(self, now=None):
+        '''
+        Return the number of seconds until the next deadline, or None if no
+        timers are scheduled.
+        '''
+        heap = self._heap
+        while heap and heap[0][2]._cancelled:
+            heapq.heappop(heap)[2]._scheduled = False
+            self._cancelled -= 1
+        if not heap:
+            return None
+
+        if now is None:
+            now = self._clock()
+        return max(heap[0][0] - now, self.RESOLUTION)
+
+    def clear(self):
+        '''
+        Cancel all the timers.
+        '''
+        for _deadline, _counter, timer in self._heap:
+            timer._scheduled = False
+            timer._cancelled = True
+        self._heap = []
+        self._cancelled = 0
+
+    def _push(self, timer):
+        '''
+        Add a timer to the heap. The counter breaks ties between deadlines
+        so that timers are never compared.
+        '''
+        self._counter += 1
+        timer._scheduled = True
+        heapq.heappush(self._heap, (timer._deadline, self._counter, timer))
+        return timer
+
+    def _cancel(self, timer):
+        '''
+        Called when a scheduled timer is cancelled.
+        '''
+        self._cancelled += 1
+        if self._cancelled >= self.COMPACT_THRESHOLD and \
+                self._cancelled * 2 > len(self._heap):
+            self._heap = [entry for entry in self._heap
+                          if not entry[2]._cancelled]
+            heapq.heapify(self._heap)
+            self._cancelled = 0
+
+
+class Timer(object):
+
+    '''
+    A callback scheduled on a TimerService.
+    '''
+
+    __slots__ = ('_service', '_deadline', '_interval', '_cb', '_args',
+                 '_scheduled', '_cancelled')
+
+    def __init__(self, service, deadline, interval, cb, args):
+        self._service = service
+        self._deadline = deadline
+        self._interval = interval
+        self._cb = cb
+        self._args = args
+        self._scheduled = False
+        self._cancelled = False
+
+    @property
+    def deadline(self):
+        '''The time at which the timer fires next.'''
+        return self._deadline
+
+    @property
+    def active(self):
+        '''Whether the timer is still due to fire.'''
+        return self._scheduled and not self._cancelled
+
+    def cancel(self):
+        '''
+        Stop the timer. Does nothing if it has already fired or been
+        cancelled.
+        '''
+        if self._scheduled and not self._cancelled:
+            self._cancelled = True
+            self._service._cancel(self)
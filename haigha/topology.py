@@ -0,0 +1,173 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+from haigha.exceptions import ChannelClosed
+
+
+class Topology(object):
+
+    '''
+    A batch of exchange, queue and binding declarations which are sent to
+    the broker back-to-back and confirmed together, so that declaring the
+    whole batch costs a single round trip rather than one per declaration.
+    Each declaration still waits for its *-ok, which arrive in order, so a
+    failure is reported rather than lost as it would be with nowait=True.
+
+    Add declarations with the declare and bind methods, which may be
+    chained, then call `execute()`. On a synchronous channel or connection
+    execute() blocks until the broker has confirmed every declaration and
+    returns their results in order: None for each exchange declaration and
+    binding, and (queue, message_count, consumer_count) for each queue
+    declaration. Otherwise it returns immediately and the results are
+    passed to `cb` once they have all arrived.
+
+    If any declaration fails, the broker closes the channel and discards
+    the rest of the batch. execute() then raises ChannelClosed on a
+    synchronous channel, or calls `err_cb` with a ChannelClosed otherwise.
+    The channel's close_info names the failure.
+
+    The batch is only pipelined if the channel has no synchronous method of
+    its own outstanding when execute() is called; otherwise the
+    declarations are queued behind it and sent one at a time as usual.
+    '''
+
+    def __init__(self, channel):
+        self._channel = channel
+        self._declarations = []
+        self._results = None
+        self._outstanding = 0
+        self._cb = None
+        self._err_cb = None
+
+    def __len__(self):
+        return len(self._declarations)
+
+    @property
+    def done(self):
+        '''Whether the broker has confirmed every declaration.'''
+        return self._results is not None and not self._outstanding
+
+    def declare_exchange(self, exchange, type, **kwargs):
+        '''
+        Add an exchange.declare. Takes the arguments of ExchangeClass.declare
+        other than `nowait` and `cb`.
+        '''
+        return self._add('exchange', 'declare', (exchange, type), kwargs)
+
+    def declare_queue(self, queue='', **kwargs):
+        '''
+        Add a queue.declare. Takes the arguments of QueueClass.declare other
+        than `nowait` and `cb`.
+        '''
+        return self._add('queue', 'declare', (queue,), kwargs)
+
+    def bind_queue(self, queue, exchange, routing_key='', **kwargs):
+        '''
+        Add a queue.bind. Takes the arguments of QueueClass.bind other than
+        `nowait` and `cb`.
+        '''
+        return self._add('queue', 'bind', (queue, exchange, routing_key),
+                         kwargs)
+
+    def unbind_queue(self, queue, exchange, routing_key='', **kwargs):
+        '''
+        Add a queue.unbind. Takes the arguments of QueueClass.unbind other
+        than `cb`.
+        '''
+        return self._add('queue', 'unbind', (queue, exchange, routing_key),
+                         kwargs)
+
+    def bind_exchange(self, exchange, source, routing_key='', **kwargs):
+        '''
+        Add an exchange.bind. Requires a RabbitConnection.
+        '''
+        return self._add('exchange', 'bind', (exchange, source, routing_key),
+                         kwargs)
+
+    def execute(self, cb=None, err_cb=None):
+        '''
+        Send all the declarations. See the class documentation for how the
+        results are returned.
+        '''
+        channel = self._channel
+        if channel.closed:
+            raise ChannelClosed()
+
+        self._results = [None] * len(self._declarations)
+        self._outstanding = len(self._declarations)
+        self._cb = cb
+        self._err_cb = err_cb
+        if not self._outstanding:
+            return self._finish()
+
+        channel.add_close_listener(self._closed_cb)
+        synchronous = channel.connection.synchronous or channel.synchronous
+
+        channel._pipelining = not len(channel._pending_events)
+        try:
+            for index, (klass, method, args, kwargs) in \
+                    enumerate(self._declarations):
+                kwargs = dict(kwargs, cb=self._result_cb(index))
+                getattr(getattr(channel, klass), method)(*args, **kwargs)
+        finally:
+            channel._pipelining = False
+
+        if synchronous:
+            while self._outstanding:
+                if channel.closed:
+                    raise self._error()
+                channel.connection.read_frames()
+            return self._results
+
+    def _add(self, klass, method, args, kwargs):
+        '''
+        Add a declaration.
+        '''
+        kwargs.pop('nowait', None)
+        kwargs.pop('cb', None)
+        self._declarations.append((klass, method, args, kwargs))
+        return self
+
+    def _result_cb(self, index):
+        '''
+        Return the callback for the *-ok of a declaration.
+        '''
+        def cb(*args):
+            self._results[index] = args or None
+            self._outstanding -= 1
+            if not self._outstanding:
+                self._finish()
+        return cb
+
+    def _finish(self):
+        '''
+        Called when every declaration has been confirmed.
+        '''
+        self._channel.remove_close_listener(self._closed_cb)
+        if self._cb:
+            self._cb(self._results)
+        return self._results
+
+    def _error(self):
+        '''
+        Return a ChannelClosed describing why the channel closed.
+        '''
+        close_info = self._channel.close_info
+        if close_info and close_info['reply_text']:
+            return ChannelClosed(
+                "channel %d is closed: %s : %s",
+                self._channel.channel_id,
+                close_info['reply_code'],
+                close_info['reply_text'])
+        return ChannelClosed()
+
+    def _closed_cb(self, channel):
+        '''
+        Callback when the channel closes before every declaration has been
+        confirmed.
+        '''
+        if self._outstanding and self._err_cb:
+            self._err_cb(self._error())
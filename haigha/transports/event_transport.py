@@ -6,6 +6,7 @@ https://github.com/agoragames/haigha/blob/master/LICENSE.txt
 
 import warnings
 
+from haigha.clock import monotonic
 from haigha.transports.transport import Transport
 
 try:
@@ -23,8 +24,8 @@ class EventTransport(Transport):
     Transport using libevent-based EventSocket.
     '''
 
-    def __init__(self, *args):
-        super(EventTransport, self).__init__(*args)
+    def __init__(self, *args, **kwargs):
+        super(EventTransport, self).__init__(*args, **kwargs)
         self._synchronous = False
 
     ###
@@ -41,8 +42,19 @@ class EventTransport(Transport):
         )
 
     def _sock_read_cb(self, sock):
+        self._update_pending_bytes()
         self.connection.read_frames()
 
+    def _update_pending_bytes(self):
+        '''
+        Refresh the count of bytes buffered in the EventSocket but not yet
+        sent. EventSocket offers no callback when its output buffer drains, so
+        this is sampled on writes and on read events.
+        '''
+        if self._high_watermark:
+            self._set_pending_bytes(
+                sum(len(buf) for buf in self._sock._write_buf))
+
     ###
     # Transport API
     ###
@@ -96,7 +108,10 @@ class EventTransport(Transport):
             self._heartbeat_timeout.delete()
             self._heartbeat_timeout = None
 
-        return self._sock.read()
+        data = self._sock.read()
+        if data:
+            self._last_read = monotonic()
+        return data
 
     def buffer(self, data):
         '''
@@ -113,6 +128,8 @@ class EventTransport(Transport):
         if not hasattr(self, '_sock'):
             return
         self._sock.write(data)
+        self._last_write = monotonic()
+        self._update_pending_bytes()
 
     def disconnect(self):
         '''
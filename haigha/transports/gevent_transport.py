@@ -5,7 +5,10 @@ https://github.com/agoragames/haigha/blob/master/LICENSE.txt
 '''
 
 import warnings
+from collections import deque
 
+from haigha.clock import monotonic
+from haigha.exceptions import ConnectionClosed
 from haigha.transports.socket_transport import SocketTransport
 
 try:
@@ -32,16 +35,47 @@ class GeventTransport(SocketTransport):
     Transport using gevent backend. It relies on gevent's implementation of
     sendall to send whole frames at a time. On the input side, it uses a gevent
     semaphore to ensure exclusive access to the socket and input buffer.
+
+    If constructed with `writer_greenlet=True`, writes are instead appended
+    to a queue which a single writer greenlet drains, coalescing up to
+    `write_coalesce_size` bytes into each sendall. Writers never block on
+    the socket or contend for a lock, which is a large win when many
+    greenlets publish concurrently.
+
+    If constructed with `reader_greenlet=True`, a single reader greenlet
+    owns the input side of the socket and runs Connection.read_frames() in a
+    loop. Only that greenlet reads and buffers socket data, so no lock is
+    taken. Any other greenlet which reads, such as one waiting on a
+    synchronous callback, instead blocks until the reader has processed its
+    next batch of frames and then checks whether its callback was satisfied.
     '''
 
+    # Default maximum number of bytes sent per sendall by the writer greenlet
+    WRITE_COALESCE_SIZE = 262144
+
     def __init__(self, *args, **kwargs):
-        super(GeventTransport, self).__init__(*args)
+        super(GeventTransport, self).__init__(*args, **kwargs)
 
         self._synchronous = False
+        # Greenlets must not block on a thread's lock, so there is no
+        # heartbeat thread; use the reader greenlet instead.
+        self._heartbeat_thread = False
+        self._send_lock = None
         self._read_lock = Semaphore()
         self._write_lock = Semaphore()
         self._read_wait = Event()
 
+        self._use_writer_greenlet = kwargs.get('writer_greenlet', False)
+        self._write_coalesce_size = kwargs.get(
+            'write_coalesce_size', self.WRITE_COALESCE_SIZE)
+        self._write_queue = deque()
+        self._write_event = Event()
+        self._writer = None
+        self._closing = False
+
+        self._use_reader_greenlet = kwargs.get('reader_greenlet', False)
+        self._reader = None
+
     ###
     # Transport API
     ###
@@ -51,12 +85,26 @@ class GeventTransport(SocketTransport):
         Connect using a host,port tuple
         '''
         super(GeventTransport, self).connect((host, port), klass=socket.socket)
+        if self._use_writer_greenlet:
+            self._closing = False
+            self._writer = gevent.spawn(self._write_loop)
+        if self._use_reader_greenlet:
+            self._reader = gevent.spawn(self._read_loop)
 
     def read(self, timeout=None):
         '''
         Read from the transport. If no data is available, should return None.
         If timeout>0, will only block for `timeout` seconds.
         '''
+        if self._reader is not None:
+            if gevent.getcurrent() is self._reader:
+                return super(GeventTransport, self).read(timeout=timeout)
+
+            # Frames are read and processed by the reader greenlet, so wait
+            # for it to finish its next batch.
+            self._read_wait.wait(timeout)
+            return None
+
         # If currently locked, another greenlet is trying to read, so yield
         # control and then return none. Required if a Connection is configured
         # to be synchronous, a sync callback is trying to read, and there's
@@ -83,6 +131,10 @@ class GeventTransport(SocketTransport):
         '''
         Buffer unused bytes from the input stream.
         '''
+        # Only the reader greenlet reads and buffers when there is one
+        if self._reader is not None:
+            return super(GeventTransport, self).buffer(data)
+
         self._read_lock.acquire()
         try:
             return super(GeventTransport, self).buffer(data)
@@ -93,21 +145,113 @@ class GeventTransport(SocketTransport):
         '''
         Write some bytes to the transport.
         '''
+        if self._writer is not None:
+            self._write_queue.append(data)
+            self._set_pending_bytes(self._pending_bytes + len(data))
+            self._write_event.set()
+            return
+
         # MUST use a lock here else gevent could raise an exception if 2
         # greenlets try to write at the same time. I was hoping that
         # sendall() would do that blocking for me, but I guess not. May
         # require an eventsocket-like buffer to speed up under high load.
+        # Bytes held by greenlets waiting on the lock or blocked in sendall()
+        # count as pending for the purposes of the write watermarks.
+        self._set_pending_bytes(self._pending_bytes + len(data))
         self._write_lock.acquire()
         try:
             return super(GeventTransport, self).write(data)
         finally:
             self._write_lock.release()
+            self._set_pending_bytes(self._pending_bytes - len(data))
+
+    def disconnect(self):
+        '''
+        Disconnect from the transport. If there is a writer greenlet, waits
+        for it to flush any queued writes first. If there is a reader
+        greenlet, stops it.
+        '''
+        reader = self._reader
+        if reader is not None:
+            self._reader = None
+            if gevent.getcurrent() is not reader:
+                reader.kill()
+            self._notify_readers()
+
+        writer = self._writer
+        if writer is not None:
+            self._writer = None
+            self._closing = True
+            self._write_event.set()
+            if gevent.getcurrent() is not writer:
+                writer.join()
+        super(GeventTransport, self).disconnect()
+
+    def _notify_readers(self):
+        '''
+        Wake all greenlets waiting for the reader greenlet to process frames.
+        '''
+        self._read_wait.set()
+        self._read_wait.clear()
+
+    def _read_loop(self):
+        '''
+        Run loop of the reader greenlet. Reads and processes frames until the
+        transport is disconnected or closed.
+        '''
+        try:
+            while self._reader is not None and \
+                    self.connection.transport is self:
+                self.connection.read_frames()
+                self._notify_readers()
+        except ConnectionClosed:
+            pass
+        finally:
+            self._reader = None
+            self._notify_readers()
+
+    def _write_loop(self):
+        '''
+        Run loop of the writer greenlet. Waits for queued writes and sends
+        them in as few sendall calls as possible. Exits after flushing if
+        the transport is disconnecting, or on a socket error.
+        '''
+        while True:
+            self._write_event.wait()
+            self._write_event.clear()
+
+            while len(self._write_queue):
+                buf = bytearray()
+                while len(self._write_queue) and \
+                        len(buf) < self._write_coalesce_size:
+                    buf.extend(self._write_queue.popleft())
+
+                try:
+                    self._sock.sendall(buf)
+                    self._last_write = monotonic()
+                except EnvironmentError:
+                    self.connection.logger.exception(
+                        'error writing to %s' % (self._host))
+                    self._writer = None
+                    self._write_queue.clear()
+                    self._set_pending_bytes(0)
+                    self.connection.transport_closed(
+                        msg='error writing to %s' % (self._host))
+                    return
+
+                if self.connection.debug > 1:
+                    self.connection.logger.debug(
+                        'sent %d bytes to %s' % (len(buf), self._host))
+                self._set_pending_bytes(self._pending_bytes - len(buf))
+
+            if self._closing:
+                return
 
 
 class GeventPoolTransport(GeventTransport):
 
     def __init__(self, *args, **kwargs):
-        super(GeventPoolTransport, self).__init__(*args)
+        super(GeventPoolTransport, self).__init__(*args, **kwargs)
 
         self._pool = kwargs.get('pool', None)
         if not self._pool:
@@ -128,4 +272,7 @@ class GeventPoolTransport(GeventTransport):
         process_frames() on each.
         '''
         for channel in channels:
-            self._pool.spawn(channel.process_frames)
+            greenlet = self._pool.spawn(channel.process_frames)
+            # Waiters must be woken after the frames have been processed
+            if self._reader is not None:
+                greenlet.link(lambda _greenlet: self._notify_readers())
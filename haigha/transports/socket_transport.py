@@ -4,23 +4,97 @@ Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
 https://github.com/agoragames/haigha/blob/master/LICENSE.txt
 '''
 
+from haigha.clock import monotonic
+from haigha.frames.heartbeat_frame import HeartbeatFrame
+from haigha.timers import TimerService
 from haigha.transports.transport import Transport
 
 import errno
+import math
+import select
 import socket
+import threading
 
 
 class SocketTransport(Transport):
 
     '''
     A simple blocking socket transport.
+
+    Reads are sized adaptively. The initial read size is taken from the
+    socket's SO_RCVBUF on the first read and clamped to
+    [`read_size_min`, `read_size_max`]. It doubles whenever a read fills the
+    whole buffer and halves when the link goes idle or after a run of small
+    reads. Data is received with recv_into() straight into the buffer that is
+    returned to the frame parser, after any unparsed bytes from the previous
+    read. Syscall counts are available through `syscalls`.
+
+    Normally heartbeats are only sent and checked while the application is
+    in Connection.read_frames(). If constructed with
+    `heartbeat_thread=True`, a daemon thread also sends a heartbeat whenever
+    nothing has been written for 90% of the heartbeat interval, so that a
+    long consumer callback or a process which only publishes doesn't get
+    disconnected by the broker. Writes from the application and the thread
+    share a lock so that frames are never interleaved. If nothing has been
+    read for two intervals and no data is waiting on the socket, the thread
+    shuts the socket down, and the next read or write in the application
+    closes the connection as usual.
     '''
 
-    def __init__(self, *args):
-        super(SocketTransport, self).__init__(*args)
+    # Bounds on the adaptive read size, overridable through the ctor
+    READ_SIZE_MIN = 4096
+    READ_SIZE_MAX = 1048576
+
+    # Number of consecutive reads using less than a quarter of the read size
+    # before the read size is halved
+    SMALL_READ_LIMIT = 8
+
+    def __init__(self, *args, **kwargs):
+        super(SocketTransport, self).__init__(*args, **kwargs)
         self._synchronous = True
         self._buffer = bytearray()
 
+        self._read_size_min = kwargs.get('read_size_min', self.READ_SIZE_MIN)
+        self._read_size_max = kwargs.get('read_size_max', self.READ_SIZE_MAX)
+        self._read_size = None
+        self._small_reads = 0
+
+        # Zeros used to grow a buffered partial frame by the read size, so
+        # that the next read lands just after it
+        self._padding = None
+
+        # The timeout currently set on the socket. After connecting, sockets
+        # are in full-blocking mode.
+        self._timeout = None
+
+        self._syscalls = {
+            'recv': 0,
+            'settimeout': 0,
+            'getsockopt': 0,
+        }
+
+        # The send lock is only needed when there is a heartbeat thread
+        # writing to the socket
+        self._heartbeat_thread = kwargs.get('heartbeat_thread', False)
+        if self._heartbeat_thread:
+            self._send_lock = threading.Lock()
+        else:
+            self._send_lock = None
+        self._heartbeat_stop = None
+
+    @property
+    def read_size(self):
+        '''The number of bytes that will be requested on the next read.'''
+        return self._read_size
+
+    @property
+    def syscalls(self):
+        '''
+        Return a dict of the number of socket calls made while reading, keyed
+        by call name.
+        '''
+        return dict(self._syscalls)
+
     ###
     # Transport API
     ###
@@ -57,12 +131,23 @@ class SocketTransport(Transport):
 
             # After connecting, switch to full-blocking mode.
             self._sock.settimeout(None)
+            self._timeout = None
+            self._last_read = self._last_write = monotonic()
             break
 
         else:
 
             raise
 
+    def fileno(self):
+        '''
+        Return the socket's file descriptor, or None if it isn't connected.
+        '''
+        sock = getattr(self, '_sock', None)
+        if sock is None:
+            return None
+        return sock.fileno()
+
     def read(self, timeout=None):
         '''
         Read from the transport. If timeout>0, will only block for `timeout`
@@ -75,21 +160,49 @@ class SocketTransport(Transport):
         try:
             # Note that we ignore both None and 0, i.e. we either block with a
             # timeout or block completely and let gevent sort it out.
-            if timeout:
-                self._sock.settimeout(timeout)
+            self._set_timeout(timeout or None)
+
+            if self._read_size is None:
+                self._init_read_size()
+
+            # Receive directly into the buffer that will be handed to the
+            # frame parser, so that new data is only written once. A partial
+            # frame left over from the last read is grown in place and the
+            # data lands just after it. The buffer can't be reused across
+            # reads because parsed frames keep referencing its bytes.
+            data = self._buffer
+            pending = len(data)
+            if pending:
+                if self._padding is None or \
+                        len(self._padding) != self._read_size:
+                    self._padding = '\0' * self._read_size
+                data.extend(self._padding)
             else:
-                self._sock.settimeout(None)
-            data = self._sock.recv(
-                self._sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF))
+                data = bytearray(self._read_size)
+            view = memoryview(data)
+            try:
+                nbytes = self._sock.recv_into(view[pending:], self._read_size)
+            except EnvironmentError:
+                # The failed call may still hold a view of the grown buffer,
+                # so keep a copy of the partial frame rather than trimming it
+                if pending:
+                    self._buffer = data[:pending]
+                raise
+            finally:
+                del view
+            self._syscalls['recv'] += 1
+
+            # The buffer can only be trimmed once the view is released
+            del data[pending + nbytes:]
+
+            if nbytes:
+                self._last_read = monotonic()
+                self._buffer = bytearray()
+                self._adjust_read_size(nbytes)
 
-            if len(data):
                 if self.connection.debug > 1:
                     self.connection.logger.debug(
-                        'read %d bytes from %s' % (len(data), self._host))
-                if len(self._buffer):
-                    self._buffer.extend(data)
-                    data = self._buffer
-                    self._buffer = bytearray()
+                        'read %d bytes from %s' % (nbytes, self._host))
                 return data
 
             # Note that no data means the socket is closed and we'll mark that
@@ -99,11 +212,13 @@ class SocketTransport(Transport):
             # Note that this is implemented differently and though it would be
             # caught as an EnvironmentError, it has no errno. Not sure whose
             # fault that is.
+            self._shrink_read_size()
             return None
 
         except EnvironmentError as e:
             # thrown if we have a timeout and no data
             if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                self._shrink_read_size()
                 return None
 
             self.connection.logger.exception(
@@ -114,6 +229,61 @@ class SocketTransport(Transport):
         if e:
             raise
 
+    def _set_timeout(self, timeout):
+        '''
+        Set the socket timeout, but only if it differs from the current one.
+        A timeout is rounded down to a power of two multiple of the timers'
+        resolution. The time until the next timer shrinks on every read, so
+        this keeps it from costing a settimeout() each time, while a read
+        still never outlasts the timeout it was given.
+        '''
+        if timeout is not None:
+            resolution = TimerService.RESOLUTION
+            _, exp = math.frexp(timeout / resolution)
+            timeout = math.ldexp(resolution, max(exp - 1, 0))
+        if timeout != self._timeout:
+            self._sock.settimeout(timeout)
+            self._syscalls['settimeout'] += 1
+            self._timeout = timeout
+
+    def _init_read_size(self):
+        '''
+        Size the read buffer from the socket's receive buffer. Only called
+        once per connection.
+        '''
+        rcvbuf = self._sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        self._syscalls['getsockopt'] += 1
+        self._set_read_size(rcvbuf)
+
+    def _set_read_size(self, size):
+        '''
+        Set the read size, clamped to the configured bounds.
+        '''
+        self._read_size = max(self._read_size_min,
+                              min(size, self._read_size_max))
+        self._small_reads = 0
+
+    def _adjust_read_size(self, nbytes):
+        '''
+        Grow the read size if a read of `nbytes` filled the buffer, and shrink
+        it after a run of reads that used only a fraction of it.
+        '''
+        if nbytes >= self._read_size:
+            self._set_read_size(self._read_size * 2)
+        elif nbytes <= self._read_size // 4:
+            self._small_reads += 1
+            if self._small_reads >= self.SMALL_READ_LIMIT:
+                self._shrink_read_size()
+        else:
+            self._small_reads = 0
+
+    def _shrink_read_size(self):
+        '''
+        Halve the read size, such as when the link has gone idle.
+        '''
+        if self._read_size is not None:
+            self._set_read_size(self._read_size // 2)
+
     def buffer(self, data):
         '''
         Buffer unused bytes from the input stream.
@@ -135,7 +305,12 @@ class SocketTransport(Transport):
             return None
 
         try:
-            self._sock.sendall(data)
+            if self._send_lock is not None:
+                with self._send_lock:
+                    self._sock.sendall(data)
+            else:
+                self._sock.sendall(data)
+            self._last_write = monotonic()
 
             if self.connection.debug > 1:
                 self.connection.logger.debug(
@@ -163,7 +338,82 @@ class SocketTransport(Transport):
         if not hasattr(self, '_sock'):
             return None
 
+        self._stop_heartbeat()
         try:
             self._sock.close()
         finally:
             self._sock = None
+            self._read_size = None
+            self._padding = None
+
+    def start_heartbeat(self, interval):
+        '''
+        Start the heartbeat thread if there should be one.
+        '''
+        if not self._heartbeat_thread or getattr(self, '_sock', None) is None:
+            return
+
+        self._stop_heartbeat()
+        self._heartbeat_stop = threading.Event()
+        thread = threading.Thread(
+            target=self._heartbeat_loop,
+            args=(self._sock, interval, self._heartbeat_stop),
+            name='haigha heartbeat %s' % (self._host))
+        thread.daemon = True
+        thread.start()
+
+    def _stop_heartbeat(self):
+        '''
+        Tell the heartbeat thread, if there is one, to exit.
+        '''
+        if self._heartbeat_stop is not None:
+            self._heartbeat_stop.set()
+            self._heartbeat_stop = None
+
+    def _heartbeat_loop(self, sock, interval, stop):
+        '''
+        Run loop of the heartbeat thread.
+        '''
+        frame = bytearray()
+        HeartbeatFrame(0).write_frame(frame)
+        send_after = 0.9 * interval
+        timeout = 2 * interval
+
+        while not stop.is_set():
+            now = monotonic()
+            idle = now - self._last_write
+            if idle >= send_after:
+                try:
+                    with self._send_lock:
+                        if stop.is_set():
+                            return
+                        sock.sendall(frame)
+                    self._last_write = monotonic()
+                except EnvironmentError:
+                    # The application's next read or write fails too
+                    return
+                idle = 0
+
+            if now - self._last_read >= timeout and \
+                    not self._readable(sock):
+                self.connection.logger.warning(
+                    'Heartbeats not received from %s for %d seconds',
+                    self._host, timeout)
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except EnvironmentError:
+                    pass
+                return
+
+            # Check the read side at least twice per interval
+            stop.wait(max(min(send_after - idle, interval / 2.0), 0.001))
+
+    def _readable(self, sock):
+        '''
+        Return whether there is data waiting on the socket, which means the
+        broker is alive but the application hasn't been reading.
+        '''
+        try:
+            return bool(select.select([sock], [], [], 0)[0])
+        except (EnvironmentError, select.error, ValueError):
+            return False
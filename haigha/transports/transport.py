@@ -4,19 +4,43 @@ Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
 https://github.com/agoragames/haigha/blob/master/LICENSE.txt
 '''
 
+from haigha.clock import monotonic
+
 
 class Transport(object):
 
     '''
     Base class and API for Transports
+
+    Transports which can accept writes faster than they send them can apply
+    backpressure through `high_watermark` and `low_watermark` keyword
+    arguments. When the number of unsent bytes reaches the high watermark the
+    transport is no longer `writable`, and it becomes writable again once
+    those bytes drain to the low watermark, which defaults to half the high
+    watermark. The connection is notified of each change through
+    Connection.transport_writable_changed().
+
+    Transports record when they last received and sent bytes, on the
+    monotonic clock in haigha.clock, in `last_read` and `last_write`. The
+    connection uses these to send heartbeats only while nothing else has
+    been sent, and to detect a dead peer, so subclasses must update them.
     '''
 
-    def __init__(self, connection):
+    def __init__(self, connection, **kwargs):
         '''
         Initialize a transport on a haigha.Connection instance.
         '''
         self._connection = connection
 
+        self._high_watermark = kwargs.get('high_watermark')
+        self._low_watermark = kwargs.get('low_watermark')
+        if self._high_watermark and self._low_watermark is None:
+            self._low_watermark = self._high_watermark // 2
+        self._pending_bytes = 0
+        self._writable = True
+
+        self._last_read = self._last_write = monotonic()
+
     @property
     def synchronous(self):
         '''Return True if this is a synchronous transport, False otherwise.'''
@@ -27,6 +51,59 @@ class Transport(object):
     def connection(self):
         return self._connection
 
+    @property
+    def writable(self):
+        '''
+        Return False if the unsent bytes have reached the high watermark and
+        not yet drained to the low watermark, True otherwise.
+        '''
+        return self._writable
+
+    @property
+    def pending_bytes(self):
+        '''Number of bytes written to the transport but not yet sent.'''
+        return self._pending_bytes
+
+    @property
+    def last_read(self):
+        '''Monotonic time at which bytes were last received.'''
+        return self._last_read
+
+    @property
+    def last_write(self):
+        '''Monotonic time at which bytes were last sent.'''
+        return self._last_write
+
+    def _set_pending_bytes(self, pending):
+        '''
+        Update the number of unsent bytes and notify the connection if this
+        crosses one of the watermarks.
+        '''
+        self._pending_bytes = pending
+        if not self._high_watermark:
+            return
+
+        if self._writable and pending >= self._high_watermark:
+            self._writable = False
+            self._connection.transport_writable_changed(False)
+        elif not self._writable and pending <= self._low_watermark:
+            self._writable = True
+            self._connection.transport_writable_changed(True)
+
+    def start_heartbeat(self, interval):
+        '''
+        Called when the connection has negotiated heartbeats every `interval`
+        seconds. Transports which can send heartbeats in the background may
+        start doing so. The default implementation does nothing.
+        '''
+
+    def fileno(self):
+        '''
+        Return the file descriptor the transport reads from, so that several
+        transports can be waited on together, or None if there isn't one.
+        '''
+        return None
+
     def process_channels(self, channels):
         '''
         Process a set of channels by calling Channel.process_frames() on each.
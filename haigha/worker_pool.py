@@ -0,0 +1,226 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+from collections import deque
+import Queue
+import threading
+
+
+class WorkerPool(object):
+
+    '''
+    Runs consumer callbacks on a bounded pool of worker threads, or
+    greenlets if `green` is True, instead of inline on the connection's read
+    path, so that a slow callback no longer holds up reading, heartbeats and
+    the other channels on the connection. Wrap each consumer with
+    `consumer()` and pass the result to basic.consume().
+
+    At most `max_pending` messages wait for a worker; once that many are
+    queued, the read path blocks until a worker frees up, which pushes back
+    on the broker through the channel's prefetch. If `ordered` is True, all
+    the messages with the same key are run by the same worker, in delivery
+    order. The key defaults to the consumer tag, so that each consumer sees
+    its messages in order; pass `key` to order by something else, e.g. the
+    routing key.
+
+    Acks and rejects must only be sent from the connection's thread, so the
+    pool's `ack()` and `reject()` may be called from the workers and are
+    queued. While any message is with the workers, a timer on the
+    connection's timers sends the queued acks every `flush_interval`
+    seconds, which also bounds how long a blocking read waits, so acks
+    aren't held back by an idle connection. They are also sent when a
+    message is dispatched and when `flush()` is called. If `auto_ack` is
+    True, each message is acked when its callback returns and rejected with
+    requeue if it raises.
+    '''
+
+    def __init__(self, channel, workers=4, max_pending=100, ordered=False,
+                 key=None, auto_ack=False, acker=None, green=False,
+                 flush_interval=0.01):
+        '''
+        Initialize the pool on a channel. `acker` defaults to the channel's
+        basic class and may instead be an AckBatcher.
+        '''
+        self._channel = channel
+        self._logger = channel.logger
+        self._workers = workers
+        self._max_pending = max_pending
+        self._ordered = ordered
+        self._key = key or _consumer_tag
+        self._auto_ack = auto_ack
+        self._acker = acker or channel.basic
+        self._green = green
+        self._flush_interval = flush_interval
+
+        self._queues = []
+        self._threads = []
+        self._completions = deque()
+
+        # Messages dispatched to the workers and not yet finished. The
+        # workers append to _finished as they finish messages, and the
+        # count is only changed on the connection's thread.
+        self._in_flight = 0
+        self._finished = deque()
+        self._flush_timer = None
+        self._closed = False
+
+        channel.add_close_listener(self._closed_cb)
+
+    @property
+    def pending(self):
+        '''Number of messages waiting for a worker.'''
+        return sum(q.qsize() for q in self._queues)
+
+    def start(self):
+        '''
+        Start the workers.
+        '''
+        if self._green:
+            import gevent
+            from gevent.queue import Queue as queue_class
+        else:
+            queue_class = Queue.Queue
+
+        if self._ordered:
+            size = max(self._max_pending // self._workers, 1)
+            self._queues = [queue_class(size) for _ in xrange(self._workers)]
+        else:
+            self._queues = [queue_class(self._max_pending)]
+
+        for index in xrange(self._workers):
+            queue = self._queues[index % len(self._queues)]
+            if self._green:
+                worker = gevent.spawn(self._work, queue)
+            else:
+                worker = threading.Thread(
+                    target=self._work, args=(queue,),
+                    name='haigha-worker-%d' % (index))
+                worker.daemon = True
+                worker.start()
+            self._threads.append(worker)
+
+    def stop(self, timeout=None):
+        '''
+        Stop the workers once they have run all the queued messages, and send
+        any outstanding acks.
+        '''
+        for index in xrange(len(self._threads)):
+            self._queues[index % len(self._queues)].put(None)
+        for worker in self._threads:
+            worker.join(timeout)
+        self._threads = []
+        self.flush()
+        if not self._in_flight:
+            self._cancel_timer()
+
+    def consumer(self, consumer):
+        '''
+        Wrap a consumer callback so that it runs on the pool.
+        '''
+        def dispatch(msg):
+            self.flush()
+            self._queue_for(msg).put((consumer, msg))
+            self._in_flight += 1
+            if self._flush_timer is None:
+                self._flush_timer = self._channel.connection.timers.schedule(
+                    self._flush_interval, self._flush_cb)
+        return dispatch
+
+    def ack(self, delivery_tag):
+        '''
+        Acknowledge a delivery. Safe to call from a worker.
+        '''
+        self._completions.append((delivery_tag, True, False))
+
+    def reject(self, delivery_tag, requeue=False):
+        '''
+        Reject a delivery. Safe to call from a worker.
+        '''
+        self._completions.append((delivery_tag, False, requeue))
+
+    def flush(self):
+        '''
+        Send the acks and rejects queued by the workers. Must be called from
+        the connection's thread.
+        '''
+        # A message is counted as finished after its ack is queued, so
+        # every ack for a finished message is sent below.
+        while self._finished:
+            self._finished.popleft()
+            self._in_flight -= 1
+
+        if self._closed:
+            self._completions.clear()
+            return
+        while self._completions:
+            delivery_tag, acked, requeue = self._completions.popleft()
+            if acked:
+                self._acker.ack(delivery_tag)
+            else:
+                self._acker.reject(delivery_tag, requeue=requeue)
+
+    def _queue_for(self, msg):
+        '''
+        Return the queue that a message should be put on.
+        '''
+        if len(self._queues) == 1:
+            return self._queues[0]
+        return self._queues[hash(self._key(msg)) % len(self._queues)]
+
+    def _work(self, queue):
+        '''
+        Main loop of a worker.
+        '''
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            consumer, msg = item
+            try:
+                consumer(msg)
+            except Exception:
+                self._logger.exception('consumer failed on %s', msg)
+                if self._auto_ack:
+                    self.reject(msg.delivery_info['delivery_tag'],
+                                requeue=True)
+            else:
+                if self._auto_ack:
+                    self.ack(msg.delivery_info['delivery_tag'])
+            self._finished.append(None)
+
+    def _flush_cb(self):
+        '''
+        Timer callback which sends the queued acks, and runs again while any
+        messages are still with the workers.
+        '''
+        self._flush_timer = None
+        self.flush()
+        if self._in_flight or self._completions:
+            self._flush_timer = self._channel.connection.timers.schedule(
+                self._flush_interval, self._flush_cb)
+
+    def _cancel_timer(self):
+        '''
+        Cancel the flush timer, if there is one.
+        '''
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+
+    def _closed_cb(self, channel):
+        '''
+        Callback when the channel closes. The broker requeues everything that
+        was unacked, so drop the pending acks and any which the workers
+        queue from now on.
+        '''
+        self._closed = True
+        self._cancel_timer()
+        self._completions.clear()
+
+
+def _consumer_tag(msg):
+    '''Default ordering key.'''
+    return msg.delivery_info['consumer_tag']
@@ -0,0 +1,141 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+from chai import Chai
+
+from haigha.ack_batcher import AckBatcher
+
+
+class FakeTimer(object):
+
+    def __init__(self, delay, cb):
+        self.delay = delay
+        self.cb = cb
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakeTimers(object):
+
+    def __init__(self):
+        self.scheduled = []
+
+    def schedule(self, delay, cb):
+        timer = FakeTimer(delay, cb)
+        self.scheduled.append(timer)
+        return timer
+
+
+class AckBatcherTest(Chai):
+
+    def setUp(self):
+        super(AckBatcherTest, self).setUp()
+        self.ch = mock()
+        self.ch.connection.timers = FakeTimers()
+        expect(self.ch.add_close_listener).any_args()
+        self.batcher = AckBatcher(self.ch, size=3, interval=10)
+
+    def test_init(self):
+        ch = mock()
+        expect(ch.add_close_listener).args(is_a(object))
+        b = AckBatcher(ch)
+        assert_equals(100, b._size)
+        assert_equals(0.1, b._interval)
+        assert_equals(0, b._prefix_end)
+        assert_equals(0, b.pending)
+        assert_equals(None, b._flush_timer)
+
+    def test_ack_sends_multiple_when_prefix_reaches_size(self):
+        self.batcher.ack(1)
+        self.batcher.ack(2)
+        assert_equals(2, self.batcher.pending)
+
+        expect(self.ch.basic.ack).args(3, multiple=True)
+        self.batcher.ack(3)
+        assert_equals(0, self.batcher.pending)
+        assert_equals(3, self.batcher._prefix_end)
+        assert_equals(None, self.batcher._flush_timer)
+
+    def test_ack_out_of_order_waits_for_gap(self):
+        self.batcher.ack(2)
+        self.batcher.ack(3)
+        self.batcher.ack(4)
+        assert_equals(0, self.batcher._prefix_end)
+        assert_equals(3, self.batcher.pending)
+
+        expect(self.ch.basic.ack).args(4, multiple=True)
+        self.batcher.ack(1)
+        assert_equals(4, self.batcher._prefix_end)
+
+    def test_ack_ignores_tags_already_in_prefix(self):
+        self.batcher._prefix_end = 5
+        self.batcher.ack(3)
+        assert_equals(0, self.batcher.pending)
+
+    def test_reject_settles_tag(self):
+        expect(self.ch.basic.reject).args(2, requeue=True)
+        self.batcher.ack(1)
+        self.batcher.reject(2, requeue=True)
+        self.batcher.ack(3)
+        assert_equals(3, self.batcher._prefix_end)
+
+        # The multiple ack names the last acked tag, not the rejected one
+        expect(self.ch.basic.ack).args(4, multiple=True)
+        self.batcher.ack(4)
+
+    def test_nack_settles_tag(self):
+        expect(self.ch.basic.nack).args(1, requeue=False)
+        self.batcher.nack(1)
+        assert_equals(1, self.batcher._prefix_end)
+        assert_equals(0, self.batcher.pending)
+
+    def test_flush_acks_gaps_individually(self):
+        self.batcher.ack(1)
+        self.batcher.ack(3)
+        self.batcher.ack(5)
+
+        expect(self.ch.basic.ack).args(1, multiple=True)
+        expect(self.ch.basic.ack).args(3)
+        expect(self.ch.basic.ack).args(5)
+        self.batcher.flush()
+        assert_equals(0, self.batcher.pending)
+        assert_equals(None, self.batcher._flush_timer)
+
+        # Closing the gaps extends the prefix past the tags already sent
+        self.batcher.ack(2)
+        self.batcher.ack(4)
+        assert_equals(5, self.batcher._prefix_end)
+        expect(self.ch.basic.ack).args(6, multiple=True)
+        self.batcher.ack(6)
+        assert_equals(0, self.batcher.pending)
+
+    def test_ack_schedules_flush_after_interval(self):
+        self.batcher.ack(1)
+        self.batcher.ack(2)
+        timers = self.ch.connection.timers.scheduled
+        assert_equals(1, len(timers))
+        assert_equals(10, timers[0].delay)
+        assert_equals(self.batcher.flush, timers[0].cb)
+        assert_equals(timers[0], self.batcher._flush_timer)
+
+        expect(self.ch.basic.ack).args(2, multiple=True)
+        timers[0].cb()
+        assert_equals(0, self.batcher.pending)
+        assert_equals(None, self.batcher._flush_timer)
+
+        self.batcher.ack(3)
+        assert_equals(2, len(timers))
+
+    def test_closed_cb(self):
+        self.batcher.ack(2)
+        self.batcher.ack(1)
+        timer = self.batcher._flush_timer
+        self.batcher._closed_cb(self.ch)
+        assert_true(timer.cancelled)
+        assert_equals(0, self.batcher.pending)
+        assert_equals(None, self.batcher._flush_timer)
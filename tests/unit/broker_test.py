@@ -0,0 +1,466 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+import logging
+import socket
+import time
+
+from chai import Chai
+
+from haigha.broker import LocalBroker, _Exchange, _Queue, _topic_matches
+from haigha.connection import PROTOCOL_HEADER
+from haigha.connections.rabbit_connection import RabbitConnection
+from haigha.exceptions import ChannelClosed
+from haigha.message import Message
+from haigha.rpc import RpcClient, RpcServer
+from haigha.worker_pool import WorkerPool
+
+
+class QuietLogger(logging.Logger):
+
+    def __init__(self):
+        logging.Logger.__init__(self, 'broker_test')
+        self.addHandler(logging.NullHandler())
+        self.propagate = False
+
+
+class TopicMatchesTest(Chai):
+
+    def matches(self, pattern, routing_key):
+        return _topic_matches(pattern.split('.'), routing_key.split('.'))
+
+    def test_literal(self):
+        assert_true(self.matches('a.b', 'a.b'))
+        assert_false(self.matches('a.b', 'a.c'))
+        assert_false(self.matches('a.b', 'a.b.c'))
+
+    def test_star_matches_one_word(self):
+        assert_true(self.matches('a.*.c', 'a.b.c'))
+        assert_false(self.matches('a.*.c', 'a.c'))
+        assert_false(self.matches('a.*', 'a.b.c'))
+
+    def test_hash_matches_any_number_of_words(self):
+        assert_true(self.matches('#', 'a.b.c'))
+        assert_true(self.matches('a.#', 'a'))
+        assert_true(self.matches('a.#', 'a.b.c'))
+        assert_true(self.matches('a.#.c', 'a.c'))
+        assert_true(self.matches('a.#.c', 'a.b.b.c'))
+        assert_true(self.matches('#.#.c', 'c'))
+        assert_false(self.matches('a.#.c', 'a.b.d'))
+        assert_false(self.matches('#.c', 'c.d'))
+
+
+class ExchangeTest(Chai):
+
+    def test_direct(self):
+        exchange = _Exchange('ex', 'direct')
+        q1, q2 = _Queue('q1'), _Queue('q2')
+        exchange.bind(q1, 'a')
+        exchange.bind(q2, 'a')
+        exchange.bind(q2, 'b')
+        assert_equals([q1, q2], exchange.route('a'))
+        assert_equals([q2], exchange.route('b'))
+        assert_equals((), exchange.route('c'))
+        assert_equals(3, len(exchange))
+
+        exchange.unbind(q1, 'a')
+        assert_equals([q2], exchange.route('a'))
+
+    def test_fanout(self):
+        exchange = _Exchange('ex', 'fanout')
+        q1, q2 = _Queue('q1'), _Queue('q2')
+        exchange.bind(q1, 'a')
+        exchange.bind(q2, 'b')
+        assert_equals([q1, q2], exchange.route('c'))
+
+    def test_topic_routes_are_cached_until_bindings_change(self):
+        exchange = _Exchange('ex', 'topic')
+        q1, q2 = _Queue('q1'), _Queue('q2')
+        exchange.bind(q1, 'a.*')
+        assert_equals([q1], exchange.route('a.b'))
+        assert_true(exchange.route('a.b') is exchange.route('a.b'))
+
+        exchange.bind(q2, '#')
+        assert_equals([q1, q2], exchange.route('a.b'))
+        exchange.unbind(q1, 'a.*')
+        assert_equals([q2], exchange.route('a.b'))
+        assert_equals([('#', q2)], exchange.bindings())
+
+
+class LocalBrokerTest(Chai):
+
+    def setUp(self):
+        super(LocalBrokerTest, self).setUp()
+        self.logger = QuietLogger()
+        self.broker = LocalBroker(frame_max=4096, logger=self.logger).start()
+        self.connection = self.connect()
+        self.ch = self.connection.channel()
+
+    def tearDown(self):
+        self.broker.stop()
+        super(LocalBrokerTest, self).tearDown()
+
+    def connect(self, **kwargs):
+        return RabbitConnection(host=self.broker.host, port=self.broker.port,
+                                transport='socket', logger=self.logger,
+                                **kwargs)
+
+    def wait(self, condition, connection=None):
+        '''
+        Read frames until condition() is true. A timer bounds each read, since
+        the condition may be on the broker's state.
+        '''
+        connection = connection or self.connection
+        deadline = time.time() + 5
+        while not condition():
+            assert_true(time.time() < deadline, 'timed out')
+            connection.timers.schedule(0.01, lambda: None)
+            connection.read_frames()
+
+    def read_until(self, condition, limit=1.0):
+        '''
+        Read frames until condition() is true without scheduling a timer for
+        each read, so that the reads only return early if the code under
+        test arranges it. A guard timer turns a hang into a failure.
+        '''
+        guard = self.connection.timers.schedule(limit * 2, lambda: None)
+        deadline = time.time() + limit
+        while not condition():
+            assert_true(time.time() < deadline, 'timed out')
+            self.connection.read_frames()
+        guard.cancel()
+
+    def collect(self, messages):
+        return lambda msg: messages.append(msg)
+
+    def test_start_assigns_port(self):
+        assert_true(self.broker.running)
+        assert_not_equals(0, self.broker.port)
+        assert_equals(1, self.broker.stats['connections'])
+
+    def test_stop_closes_connections(self):
+        self.broker.stop()
+        assert_false(self.broker.running)
+        self.wait(lambda: self.connection.transport is None)
+        assert_equals(0, self.connection.close_info['reply_code'])
+
+    def test_rejects_bad_protocol_header(self):
+        sock = socket.create_connection((self.broker.host, self.broker.port))
+        sock.sendall('HTTP/1.1')
+        assert_equals(PROTOCOL_HEADER, sock.recv(100))
+        assert_equals('', sock.recv(100))
+        sock.close()
+
+    def test_declare_and_get(self):
+        declared = []
+        self.ch.queue.declare(
+            'q', auto_delete=False,
+            cb=lambda *args: declared.append(args))
+        self.ch.basic.publish(Message('hello'), '', 'q')
+        self.ch.basic.publish(Message('world'), '', 'q')
+        self.wait(lambda: declared)
+        assert_equals(('q', 0, 0), declared[0])
+
+        msg = self.ch.basic.get('q')
+        assert_equals('hello', str(msg.body))
+        assert_equals(1, msg.delivery_info['message_count'])
+        assert_equals(1, self.broker.queue_depth('q'))
+        assert_equals('world', str(self.ch.basic.get('q').body))
+        assert_equals(None, self.ch.basic.get('q'))
+
+    def test_server_named_queue(self):
+        declared = []
+        self.ch.queue.declare(cb=lambda *args: declared.append(args))
+        self.wait(lambda: declared)
+        assert_true(declared[0][0].startswith('amq.gen-'))
+
+    def test_topic_exchange(self):
+        received = []
+        self.ch.exchange.declare('ex', 'topic')
+        self.ch.queue.declare('q', auto_delete=True)
+        self.ch.queue.bind('q', 'ex', 'a.#')
+        self.ch.basic.consume('q', self.collect(received))
+        self.ch.basic.publish(Message('1'), 'ex', 'a.b.c')
+        self.ch.basic.publish(Message('2'), 'ex', 'b.c')
+        self.ch.basic.publish(Message('3'), 'ex', 'a')
+        self.wait(lambda: len(received) == 2)
+        assert_equals(['1', '3'], [str(m.body) for m in received])
+        assert_equals('a.b.c', received[0].delivery_info['routing_key'])
+        assert_equals('ex', received[0].delivery_info['exchange'])
+
+    def test_fanout_to_several_queues_and_exchange_binding(self):
+        received = []
+        self.ch.exchange.declare('source', 'fanout')
+        self.ch.exchange.declare('dest', 'direct')
+        self.ch.exchange.bind('dest', 'source', 'k')
+        for queue in ('q1', 'q2'):
+            self.ch.queue.declare(queue, auto_delete=True)
+            self.ch.queue.bind(queue, 'dest', 'k')
+            self.ch.basic.consume(queue, self.collect(received))
+        self.ch.basic.publish(Message('fan'), 'source', 'k')
+        self.wait(lambda: len(received) == 2)
+        assert_equals(['fan', 'fan'], [str(m.body) for m in received])
+
+    def test_large_message_is_split_into_frames(self):
+        received = []
+        body = ''.join(chr(i % 256) for i in xrange(20000))
+        self.ch.queue.declare('q', auto_delete=True)
+        self.ch.basic.consume('q', self.collect(received))
+        self.ch.basic.publish(
+            Message(body, application_headers={'k': 'v'}), '', 'q')
+        self.wait(lambda: received)
+        assert_equals(body, str(received[0].body))
+        assert_equals({'k': 'v'}, received[0].properties['application_headers'])
+
+    def test_qos_limits_unacked_deliveries(self):
+        received = []
+        self.ch.queue.declare('q', auto_delete=True)
+        self.ch.basic.qos(prefetch_count=2)
+        self.ch.basic.consume('q', self.collect(received), no_ack=False)
+        for i in xrange(5):
+            self.ch.basic.publish(Message(str(i)), '', 'q')
+        self.wait(lambda: len(received) == 2)
+        self.wait(lambda: self.broker.queue_depth('q') == 3)
+
+        self.ch.basic.ack(received[1].delivery_info['delivery_tag'],
+                          multiple=True)
+        self.wait(lambda: len(received) == 4)
+        assert_equals(['0', '1', '2', '3'], [str(m.body) for m in received])
+        assert_equals(1, self.broker.queue_depth('q'))
+
+    def test_multiple_ack_of_unknown_tag_closes_channel(self):
+        received = []
+        self.ch.queue.declare('q', auto_delete=False)
+        self.ch.basic.consume('q', self.collect(received), no_ack=False)
+        self.ch.basic.publish(Message('m'), '', 'q')
+        self.wait(lambda: received)
+
+        self.ch.basic.ack(5, multiple=True)
+        self.wait(lambda: self.ch.closed)
+        assert_equals(406, self.ch.close_info['reply_code'])
+        self.wait(lambda: self.broker.queue_depth('q') == 1)
+
+    def test_batch_timeout_on_idle_connection(self):
+        batches = []
+        self.ch.queue.declare('q', auto_delete=False)
+        self.ch.basic.consume('q', batches.append, batch_size=10,
+                              batch_timeout=0.05)
+        self.ch.basic.publish(Message('m'), '', 'q')
+
+        # Only the batch timeout can end the blocking reads once the message
+        # has arrived
+        self.read_until(lambda: batches)
+        assert_equals(['m'], [str(m.body) for m in batches[0]])
+
+    def test_worker_pool_acks_on_idle_connection(self):
+        consumed = []
+        pool = WorkerPool(self.ch, workers=2, auto_ack=True)
+        pool.start()
+        self.ch.queue.declare('q', auto_delete=False)
+        self.ch.basic.qos(prefetch_count=2)
+        self.ch.basic.consume('q', pool.consumer(consumed.append),
+                              no_ack=False)
+        for i in xrange(5):
+            self.ch.basic.publish(Message(str(i)), '', 'q')
+
+        # Only the pool's timer can end the blocking reads, so the broker
+        # only sends more once the acks have gone out without a read
+        self.read_until(lambda: len(consumed) == 5)
+        pool.stop()
+        self.wait(lambda: self.broker.stats['acked'] == 5)
+
+    def test_reject_and_nack_requeue(self):
+        received = []
+        self.ch.queue.declare('q', auto_delete=True)
+        self.ch.basic.qos(prefetch_count=1)
+        self.ch.basic.consume('q', self.collect(received), no_ack=False)
+        self.ch.basic.publish(Message('m'), '', 'q')
+        self.wait(lambda: len(received) == 1)
+        assert_false(received[0].delivery_info['redelivered'])
+
+        self.ch.basic.reject(received[0].delivery_info['delivery_tag'],
+                             requeue=True)
+        self.wait(lambda: len(received) == 2)
+        assert_true(received[1].delivery_info['redelivered'])
+
+        self.ch.basic.nack(received[1].delivery_info['delivery_tag'])
+        self.ch.basic.publish(Message('n'), '', 'q')
+        self.wait(lambda: len(received) == 3)
+        assert_equals('n', str(received[2].body))
+
+    def test_unacked_messages_requeued_when_channel_closes(self):
+        received = []
+        self.ch.queue.declare('q', auto_delete=False)
+        self.ch.basic.consume('q', self.collect(received), no_ack=False)
+        self.ch.basic.publish(Message('m'), '', 'q')
+        self.wait(lambda: received)
+
+        self.ch.close()
+        self.wait(lambda: self.broker.queue_depth('q') == 1)
+        msg = self.connection.channel().basic.get('q')
+        assert_true(msg.delivery_info['redelivered'])
+
+    def test_publisher_confirms_and_returns(self):
+        acks = []
+        returned = []
+        self.ch.confirm.select()
+        self.ch.basic.set_ack_listener(acks.append)
+        self.ch.basic.set_return_listener(self.collect(returned))
+        self.ch.queue.declare('q', auto_delete=False)
+        self.ch.basic.publish(Message('1'), '', 'q')
+        self.ch.basic.publish(Message('2'), '', 'nowhere', mandatory=True)
+        self.ch.basic.publish(Message('3'), '', 'nowhere')
+        self.wait(lambda: len(acks) == 3)
+        assert_equals([1, 2, 3], acks)
+        assert_equals(1, len(returned))
+        assert_equals(312, returned[0].return_info['reply_code'])
+        assert_equals('2', str(returned[0].body))
+        assert_equals(1, self.broker.stats['returned'])
+
+    def test_transactions(self):
+        committed = []
+        self.ch.queue.declare('q', auto_delete=False)
+        self.ch.tx.select()
+        self.ch.basic.publish(Message('rolled back'), '', 'q')
+        self.ch.tx.rollback()
+        self.ch.basic.publish(Message('committed'), '', 'q')
+        self.wait(lambda: self.broker.stats['published'] == 2)
+        assert_equals(0, self.broker.queue_depth('q'))
+
+        self.ch.tx.commit(cb=lambda: committed.append(True))
+        self.wait(lambda: committed)
+        assert_equals(1, self.broker.queue_depth('q'))
+
+        msg = self.ch.basic.get('q', no_ack=False)
+        self.ch.basic.ack(msg.delivery_info['delivery_tag'])
+        self.ch.tx.rollback()
+        self.ch.basic.recover(requeue=True)
+        self.wait(lambda: self.broker.queue_depth('q') == 1)
+
+    def test_error_closes_channel(self):
+        self.ch.basic.publish(Message('m'), 'missing', 'k')
+        self.wait(lambda: self.ch.closed)
+        assert_equals(404, self.ch.close_info['reply_code'])
+        assert_equals(60, self.ch.close_info['class_id'])
+        assert_equals(40, self.ch.close_info['method_id'])
+
+        # The connection and other channels are unaffected
+        ch = self.connection.channel()
+        ch.queue.declare('q', auto_delete=False)
+        ch.basic.publish(Message('m'), '', 'q')
+        self.wait(lambda: self.broker.queue_depth('q') == 1)
+
+    def test_exclusive_queue_is_deleted_with_connection(self):
+        other = self.connect()
+        ch = other.channel()
+        ch.queue.declare('mine', exclusive=True)
+        self.wait(lambda: self.broker.queue_depth('mine') == 0, other)
+
+        assert_raises(ChannelClosed, self.ch.queue.declare, 'mine',
+                      passive=True)
+        assert_equals(405, self.ch.close_info['reply_code'])
+
+        other.close()
+        self.wait(lambda: other.closed, other)
+        self.wait(lambda: self.broker.queue_depth('mine') is None)
+
+    def test_queue_delete_cancels_consumers(self):
+        cancelled = []
+        self.ch.queue.declare('q', auto_delete=False)
+        self.ch.basic.consume('q', self.collect([]),
+                              cancel_cb=cancelled.append, consumer_tag='tag')
+        self.connection.channel().queue.delete('q')
+        self.wait(lambda: cancelled)
+        assert_equals(['tag'], cancelled)
+
+    def test_direct_reply_to(self):
+        server = self.connection.channel()
+        server.queue.declare('rpc', auto_delete=True)
+
+        def echo(msg):
+            server.basic.publish(
+                Message(msg.body,
+                        correlation_id=msg.properties['correlation_id']),
+                '', msg.properties['reply_to'])
+        server.basic.consume('rpc', echo)
+
+        client = RpcClient(self.connection.channel(), routing_key='rpc')
+        rpc_call = client.call('ping')
+        client.wait(rpc_call)
+        assert_equals('ping', str(rpc_call.result().body))
+
+    def test_rpc_server_replies_on_idle_connection(self):
+        server_ch = self.connection.channel()
+        server_ch.queue.declare('rpc', auto_delete=True)
+        server = RpcServer(server_ch, 'rpc', lambda msg: msg.body,
+                           workers=2, prefetch=2, ack_size=1)
+        server.start()
+
+        client = RpcClient(self.connection.channel(), routing_key='rpc')
+        calls = [client.call(str(i)) for i in xrange(5)]
+        # The replies and acks only go out from the pool's timer, and with a
+        # prefetch of 2 the broker holds back the rest until they have
+        self.read_until(lambda: all(c.done for c in calls))
+        assert_equals(['0', '1', '2', '3', '4'],
+                      [str(c.result().body) for c in calls])
+        server.stop()
+        self.wait(lambda: self.broker.stats['acked'] == 5)
+
+    def test_heartbeats(self):
+        self.broker.stop()
+        self.broker = LocalBroker(heartbeat=1, logger=self.logger).start()
+        connection = self.connect(heartbeat=None)
+        start = time.time()
+        while time.time() - start < 2.5:
+            connection.read_frames()
+        assert_false(connection.closed)
+        assert_true(connection.frames_read > 4)
+
+    def test_heartbeats_dont_cost_a_settimeout_per_read(self):
+        connection = self.connect(
+            heartbeat=10,
+            sock_opts={(socket.IPPROTO_TCP, socket.TCP_NODELAY): 1})
+        ch = connection.channel()
+        received = []
+        ch.queue.declare('q', auto_delete=True)
+        ch.basic.consume('q', self.collect(received))
+
+        # Each read is bounded by the next heartbeat timer, which is a
+        # little closer every time
+        for i in xrange(200):
+            ch.basic.publish(Message('m'), '', 'q')
+            while len(received) <= i:
+                connection.read_frames()
+        assert_true(connection.transport.syscalls['settimeout'] <= 3)
+
+    def test_heartbeats_waiting_unread_keep_connection_open(self):
+        self.broker.stop()
+        self.broker = LocalBroker(heartbeat=1, logger=self.logger).start()
+        connection = self.connect(heartbeat=None)
+        ch = connection.channel()
+        ch.queue.declare('q', auto_delete=False)
+
+        # Keep the broker hearing from us without reading for over two
+        # intervals, while its heartbeats pile up on the socket
+        start = time.time()
+        while time.time() - start < 2.5:
+            ch.basic.publish(Message('m'), '', 'q')
+            time.sleep(0.2)
+        ch.queue.declare('r', auto_delete=False)
+        assert_false(connection.closed)
+
+    def test_heartbeat_thread_survives_a_long_callback(self):
+        self.broker.stop()
+        self.broker = LocalBroker(heartbeat=1, logger=self.logger).start()
+        connection = self.connect(heartbeat=1, heartbeat_thread=True)
+        ch = connection.channel()
+        ch.queue.declare('q', auto_delete=False)
+
+        # The thread keeps the broker hearing from us, and the broker's
+        # heartbeats wait on the socket until the next read
+        time.sleep(3.5)
+        ch.queue.declare('r', auto_delete=False)
+        assert_false(connection.closed)
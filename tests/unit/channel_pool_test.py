@@ -13,24 +13,39 @@ from haigha.channel_pool import ChannelPool
 
 class ChannelPoolTest(Chai):
 
+    def setUp(self):
+        super(ChannelPoolTest, self).setUp()
+
+        self.connection = mock()
+        expect(self.connection.add_writable_listener).any_args().any_order()
+
     def test_init(self):
-        c = ChannelPool('connection')
-        self.assertEquals('connection', c._connection)
+        conn = self.connection
+
+        c = ChannelPool(conn)
+        self.assertEquals(conn, c._connection)
         self.assertEquals(set(), c._free_channels)
         assert_equals(None, c._size)
         assert_equals(0, c._channels)
         assert_equals(deque(), c._queue)
 
-        c = ChannelPool('connection', size=50)
-        self.assertEquals('connection', c._connection)
+        c = ChannelPool(conn, size=50)
+        self.assertEquals(conn, c._connection)
         self.assertEquals(set(), c._free_channels)
         assert_equals(50, c._size)
         assert_equals(0, c._channels)
         assert_equals(deque(), c._queue)
 
+    def test_load(self):
+        pool = ChannelPool(self.connection)
+        pool._channels = 3
+        pool._free_channels = set(['ch'])
+        pool._queue.append('msg')
+        assert_equals(3, pool.load)
+
     def test_publish_without_user_cb(self):
         ch = mock()
-        cp = ChannelPool(None)
+        cp = ChannelPool(self.connection)
 
         expect(cp._get_channel).returns(ch)
         expect(ch.publish_synchronous).args(
@@ -45,7 +60,7 @@ class ChannelPoolTest(Chai):
 
     def test_publish_with_user_cb(self):
         ch = mock()
-        cp = ChannelPool(None)
+        cp = ChannelPool(self.connection)
         user_cb = mock()
 
         expect(cp._get_channel).returns(ch)
@@ -59,9 +74,55 @@ class ChannelPoolTest(Chai):
         var('cb').value()
         assert_equals(set([ch]), cp._free_channels)
 
+    def test_publish_with_confirms_keeps_channel_in_pool(self):
+        ch = mock()
+        ch.closed = False
+        cp = ChannelPool(self.connection, confirms=True)
+        user_cb = mock()
+
+        expect(cp._get_channel).returns(ch)
+        expect(ch.publish).args(
+            'arg1', confirm_cb=var('cb'), doit='harder')
+
+        cp.publish('arg1', cb=user_cb, doit='harder')
+        assert_equals(set([ch]), cp._free_channels)
+
+        expect(user_cb)
+        var('cb').value(1, True)
+        assert_equals(set([ch]), cp._free_channels)
+
+    def test_publish_with_confirms_holds_channel_while_window_full(self):
+        ch = mock()
+        ch.closed = False
+        ch.active = True
+        ch.basic.unconfirmed = 2
+        cp = ChannelPool(self.connection, confirms=True, window=2)
+        user_cb = mock()
+        nack_cb = mock()
+
+        expect(cp._get_channel).returns(ch)
+        expect(ch.publish).args('arg1', confirm_cb=var('cb'))
+
+        cp.publish('arg1', cb=user_cb, nack_cb=nack_cb)
+        assert_equals(set(), cp._free_channels)
+
+        ch.basic.unconfirmed = 1
+        expect(cp._process_queue)
+        expect(nack_cb)
+        var('cb').value(1, False)
+        assert_equals(set([ch]), cp._free_channels)
+
+    def test_publish_with_confirms_queues_nack_cb(self):
+        cp = ChannelPool(self.connection, confirms=True)
+        expect(cp._get_channel).returns(None)
+
+        cp.publish('arg1', cb='ack', nack_cb='nack')
+        assert_equals(deque([(('arg1',), {'cb': 'ack', 'nack_cb': 'nack'})]),
+                      cp._queue)
+
     def test_publish_resends_queued_messages_if_channel_is_active(self):
         ch = mock()
-        cp = ChannelPool(None)
+        cp = ChannelPool(self.connection)
         user_cb = mock()
         ch.active = True
         ch.closed = False
@@ -82,7 +143,7 @@ class ChannelPoolTest(Chai):
 
     def test_publish_does_not_resend_queued_messages_if_channel_is_inactive(self):
         ch = mock()
-        cp = ChannelPool(None)
+        cp = ChannelPool(self.connection)
         user_cb = mock()
         ch.active = True
         ch.closed = False
@@ -106,7 +167,7 @@ class ChannelPoolTest(Chai):
 
     def test_publish_does_not_resend_queued_messages_if_channel_is_closed(self):
         ch = mock()
-        cp = ChannelPool(None)
+        cp = ChannelPool(self.connection)
         user_cb = mock()
         ch.active = True
         ch.closed = False
@@ -133,7 +194,7 @@ class ChannelPoolTest(Chai):
         ch3 = mock()
         ch1.active = ch2.active = False
         ch3.active = True
-        cp = ChannelPool(None)
+        cp = ChannelPool(self.connection)
 
         expect(cp._get_channel).returns(ch1)
         expect(cp._get_channel).returns(ch2)
@@ -144,7 +205,7 @@ class ChannelPoolTest(Chai):
         self.assertEquals(set([ch1, ch2]), cp._free_channels)
 
     def test_publish_appends_to_queue_when_no_ready_channels(self):
-        cp = ChannelPool(None)
+        cp = ChannelPool(self.connection)
 
         expect(cp._get_channel).returns(None)
 
@@ -155,7 +216,7 @@ class ChannelPoolTest(Chai):
 
     def test_publish_appends_to_queue_when_no_ready_channels_out_of_several(self):
         ch1 = mock()
-        cp = ChannelPool(None)
+        cp = ChannelPool(self.connection)
         ch1.active = False
 
         expect(cp._get_channel).returns(ch1)
@@ -166,8 +227,57 @@ class ChannelPoolTest(Chai):
         assert_equals(deque([(('arg1', 'arg2'), {'arg3': 'foo', 'cb': 'usercb'})]),
                       cp._queue)
 
+    def test_publish_appends_to_queue_when_connection_not_writable(self):
+        cp = ChannelPool(self.connection)
+        cp._connection.writable = False
+
+        stub(cp._get_channel)
+
+        cp.publish('arg1', 'arg2', arg3='foo', cb='usercb')
+        assert_equals(deque([(('arg1', 'arg2'), {'arg3': 'foo', 'cb': 'usercb'})]),
+                      cp._queue)
+
+    def test_writable_cb_processes_queue_while_channels_available(self):
+        conn = self.connection
+        cp = ChannelPool(conn, size=2)
+        cp._channels = 1
+        conn.writable = True
+        cp._queue = deque([(('foo',), {}), (('bar',), {}), (('cat',), {})])
+
+        def process_queue():
+            cp._queue.popleft()
+            cp._channels += 1
+        expect(cp._process_queue).side_effect(process_queue)
+
+        cp._writable_cb(conn)
+        assert_equals(deque([(('bar',), {}), (('cat',), {})]), cp._queue)
+
+    def test_writable_cb_stops_when_message_is_requeued(self):
+        conn = self.connection
+        cp = ChannelPool(conn, size=1)
+        cp._channels = 1
+        cp._free_channels = set([mock()])
+        conn.writable = True
+        cp._queue = deque([(('foo',), {}), (('bar',), {})])
+
+        def process_queue():
+            cp._queue.append(cp._queue.popleft())
+        expect(cp._process_queue).side_effect(process_queue)
+
+        cp._writable_cb(conn)
+        assert_equals(deque([(('bar',), {}), (('foo',), {})]), cp._queue)
+
+    def test_writable_cb_when_not_writable(self):
+        conn = self.connection
+        cp = ChannelPool(conn)
+        conn.writable = False
+        cp._queue = deque([(('foo',), {})])
+
+        stub(cp._process_queue)
+        cp._writable_cb(conn)
+
     def test_process_queue(self):
-        cp = ChannelPool(None)
+        cp = ChannelPool(self.connection)
         cp._queue = deque([
             (('foo',), {'a': 1}),
             (('bar',), {'b': 2}),
@@ -179,8 +289,60 @@ class ChannelPoolTest(Chai):
         cp._process_queue()
         cp._process_queue()
 
+    def test_process_queue_when_not_writable(self):
+        cp = ChannelPool(self.connection)
+        cp._connection.writable = False
+        cp._queue = deque([(('foo',), {})])
+        stub(cp.publish)
+
+        cp._process_queue()
+        assert_equals(deque([(('foo',), {})]), cp._queue)
+
+    def test_process_queue_puts_unsent_message_back_at_head(self):
+        cp = ChannelPool(self.connection, size=1)
+        cp._channels = 1
+        cp._queue = deque([(('foo',), {}), (('bar',), {})])
+        expect(cp._get_channel).returns(None)
+
+        cp._process_queue()
+        assert_equals(deque([(('foo',), {'cb': None}), (('bar',), {})]),
+                      cp._queue)
+
+    def test_publish_keeps_order_across_backpressure(self):
+        conn = self.connection
+        conn.writable = True
+        sent = []
+        ch = mock()
+        ch.active = True
+        ch.closed = False
+        expect(conn.channel).returns(ch)
+        expect(ch.add_close_listener).any_args()
+
+        def publish_synchronous(body, cb):
+            sent.append(body)
+            callbacks.append(cb)
+        callbacks = []
+        expect(ch.publish_synchronous).any_args().side_effect(
+            publish_synchronous).times(3)
+
+        cp = ChannelPool(conn, size=1)
+        cp.publish('m1')
+        cp.publish('m2')
+        conn.writable = False
+        cp.publish('m3')
+
+        # The commit arrives while the connection is still not writable
+        callbacks.pop()()
+        assert_equals(['m1'], sent)
+
+        conn.writable = True
+        cp._writable_cb(conn)
+        callbacks.pop()()
+        assert_equals(['m1', 'm2', 'm3'], sent)
+        assert_equals(deque(), cp._queue)
+
     def test_get_channel_returns_new_when_none_free_and_not_at_limit(self):
-        conn = mock()
+        conn = self.connection
         cp = ChannelPool(conn)
         cp._channels = 1
 
@@ -190,8 +352,18 @@ class ChannelPoolTest(Chai):
         self.assertEquals(set(), cp._free_channels)
         assert_equals(2, cp._channels)
 
+    def test_get_channel_selects_confirms_on_new_channel(self):
+        conn = self.connection
+        cp = ChannelPool(conn, confirms=True)
+
+        with expect(conn.channel).returns(mock()) as newchannel:
+            expect(newchannel.add_close_listener).args(cp._channel_closed_cb)
+            expect(newchannel.confirm.select)
+            self.assertEquals(newchannel, cp._get_channel())
+        assert_equals(1, cp._channels)
+
     def test_get_channel_returns_new_when_none_free_and_at_limit(self):
-        conn = mock()
+        conn = self.connection
         cp = ChannelPool(conn, 1)
         cp._channels = 1
 
@@ -201,7 +373,7 @@ class ChannelPoolTest(Chai):
         self.assertEquals(set(), cp._free_channels)
 
     def test_get_channel_when_one_free_and_not_closed(self):
-        conn = mock()
+        conn = self.connection
         ch = mock()
         ch.closed = False
         cp = ChannelPool(conn)
@@ -217,7 +389,7 @@ class ChannelPoolTest(Chai):
             def pop(self):
                 pass
 
-        conn = mock()
+        conn = self.connection
         ch1 = mock()
         ch1.closed = True
         ch2 = mock()
@@ -237,7 +409,7 @@ class ChannelPoolTest(Chai):
         assert_equals(2, cp._channels)
 
     def test_get_channel_when_two_free_and_all_closed(self):
-        conn = mock()
+        conn = self.connection
         ch1 = mock()
         ch1.closed = True
         ch2 = mock()
@@ -254,7 +426,7 @@ class ChannelPoolTest(Chai):
         assert_equals(3, cp._channels)
 
     def test_channel_closed_cb(self):
-        cp = ChannelPool(None)
+        cp = ChannelPool(self.connection)
         cp._channels = 32
 
         expect(cp._process_queue)
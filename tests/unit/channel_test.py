@@ -20,6 +20,7 @@ from haigha.frames.method_frame import MethodFrame
 from haigha.frames.heartbeat_frame import HeartbeatFrame
 from haigha.frames.header_frame import HeaderFrame
 from haigha.frames.content_frame import ContentFrame
+from haigha.topology import Topology
 
 
 class SyncWrapperTest(Chai):
@@ -80,6 +81,7 @@ class ChannelTest(Chai):
         assert_equals(c._class_map[60], c.basic)
         assert_equals(c._class_map[90], c.tx)
         assert_equals(deque([]), c._pending_events)
+        assert_false(c._pipelining)
         assert_equals(deque([]), c._frame_buffer)
         assert_equals(set([]), c._open_listeners)
         assert_equals(set([]), c._close_listeners)
@@ -240,6 +242,12 @@ class ChannelTest(Chai):
 
         c.publish_synchronous('arg1', 'arg2', foo='bar', cb='a_cb')
 
+    def test_topology(self):
+        c = Channel(mock(), None, {})
+        t = c.topology()
+        assert_true(isinstance(t, Topology))
+        assert_equals(c, t._channel)
+
     def test_dispatch(self):
         c = Channel(mock(), None, {})
         frame = mock()
@@ -277,6 +285,18 @@ class ChannelTest(Chai):
         c.process_frames()
         assert_equals(deque(), c._frame_buffer)
 
+    def test_process_frames_flushes_batches(self):
+        c = Channel(mock(), None, {})
+        c.basic = mock()
+        c.basic._batch_consumers = {'ctag': 'batch'}
+        f0 = MethodFrame('ch_id', 'c_id', 'm_id')
+        c._frame_buffer = deque([f0])
+
+        expect(c.dispatch).args(f0).raises(ProtocolClass.FrameUnderflow)
+        expect(c.basic.flush_batches)
+
+        c.process_frames()
+
     def test_process_frames_stops_when_frameunderflow_raised(self):
         c = Channel(mock(), None, {})
         f0 = MethodFrame('ch_id', 'c_id', 'm_id')
@@ -443,6 +463,16 @@ class ChannelTest(Chai):
         c.send_frame('frame')
         assert_equals(deque(['cb', 'frame']), c._pending_events)
 
+    def test_send_frame_when_pipelining_pending_event(self):
+        conn = mock()
+        c = Channel(conn, 32, {})
+        c._pending_events.append('cb')
+        c._pipelining = True
+
+        expect(conn.send_frame).args('frame')
+        c.send_frame('frame')
+        assert_equals(deque(['cb']), c._pending_events)
+
     def test_send_frame_when_not_closed_and_flow_control(self):
         conn = mock()
         c = Channel(conn, 32, {})
@@ -486,6 +516,15 @@ class ChannelTest(Chai):
         c.add_synchronous_cb('foo')
         assert_equals(deque(['foo']), c._pending_events)
 
+    def test_add_synchronous_cb_when_pipelining(self):
+        conn = mock()
+        conn.synchronous = True
+        c = Channel(conn, None, {})
+        c._pipelining = True
+
+        assert_equals(None, c.add_synchronous_cb('foo'))
+        assert_equals(deque(['foo']), c._pending_events)
+
     def test_add_synchronous_cb_when_transport_asynchronous_but_channel_synchronous(self):
         conn = mock()
         conn.synchronous = False
@@ -8,16 +8,24 @@ from chai import Chai
 
 from haigha.classes import basic_class
 from haigha.classes.protocol_class import ProtocolClass
-from haigha.classes.basic_class import BasicClass
+from haigha.classes.basic_class import BasicClass, BatchConsumer, \
+    ConsumerRecord
 from haigha.frames.method_frame import MethodFrame
 from haigha.writer import Writer
 from haigha.reader import Reader
 from haigha.message import Message
 from haigha.connection import Connection
+from haigha.timers import TimerService
 
 from collections import deque
 
 
+def consumer_cbs(klass):
+    '''Return the registered consumers keyed by tag.'''
+    return dict(
+        (tag, record.consumer) for tag, record in klass._consumers.iteritems())
+
+
 class BasicClassTest(Chai):
 
     def setUp(self):
@@ -46,7 +54,8 @@ class BasicClassTest(Chai):
             }, klass.dispatch_map)
         assert_equals(0, klass._consumer_tag_id)
         assert_equals(deque(), klass._pending_consumers)
-        assert_equals({}, klass._consumer_cb)
+        assert_equals({}, klass._consumers)
+        assert_equals({}, klass._consumer_tags)
         assert_equals(deque(), klass._get_cb)
         assert_equals(deque(), klass._recover_cb)
         assert_equals(deque(), klass._cancel_cb)
@@ -55,7 +64,8 @@ class BasicClassTest(Chai):
     def test_cleanup(self):
         self.klass._cleanup()
         assert_equals(None, self.klass._pending_consumers)
-        assert_equals(None, self.klass._consumer_cb)
+        assert_equals(None, self.klass._consumers)
+        assert_equals(None, self.klass._consumer_tags)
         assert_equals(None, self.klass._get_cb)
         assert_equals(None, self.klass._recover_cb)
         assert_equals(None, self.klass._cancel_cb)
@@ -127,10 +137,10 @@ class BasicClassTest(Chai):
         expect(self.klass.send_frame).args('frame')
 
         assert_equals(deque(), self.klass._pending_consumers)
-        assert_equals({}, self.klass._consumer_cb)
+        assert_equals({}, consumer_cbs(self.klass))
         self.klass.consume('queue', 'consumer')
         assert_equals(deque(), self.klass._pending_consumers)
-        assert_equals({'ctag': 'consumer'}, self.klass._consumer_cb)
+        assert_equals({'ctag': 'consumer'}, consumer_cbs(self.klass))
 
     def test_consume_with_args_including_nowait_and_ticket(self):
         w = mock()
@@ -148,12 +158,14 @@ class BasicClassTest(Chai):
             self.klass._recv_consume_ok)
 
         assert_equals(deque(), self.klass._pending_consumers)
-        assert_equals({}, self.klass._consumer_cb)
+        assert_equals({}, consumer_cbs(self.klass))
         self.klass.consume('queue', 'consumer', consumer_tag='stag', no_local='nloc',
                            no_ack='nack', exclusive='mine', nowait=False, ticket='train')
-        assert_equals(
-            deque([('consumer', None)]), self.klass._pending_consumers)
-        assert_equals({}, self.klass._consumer_cb)
+        record, cb = self.klass._pending_consumers[0]
+        assert_equals(1, len(self.klass._pending_consumers))
+        assert_equals(('stag', 'consumer', None), (
+            record.consumer_tag, record.consumer, cb))
+        assert_equals({}, consumer_cbs(self.klass))
 
     def test_consume_with_args_including_nowait_no_ticket_with_callback(self):
         w = mock()
@@ -171,24 +183,28 @@ class BasicClassTest(Chai):
             self.klass._recv_consume_ok)
 
         self.klass._pending_consumers = deque([('blargh', None)])
-        assert_equals({}, self.klass._consumer_cb)
+        assert_equals({}, consumer_cbs(self.klass))
         self.klass.consume('queue', 'consumer', consumer_tag='stag', no_local='nloc',
                            no_ack='nack', exclusive='mine', nowait=False, cb='callback')
-        assert_equals(deque(
-            [('blargh', None), ('consumer', 'callback')]), self.klass._pending_consumers)
-        assert_equals({}, self.klass._consumer_cb)
+        assert_equals(2, len(self.klass._pending_consumers))
+        assert_equals(('blargh', None), self.klass._pending_consumers[0])
+        record, cb = self.klass._pending_consumers[1]
+        assert_equals(('consumer', 'callback'), (record.consumer, cb))
+        assert_equals({}, consumer_cbs(self.klass))
 
     def test_recv_consume_ok(self):
         frame = mock()
         cb = mock()
         expect(frame.args.read_shortstr).returns('ctag')
+        blargh = ConsumerRecord('', 'blargh')
         self.klass._pending_consumers = deque(
-            [('consumer', None), ('blargh', cb)])
+            [(ConsumerRecord('', 'consumer'), None), (blargh, cb)])
 
-        assert_equals({}, self.klass._consumer_cb)
+        assert_equals({}, consumer_cbs(self.klass))
         self.klass._recv_consume_ok(frame)
-        assert_equals({'ctag': 'consumer'}, self.klass._consumer_cb)
-        assert_equals(deque([('blargh', cb)]), self.klass._pending_consumers)
+        assert_equals({'ctag': 'consumer'}, consumer_cbs(self.klass))
+        assert_equals('ctag', self.klass._consumers['ctag'].consumer_tag)
+        assert_equals(deque([(blargh, cb)]), self.klass._pending_consumers)
 
         # call again and assert that cb is called
         frame2 = mock()
@@ -196,7 +212,9 @@ class BasicClassTest(Chai):
         expect(cb)
         self.klass._recv_consume_ok(frame2)
         assert_equals(
-            {'ctag': 'consumer', 'ctag2': 'blargh'}, self.klass._consumer_cb)
+            {'ctag': 'consumer', 'ctag2': 'blargh'}, consumer_cbs(self.klass))
+        assert_equals({'consumer': ['ctag'], 'blargh': ['ctag2']},
+                      self.klass._consumer_tags)
         assert_equals(deque(), self.klass._pending_consumers)
 
     def test_cancel_default_args(self):
@@ -212,11 +230,11 @@ class BasicClassTest(Chai):
         expect(self.klass.logger.info).args(
             'purged consumer with tag " %s "', '')
 
-        self.klass._consumer_cb[''] = 'foo'
+        self.klass._add_consumer(ConsumerRecord('', 'foo'))
         assert_equals(deque(), self.klass._cancel_cb)
         self.klass.cancel()
         assert_equals(deque(), self.klass._cancel_cb)
-        assert_equals({}, self.klass._consumer_cb)
+        assert_equals({}, consumer_cbs(self.klass))
 
     def test_cancel_nowait_and_consumer_tag_not_registered(self):
         w = mock()
@@ -235,7 +253,7 @@ class BasicClassTest(Chai):
         assert_equals(deque(), self.klass._cancel_cb)
         self.klass.cancel(consumer_tag='ctag')
         assert_equals(deque(), self.klass._cancel_cb)
-        assert_equals({}, self.klass._consumer_cb)
+        assert_equals({}, consumer_cbs(self.klass))
 
     def test_cancel_wait_without_cb(self):
         w = mock()
@@ -254,7 +272,7 @@ class BasicClassTest(Chai):
         assert_equals(deque(), self.klass._cancel_cb)
         self.klass.cancel(nowait=False)
         assert_equals(deque([None]), self.klass._cancel_cb)
-        assert_equals({}, self.klass._consumer_cb)
+        assert_equals({}, consumer_cbs(self.klass))
 
     def test_cancel_wait_with_cb(self):
         w = mock()
@@ -273,7 +291,7 @@ class BasicClassTest(Chai):
         self.klass._cancel_cb = deque(['blargh'])
         self.klass.cancel(nowait=False, cb='user_cb')
         assert_equals(deque(['blargh', 'user_cb']), self.klass._cancel_cb)
-        assert_equals({}, self.klass._consumer_cb)
+        assert_equals({}, consumer_cbs(self.klass))
 
     def test_cancel_resolves_to_ctag_when_consumer_arg_supplied(self):
         w = mock()
@@ -288,18 +306,18 @@ class BasicClassTest(Chai):
         expect(self.klass.logger.info).args(
             'purged consumer with tag " %s "', 'ctag')
 
-        self.klass._consumer_cb['ctag'] = 'consumer'
+        self.klass._add_consumer(ConsumerRecord('ctag', 'consumer'))
         assert_equals(deque(), self.klass._cancel_cb)
 
         self.klass.cancel(consumer='consumer')
         assert_equals(deque(), self.klass._cancel_cb)
-        assert_equals({}, self.klass._consumer_cb)
+        assert_equals({}, consumer_cbs(self.klass))
 
     def test_recv_cancel_ok_when_consumer_and_callback(self):
         frame = mock()
         cancel_cb = mock()
         expect(frame.args.read_shortstr).returns('ctag')
-        self.klass._consumer_cb['ctag'] = 'foo'
+        self.klass._add_consumer(ConsumerRecord('ctag', 'foo'))
         self.klass._cancel_cb = deque([cancel_cb, mock()])
         expect(self.klass.logger.info).args(
             'purged consumer with tag " %s "', 'ctag')
@@ -322,7 +340,7 @@ class BasicClassTest(Chai):
 
     def test_lookup_consumer_tag_by_consumer_with_match_found(self):
         consumer = mock()
-        self.klass._consumer_cb['ctag'] = consumer
+        self.klass._add_consumer(ConsumerRecord('ctag', consumer))
 
         consumer_tag = self.klass._lookup_consumer_tag_by_consumer(consumer)
         assert_equals('ctag', consumer_tag)
@@ -332,13 +350,47 @@ class BasicClassTest(Chai):
         consumer_tag = self.klass._lookup_consumer_tag_by_consumer(consumer)
         assert_is(None, consumer_tag)
 
+    def test_lookup_consumer_tag_by_unhashable_consumer(self):
+        consumer = []
+        self.klass._add_consumer(ConsumerRecord('ctag', consumer))
+        assert_equals({}, self.klass._consumer_tags)
+        assert_equals(
+            'ctag', self.klass._lookup_consumer_tag_by_consumer(consumer))
+
+        expect(self.klass.logger.info).any_args()
+        self.klass._purge_consumer_by_tag('ctag')
+        assert_equals({}, self.klass.consumers)
+
+    def test_purge_consumer_by_tag_keeps_index_for_reused_consumer(self):
+        self.klass._add_consumer(ConsumerRecord('ctag1', 'consumer'))
+        self.klass._add_consumer(ConsumerRecord('ctag2', 'consumer'))
+        expect(self.klass.logger.info).any_args()
+
+        self.klass._purge_consumer_by_tag('ctag1')
+        assert_equals({'consumer': ['ctag2']}, self.klass._consumer_tags)
+        assert_equals(['ctag2'], self.klass.consumers.keys())
+
+    def test_cancel_by_consumer_cancels_each_of_its_tags(self):
+        consumer = mock()
+        expect(self.klass.allow_nowait).returns(True).times(4)
+        expect(self.klass.send_frame).any_args().times(4)
+        expect(self.klass.logger.info).any_args().times(2)
+        self.klass.consume('q1', consumer)
+        self.klass.consume('q2', consumer)
+
+        self.klass.cancel(consumer=consumer)
+        assert_equals(['channel-42-2'], self.klass.consumers.keys())
+        self.klass.cancel(consumer=consumer)
+        assert_equals({}, self.klass.consumers)
+        assert_equals({}, self.klass._consumer_tags)
+
     def test_purge_consumer_by_tag_with_match_found(self):
-        self.klass._consumer_cb['ctag'] = mock()
+        self.klass._add_consumer(ConsumerRecord('ctag', mock()))
         expect(self.klass.logger.info).args(
             'purged consumer with tag " %s "', 'ctag')
 
         self.klass._purge_consumer_by_tag('ctag')
-        assert_equals({}, self.klass._consumer_cb)
+        assert_equals({}, consumer_cbs(self.klass))
 
     def test_purge_consumer_by_tag_with_match_not_found(self):
         expect(self.klass.logger.warning).args(
@@ -346,6 +398,50 @@ class BasicClassTest(Chai):
 
         self.klass._purge_consumer_by_tag('ctag')
 
+    def test_purge_consumer_by_tag_flushes_batch(self):
+        batch = mock()
+        self.klass._consumers['ctag'] = ConsumerRecord('ctag', 'c', batch)
+        self.klass._batch_consumers['ctag'] = batch
+        expect(batch.flush)
+        expect(self.klass.logger.info).any_args()
+
+        self.klass._purge_consumer_by_tag('ctag')
+        assert_equals({}, self.klass._batch_consumers)
+
+    def test_consume_with_batch_size(self):
+        expect(self.klass.send_frame).any_args()
+        expect(self.klass.allow_nowait).returns(True)
+
+        self.klass.consume('queue', 'consumer', consumer_tag='ctag',
+                           batch_size=10, batch_timeout=0.5)
+        batch = self.klass._consumers['ctag'].callback
+        assert_true(isinstance(batch, BatchConsumer))
+        assert_equals('consumer', batch.consumer)
+        assert_equals(10, batch._batch_size)
+        assert_equals(0.5, batch._batch_timeout)
+        assert_equals(self.klass.channel.connection.timers, batch._timers)
+        assert_equals({'ctag': batch}, self.klass._batch_consumers)
+        assert_equals(
+            'ctag', self.klass._lookup_consumer_tag_by_consumer('consumer'))
+
+    def test_flush_batches(self):
+        b1 = mock()
+        b2 = mock()
+        self.klass._batch_consumers = {'a': b1, 'b': b2}
+        expect(b1.due).returns(True)
+        expect(b1.flush)
+        expect(b2.due).returns(False)
+
+        self.klass.flush_batches()
+
+    def test_cleanup_drops_partial_batches(self):
+        batch = mock()
+        self.klass._batch_consumers = {'ctag': batch}
+        expect(batch.clear)
+
+        self.klass._cleanup()
+        assert_equals(None, self.klass._batch_consumers)
+
 
     def test_publish_default_args(self):
         args = Writer()
@@ -445,13 +541,14 @@ class BasicClassTest(Chai):
         msg = mock()
         msg.delivery_info = {'consumer_tag': 'ctag'}
         cb = mock()
-        self.klass._consumer_cb['ctag'] = cb
+        self.klass._add_consumer(ConsumerRecord('ctag', cb))
 
         expect(self.klass._read_msg).args(
             'frame', with_consumer_tag=True, with_message_count=False).returns(msg)
         expect(cb).args(msg)
 
         self.klass._recv_deliver('frame')
+        assert_equals(1, self.klass.consumers['ctag'].delivered)
 
     def test_recv_deliver_without_cb(self):
         msg = mock()
@@ -695,7 +792,7 @@ class BasicClassTest(Chai):
         header_frame.properties = {}
         cframe1 = mock()
         cframe2 = mock()
-        self.klass._consumer_cb['ctag'] = mock()
+        self.klass._add_consumer(ConsumerRecord('ctag', mock()))
         delivery_info = {
             'channel': self.klass.channel,
             'delivery_tag': 'dtag',
@@ -797,3 +894,67 @@ class BasicClassTest(Chai):
 
         assert_equals((header_frame, 'x' * 100), self.klass._reap_msg_frames(
             method_frame))
+
+
+class BatchConsumerTest(Chai):
+
+    def test_delivers_when_full(self):
+        consumer = mock()
+        b = BatchConsumer(consumer, 2)
+        b('m1')
+        assert_equals(1, len(b))
+        expect(consumer).args(['m1', 'm2'])
+        b('m2')
+        assert_equals(0, len(b))
+
+    def test_due_without_timeout(self):
+        b = BatchConsumer(mock(), 5)
+        assert_false(b.due())
+        b('m1')
+        assert_true(b.due())
+
+    def test_timeout_delivers_partial_batch(self):
+        consumer = mock()
+        now = [100]
+        timers = TimerService(clock=lambda: now[0])
+        b = BatchConsumer(consumer, 5, 2, timers)
+        b('m1')
+        b('m2')
+        assert_false(b.due())
+        assert_equals(1, len(timers))
+        timers.run()
+
+        expect(consumer).args(['m1', 'm2'])
+        now[0] = 102
+        timers.run()
+        assert_equals(0, len(b))
+        assert_equals(None, b._timer)
+
+    def test_flush_cancels_timeout(self):
+        consumer = mock()
+        timers = TimerService()
+        b = BatchConsumer(consumer, 2, 2, timers)
+        b('m1')
+        timer = b._timer
+        expect(consumer).args(['m1', 'm2'])
+        b('m2')
+        assert_false(timer.active)
+        assert_equals(None, b._timer)
+
+    def test_clear(self):
+        timers = TimerService()
+        b = BatchConsumer(mock(), 5, 2, timers)
+        b('m1')
+        timer = b._timer
+        b.clear()
+        assert_equals(0, len(b))
+        assert_false(timer.active)
+
+    def test_flush(self):
+        consumer = mock()
+        b = BatchConsumer(consumer, 5)
+        b.flush()
+        b('m1')
+        expect(consumer).args(['m1'])
+        b.flush()
+        assert_equals(0, len(b))
@@ -10,6 +10,7 @@ from chai import Chai
 from haigha.classes import exchange_class
 from haigha.classes.protocol_class import ProtocolClass
 from haigha.classes.exchange_class import ExchangeClass
+from haigha.declaration_cache import DeclarationCache
 from haigha.frames.method_frame import MethodFrame
 from haigha.writer import Writer
 
@@ -20,6 +21,7 @@ class ExchangeClassTest(Chai):
         super(ExchangeClassTest, self).setUp()
         ch = mock()
         ch.channel_id = 42
+        ch.connection.declaration_cache = None
         ch.logger = mock()
         self.klass = ExchangeClass(ch)
 
@@ -99,6 +101,37 @@ class ExchangeClassTest(Chai):
                            nowait=True, arguments='table', ticket='t', cb='foo')
         assert_equals(deque(['foo']), self.klass._declare_cb)
 
+    def test_declare_with_cache(self):
+        cache = self.klass.channel.connection.declaration_cache = \
+            DeclarationCache()
+        self.klass.channel.synchronous = False
+        expect(self.klass.send_frame).args(is_a(MethodFrame))
+        self.klass.declare('exchange', 'topic', durable=True)
+        assert_true(DeclarationCache.exchange_key(
+            'exchange', 'topic', True, False, False, None) in cache)
+
+        # Repeats are skipped, but the callback is still called
+        cb = mock()
+        expect(cb)
+        self.klass.declare('exchange', 'topic', durable=True)
+        self.klass.declare('exchange', 'topic', durable=True, cb=cb)
+        assert_equals(deque(), self.klass._declare_cb)
+
+        # Passive declarations are always sent
+        expect(self.klass.send_frame).args(is_a(MethodFrame))
+        self.klass.declare('exchange', 'topic', passive=True, durable=True)
+
+    def test_delete_with_cache(self):
+        cache = self.klass.channel.connection.declaration_cache = \
+            DeclarationCache()
+        self.klass.channel.synchronous = False
+        key = DeclarationCache.exchange_key(
+            'exchange', 'topic', False, False, False, None)
+        cache.add(key, 42)
+        expect(self.klass.send_frame).args(is_a(MethodFrame))
+        self.klass.delete('exchange')
+        assert_false(key in cache)
+
     def test_recv_declare_ok_no_cb(self):
         self.klass._declare_cb = deque([None])
         self.klass._recv_declare_ok('frame')
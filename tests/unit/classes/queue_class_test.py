@@ -9,6 +9,7 @@ from chai import Chai
 from haigha.classes import queue_class
 from haigha.classes.protocol_class import ProtocolClass
 from haigha.classes.queue_class import QueueClass
+from haigha.declaration_cache import DeclarationCache
 from haigha.frames.method_frame import MethodFrame
 from haigha.writer import Writer
 
@@ -21,6 +22,7 @@ class QueueClassTest(Chai):
         super(QueueClassTest, self).setUp()
         ch = mock()
         ch.channel_id = 42
+        ch.connection.declaration_cache = None
         ch.logger = mock()
         self.klass = QueueClass(ch)
 
@@ -112,6 +114,49 @@ class QueueClassTest(Chai):
                                                    cb='callback'))
         assert_equals(deque(['blargh', 'callback']), self.klass._declare_cb)
 
+    def test_declare_with_cache_and_nowait(self):
+        cache = self.klass.channel.connection.declaration_cache = \
+            DeclarationCache()
+        expect(self.klass.allow_nowait).returns(True).times(2)
+        expect(self.klass.send_frame).args(is_a(MethodFrame))
+        self.klass.declare('queue', durable=True)
+        key = DeclarationCache.queue_key('queue', True, False, True, {})
+        assert_true(key in cache)
+
+        # The result isn't known, so a repeat is only skipped if it
+        # doesn't need one
+        self.klass.declare('queue', durable=True)
+
+        expect(self.klass.allow_nowait).returns(True)
+        expect(self.klass.send_frame).args(is_a(MethodFrame))
+        expect(self.klass.channel.add_synchronous_cb).args(
+            self.klass._recv_declare_ok)
+        self.klass.declare('queue', durable=True, cb='callback')
+        assert_equals(1, len(self.klass._declare_cb))
+
+    def test_declare_with_cache_always_sends_when_result_needed(self):
+        cache = self.klass.channel.connection.declaration_cache = \
+            DeclarationCache()
+        expect(self.klass.allow_nowait).returns(False).times(2)
+        expect(self.klass.send_frame).args(is_a(MethodFrame)).times(2)
+        expect(self.klass.channel.add_synchronous_cb).args(
+            self.klass._recv_declare_ok).times(2)
+        self.klass.declare('queue')
+        key = DeclarationCache.queue_key('queue', False, False, True, {})
+        assert_true(key in cache)
+
+        # The counts may have changed, so the repeat goes to the broker
+        self.klass.declare('queue')
+
+    def test_declare_with_cache_skips_server_named_and_passive(self):
+        cache = self.klass.channel.connection.declaration_cache = \
+            DeclarationCache()
+        expect(self.klass.allow_nowait).returns(True).times(2)
+        expect(self.klass.send_frame).args(is_a(MethodFrame)).times(2)
+        self.klass.declare()
+        self.klass.declare('queue', passive=True)
+        assert_equals(0, len(cache))
+
     def test_recv_declare_ok_with_callback(self):
         rframe = mock()
         cb = mock()
@@ -221,6 +266,31 @@ class QueueClassTest(Chai):
         assert_equals(1, len(self.klass._bind_cb))
         assert_false(None in self.klass._bind_cb)
 
+    def test_bind_unbind_and_delete_with_cache(self):
+        cache = self.klass.channel.connection.declaration_cache = \
+            DeclarationCache()
+        self.klass.channel.synchronous = False
+        key = DeclarationCache.queue_bind_key('queue', 'exchange', 'rk', {})
+        expect(self.klass.send_frame).args(is_a(MethodFrame))
+        self.klass.bind('queue', 'exchange', 'rk')
+        assert_true(key in cache)
+
+        cb = mock()
+        expect(cb)
+        self.klass.bind('queue', 'exchange', 'rk', cb=cb)
+
+        expect(self.klass.send_frame).args(is_a(MethodFrame))
+        expect(self.klass.channel.add_synchronous_cb).args(
+            self.klass._recv_unbind_ok)
+        self.klass.unbind('queue', 'exchange', 'rk')
+        assert_false(key in cache)
+
+        cache.add(key, 42)
+        cache.add(DeclarationCache.queue_key('queue', 0, 0, 0, {}), 42)
+        expect(self.klass.send_frame).args(is_a(MethodFrame))
+        self.klass.delete('queue')
+        assert_equals(0, len(cache))
+
     def test_unbind_default_args(self):
         w = mock()
         expect(mock(queue_class, 'Writer')).returns(w)
@@ -0,0 +1,77 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+import threading
+
+from chai import Chai
+
+from haigha import clock
+
+
+class FakeTime(object):
+
+    @staticmethod
+    def time():
+        return 42
+
+
+class ClockTest(Chai):
+
+    def setUp(self):
+        super(ClockTest, self).setUp()
+        self._time = clock.time
+
+    def tearDown(self):
+        clock.time = self._time
+        super(ClockTest, self).tearDown()
+
+    def test_monotonic_does_not_go_backwards(self):
+        last = clock.monotonic()
+        for _ in xrange(1000):
+            now = clock.monotonic()
+            assert_true(now >= last)
+            last = now
+
+    def test_clock_gettime_from_several_threads(self):
+        gettime = clock._clock_gettime(1)
+        if gettime is None:
+            return
+        errors = []
+
+        def read():
+            last = gettime()
+            for _ in xrange(10000):
+                now = gettime()
+                if now < last:
+                    errors.append((last, now))
+                last = now
+
+        threads = [threading.Thread(target=read) for _ in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert_equals([], errors)
+
+    def test_find_monotonic_prefers_time_monotonic(self):
+        mock(clock, 'time')
+        clock.time.monotonic = 'monotonic'
+        assert_equals('monotonic', clock._find_monotonic())
+
+    def test_find_monotonic_uses_clock_gettime(self):
+        clock.time = FakeTime
+        mock(clock, 'sys')
+        clock.sys.platform = 'linux2'
+        expect(clock._clock_gettime).args(1).returns('gettime')
+        assert_equals('gettime', clock._find_monotonic())
+
+    def test_find_monotonic_falls_back_to_time(self):
+        clock.time = FakeTime
+        mock(clock, 'sys')
+        clock.sys.platform = 'plan9'
+        mock(clock, 'warnings')
+        expect(clock.warnings.warn).args(str)
+        assert_equals(FakeTime.time, clock._find_monotonic())
@@ -0,0 +1,229 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+import socket
+
+from chai import Chai
+
+from haigha import connection_pool
+from haigha.connection_pool import ConnectionPool
+from haigha.exceptions import ConnectionClosed
+from haigha.timers import TimerService
+
+
+class FakeTransport(object):
+
+    '''A transport which reads in the background, or from a socket.'''
+
+    def __init__(self, sock=None):
+        self.synchronous = sock is not None
+        self.sock = sock
+
+    def fileno(self):
+        return self.sock.fileno() if self.sock else None
+
+
+class FakeConnection(object):
+
+    '''Records its options instead of connecting.'''
+
+    fail = False
+
+    def __init__(self, **kwargs):
+        if FakeConnection.fail:
+            raise IOError('refused')
+        self.kwargs = kwargs
+        self.closed = False
+        self.transport = FakeTransport()
+        self.timers = TimerService()
+        self.channels = []
+        self.reads = 0
+        self.writable = True
+
+    def add_writable_listener(self, listener):
+        pass
+
+    def channel(self, synchronous=False):
+        channel = FakeChannel()
+        self.channels.append(channel)
+        return channel
+
+    def read_frames(self):
+        self.reads += 1
+        if self.transport.sock:
+            self.transport.sock.recv(1024)
+
+    def close(self, *args):
+        self.closed = True
+
+
+class FakeChannel(object):
+
+    def __init__(self):
+        self.close_listeners = []
+
+    def add_close_listener(self, listener):
+        self.close_listeners.append(listener)
+
+
+class ConnectionPoolTest(Chai):
+
+    def setUp(self):
+        super(ConnectionPoolTest, self).setUp()
+        FakeConnection.fail = False
+
+    def pool(self, **kwargs):
+        kwargs.setdefault('connection_class', FakeConnection)
+        return ConnectionPool(**kwargs)
+
+    def test_init(self):
+        pool = self.pool(size=3, user='u', port=5673)
+        assert_equals(3, len(pool.connections))
+        assert_false(pool.closed)
+        for conn in pool.connections:
+            assert_equals('localhost', conn.kwargs['host'])
+            assert_equals(5673, conn.kwargs['port'])
+            assert_equals('u', conn.kwargs['user'])
+            assert_true(callable(conn.kwargs['close_cb']))
+        assert_equals(3, len(pool._channel_pools))
+        assert_equals(pool.connections[0], pool._channel_pools[0]._connection)
+
+    def test_init_with_hosts(self):
+        pool = self.pool(size=3, hosts=['a', 'b:5673', ('c', 1)])
+        assert_equals([('a', 5672), ('b', 5673), ('c', 1)],
+                      [(c.kwargs['host'], c.kwargs['port'])
+                       for c in pool.connections])
+
+    def test_init_with_bad_policy(self):
+        assert_raises(ValueError, self.pool, policy='random')
+
+    def test_init_when_connect_fails(self):
+        FakeConnection.fail = True
+        clock = mock(connection_pool, 'monotonic')
+        expect(clock).returns(100).times(2)
+        pool = self.pool(retry_interval=5)
+        assert_equals([], pool.connections)
+        assert_equals([105, 105], pool._retry_at)
+
+        expect(clock).returns(101)
+        assert_raises(ConnectionClosed, pool.channel)
+
+    def test_channel_least_loaded(self):
+        pool = self.pool(size=2)
+        c1 = pool.channel()
+        c2 = pool.channel()
+        assert_equals(1, len(pool._connections[0].channels))
+        assert_equals(1, len(pool._connections[1].channels))
+        assert_equals([1, 1], pool._channels)
+
+        c1.close_listeners[0](c1)
+        assert_equals([0, 1], pool._channels)
+        pool.channel()
+        assert_equals(2, len(pool._connections[0].channels))
+
+    def test_channel_hash(self):
+        pool = self.pool(size=4, policy='hash')
+        index = hash('key') % 4
+        pool.channel('key')
+        pool.channel('key')
+        assert_equals(2, len(pool._connections[index].channels))
+
+        # Keys move to the next connection while theirs is down
+        pool._connections[index].closed = True
+        pool.channel('key')
+        assert_equals(
+            1, len(pool._connections[(index + 1) % 4].channels))
+
+    def test_publish_least_loaded(self):
+        pool = self.pool(size=2)
+        pool._channel_pools[0]._queue.append('busy')
+        expect(pool._channel_pools[1].publish).args('msg', 'ex', 'rk', a=1)
+        pool.publish('msg', 'ex', 'rk', a=1)
+
+    def test_publish_hash_uses_routing_key(self):
+        pool = self.pool(size=4, policy='hash')
+        index = hash('rk') % 4
+        expect(pool._channel_pools[index].publish).args('msg', 'ex', 'rk')
+        expect(pool._channel_pools[index].publish).args(
+            'msg', exchange='ex', routing_key='rk')
+        pool.publish('msg', 'ex', 'rk')
+        pool.publish('msg', exchange='ex', routing_key='rk')
+
+    def test_read_frames(self):
+        pool = self.pool(size=2)
+        pool._connections[1].closed = True
+        pool.read_frames()
+        assert_equals(1, pool._connections[0].reads)
+        assert_equals(0, pool._connections[1].reads)
+
+    def test_read_frames_waits_on_blocking_transports_together(self):
+        pool = self.pool(size=2)
+        pairs = [socket.socketpair() for _ in xrange(2)]
+        try:
+            for connection, (sock, _) in zip(pool._connections, pairs):
+                connection.transport = FakeTransport(sock)
+            fired = []
+            pool._connections[0].timers.schedule(0, fired.append, True)
+
+            # Only the connection with data is read, and the other's timers
+            # are run
+            pairs[1][1].sendall('x')
+            pool.read_frames()
+            assert_equals(0, pool._connections[0].reads)
+            assert_equals(1, pool._connections[1].reads)
+            assert_equals([True], fired)
+
+            # Without data, it waits no longer than the timeout
+            pool.read_frames(timeout=0.01)
+            assert_equals(0, pool._connections[0].reads)
+            assert_equals(1, pool._connections[1].reads)
+        finally:
+            for a, b in pairs:
+                a.close()
+                b.close()
+
+    def test_connection_closed_replaces_connection(self):
+        close_cb = mock()
+        pool = self.pool(size=2, close_cb=close_cb)
+        old = pool._connections[1]
+        expect(close_cb)
+        old.kwargs['close_cb']()
+
+        assert_true(pool._connections[1] is not old)
+        assert_equals(2, len(pool.connections))
+        assert_equals(pool._connections[1],
+                      pool._channel_pools[1]._connection)
+
+    def test_connection_closed_retries_later_when_connect_fails(self):
+        pool = self.pool(size=2, retry_interval=5)
+        close_cb = pool._connections[0].kwargs['close_cb']
+        FakeConnection.fail = True
+        clock = mock(connection_pool, 'monotonic')
+        expect(clock).returns(100).times(2)
+        close_cb()
+        assert_equals(None, pool._connections[0])
+        assert_equals(105, pool._retry_at[0])
+
+        # Skipped until the retry interval has passed
+        FakeConnection.fail = False
+        expect(clock).returns(103)
+        pool.channel()
+        assert_equals(None, pool._connections[0])
+
+        expect(clock).returns(106)
+        pool.read_frames()
+        assert_equals(2, len(pool.connections))
+
+    def test_connection_closed_after_close(self):
+        pool = self.pool(size=2)
+        pool.close()
+        assert_true(pool.closed)
+        assert_true(all(c.closed for c in pool.connections))
+
+        pool._connections[0].kwargs['close_cb']()
+        assert_equals(None, pool._connections[0])
+        pool.read_frames()
+        assert_equals(None, pool._connections[0])
@@ -21,6 +21,8 @@ from haigha.classes.exchange_class import ExchangeClass
 from haigha.classes.queue_class import QueueClass
 from haigha.classes.transaction_class import TransactionClass
 from haigha.classes.protocol_class import ProtocolClass
+from haigha.declaration_cache import DeclarationCache
+from haigha.timers import TimerService
 
 from haigha.transports import event_transport
 from haigha.transports import gevent_transport
@@ -75,6 +77,9 @@ class ConnectionTest(Chai):
         self.connection._transport = mock()
         self.connection._synchronous = False
         self.connection._synchronous_connect = False
+        self.connection._writable_listeners = set()
+        self.connection._declaration_cache = None
+        self.connection._timers = mock()
 
     def test_init_without_keyword_args(self):
         conn = Connection.__new__(Connection)
@@ -102,6 +107,9 @@ class ConnectionTest(Chai):
         assert_equal(None, conn._heartbeat)
         assert_equal(None, conn._open_cb)
         assert_equal(None, conn._close_cb)
+        assert_equal(None, conn._declaration_cache)
+        assert_true(isinstance(conn._timers, TimerService))
+        assert_equal(conn._timers, conn.timers)
         assert_equal('AMQPLAIN', conn._login_method)
         assert_equal('en_US', conn._locale)
         assert_equal(None, conn._client_properties)
@@ -147,11 +155,37 @@ class ConnectionTest(Chai):
 
         expect(connection.ConnectionChannel).args(
             conn, 0, {}).returns('connection_channel')
-        expect(event_transport.EventTransport).args(conn).returns(transport)
+        expect(event_transport.EventTransport).args(
+            conn, transport='event').returns(transport)
         expect(conn.connect).args('localhost', 5672)
 
         conn.__init__(transport='event')
 
+    def test_init_with_declaration_cache(self):
+        conn = Connection.__new__(Connection)
+        mock(connection, 'ConnectionChannel')
+        expect(connection.ConnectionChannel).args(
+            conn, 0, {}).returns('connection_channel')
+        expect(socket_transport.SocketTransport).args(
+            conn, declaration_cache=True).returns(mock())
+        expect(conn.connect).args('localhost', 5672)
+
+        conn.__init__(declaration_cache=True)
+        assert_true(isinstance(conn.declaration_cache, DeclarationCache))
+
+    def test_init_with_timers(self):
+        conn = Connection.__new__(Connection)
+        timers = TimerService()
+        mock(connection, 'ConnectionChannel')
+        expect(connection.ConnectionChannel).args(
+            conn, 0, {}).returns('connection_channel')
+        expect(socket_transport.SocketTransport).args(
+            conn, timers=timers).returns(mock())
+        expect(conn.connect).args('localhost', 5672)
+
+        conn.__init__(timers=timers)
+        assert_true(conn.timers is timers)
+
     def test_properties(self):
         assert_equal(self.connection._logger, self.connection.logger)
         assert_equal(self.connection._debug, self.connection.debug)
@@ -322,6 +356,23 @@ class ConnectionTest(Chai):
         assert_equals(0, self.connection._close_info['class_id'])
         assert_equals(0, self.connection._close_info['method_id'])
 
+    def test_writable(self):
+        self.connection._transport.writable = False
+        assert_false(self.connection.writable)
+        self.connection._transport = None
+        assert_true(self.connection.writable)
+
+    def test_transport_writable_changed_notifies_listeners(self):
+        listener = mock()
+        self.connection._debug = False
+        self.connection.add_writable_listener(listener)
+
+        expect(listener).args(self.connection)
+        self.connection.transport_writable_changed(False)
+
+        self.connection.remove_writable_listener(listener)
+        self.connection.transport_writable_changed(True)
+
     def test_next_channel_id_when_less_than_max(self):
         self.connection._channel_counter = 32
         self.connection._channel_max = 23423
@@ -398,6 +449,13 @@ class ConnectionTest(Chai):
         ch.channel_id = 500424834
         self.connection._channel_closed(ch)
 
+    def test_channel_closed_with_declaration_cache(self):
+        ch = mock()
+        ch.channel_id = 42
+        self.connection._declaration_cache = mock()
+        expect(self.connection._declaration_cache.channel_closed).args(ch)
+        self.connection._channel_closed(ch)
+
     def test_close(self):
         self.connection._channels[0] = mock()
         expect(self.connection._channels[0].close)
@@ -440,6 +498,12 @@ class ConnectionTest(Chai):
         self.connection._close_cb = None
         self.connection._callback_close()
 
+    def test_callback_close_clears_declaration_cache(self):
+        self.connection._close_cb = None
+        self.connection._declaration_cache = mock()
+        expect(self.connection._declaration_cache.clear)
+        self.connection._callback_close()
+
     def test_callback_close_when_user_cb(self):
         self.connection._close_cb = mock()
         expect(self.connection._close_cb)
@@ -456,21 +520,39 @@ class ConnectionTest(Chai):
         assert_equals(0, self.connection._frames_read)
 
     def test_read_frames_when_transport_returns_no_data(self):
-        self.connection._heartbeat = None
-        expect(self.connection._channels[0].send_heartbeat)
+        expect(self.connection._timers.run).returns(None)
         expect(self.connection._transport.read).args(None).returns(None)
         self.connection.read_frames()
         assert_equals(0, self.connection._frames_read)
 
+    def test_read_frames_checks_heartbeat_after_empty_read(self):
+        self.connection._heartbeat = 3
+        expect(self.connection._timers.run).returns(2.5)
+        expect(self.connection._transport.read).args(2.5).returns(None)
+        expect(self.connection._channels[0].check_heartbeat)
+        self.connection.read_frames()
+
+    def test_read_frames_reads_until_next_timer(self):
+        expect(self.connection._timers.run).returns(2.5)
+        expect(self.connection._transport.read).args(2.5).returns(None)
+        self.connection.read_frames()
+
+    def test_read_frames_does_not_block_after_timers_fire(self):
+        self.connection._timers = TimerService()
+        fired = []
+        self.connection._timers.schedule(0, fired.append, True)
+        expect(self.connection._transport.read).args(
+            TimerService.RESOLUTION).returns(None)
+        self.connection.read_frames()
+        assert_equals([True], fired)
+
     def test_read_frames_when_transport_when_frame_data_and_no_debug_and_no_buffer(self):
         reader = mock()
         frame = mock()
         frame.channel_id = 42
         channel = mock()
         mock(connection, 'Reader')
-        self.connection._heartbeat = 3
-
-        expect(self.connection._channels[0].send_heartbeat)
+        expect(self.connection._timers.run).returns(3)
         expect(self.connection._transport.read).args(3).returns('data')
         expect(connection.Reader).args('data').returns(reader)
         expect(connection.Frame.read_frames).args(reader).returns([frame])
@@ -491,7 +573,7 @@ class ConnectionTest(Chai):
         mock(connection, 'Reader')
         self.connection._debug = 2
 
-        expect(self.connection._channels[0].send_heartbeat)
+        expect(self.connection._timers.run).returns(None)
         expect(self.connection._transport.read).args(None).returns('data')
         expect(connection.Reader).args('data').returns(reader)
         expect(connection.Frame.read_frames).args(reader).returns([frame])
@@ -512,9 +594,7 @@ class ConnectionTest(Chai):
         frame.channel_id = 42
         channel = mock()
         mock(connection, 'Reader')
-        self.connection._heartbeat = 3
-
-        expect(self.connection._channels[0].send_heartbeat)
+        expect(self.connection._timers.run).returns(3)
         expect(self.connection._transport.read).args(3).returns('data')
         expect(connection.Reader).args('data').returns(reader)
         expect(connection.Frame.read_frames).args(
@@ -631,13 +711,14 @@ class ConnectionChannelTest(Chai):
                           51: c._recv_close_ok,
                       }
                       )
-        assert_equal(0, c._last_heartbeat_send)
+        assert_equal(None, c._send_timer)
+        assert_equal(None, c._check_timer)
 
     def test_dispatch_on_heartbeat_frame(self):
         frame = mock()
 
         expect(frame.type).returns(HeartbeatFrame.type())
-        expect(self.ch.send_heartbeat)
+        stub(self.ch.send_heartbeat)
 
         self.ch.dispatch(frame)
 
@@ -703,38 +784,114 @@ class ConnectionChannelTest(Chai):
 
         self.ch.send_heartbeat()
 
-    def test_send_heartbeat_when_not_sent_yet(self):
-        mock(connection, 'time')
+    def test_send_heartbeat(self):
         self.ch.connection._heartbeat = 3
-        self.ch._last_heartbeat_send = 0
-
-        expect(connection.time.time).returns(4200.3).times(2)
         expect(self.ch.send_frame).args(HeartbeatFrame)
-
         self.ch.send_heartbeat()
-        assert_equals(4200.3, self.ch._last_heartbeat_send)
 
-    def test_send_heartbeat_when_sent_long_ago(self):
-        mock(connection, 'time')
-        self.ch.connection._heartbeat = 3
-        self.ch._last_heartbeat_send = 4196
-
-        expect(connection.time.time).returns(4200.3).times(2)
-        expect(self.ch.send_frame).args(HeartbeatFrame)
+    def test_start_heartbeat(self):
+        self.ch.connection._heartbeat = 10
+        old_timer = mock()
+        self.ch._send_timer = old_timer
 
-        self.ch.send_heartbeat()
-        assert_equals(4200.3, self.ch._last_heartbeat_send)
-
-    def test_send_heart_when_sent_recently(self):
-        mock(connection, 'time')
+        expect(old_timer.cancel)
+        expect(self.ch.send_heartbeat)
+        expect(self.ch._heartbeat_send_cb)
+        expect(self.ch._heartbeat_check_cb)
+        expect(self.ch.connection.transport.start_heartbeat).args(10)
+
+        self.ch._start_heartbeat()
+
+    def test_start_heartbeat_when_no_heartbeat(self):
+        self.ch.connection._heartbeat = 0
+        stub(self.ch.send_heartbeat)
+        self.ch._start_heartbeat()
+        assert_equals(None, self.ch._send_timer)
+
+    def test_heartbeat_send_cb_when_idle(self):
+        self.ch.connection._heartbeat = 10
+        self.ch.connection.transport.last_write = 100
+        expect(self.connection.timers.clock).returns(109)
+        expect(self.ch.send_heartbeat)
+        expect(self.connection.timers.schedule).args(
+            9.0, self.ch._heartbeat_send_cb).returns('timer')
+
+        self.ch._heartbeat_send_cb()
+        assert_equals('timer', self.ch._send_timer)
+
+    def test_heartbeat_send_cb_when_recently_written(self):
+        self.ch.connection._heartbeat = 10
+        self.ch.connection.transport.last_write = 100
+        expect(self.connection.timers.clock).returns(106)
+        stub(self.ch.send_heartbeat)
+        expect(self.connection.timers.schedule).args(
+            var('delay'), self.ch._heartbeat_send_cb).returns('timer')
+
+        self.ch._heartbeat_send_cb()
+        assert_almost_equals(3.0, var('delay').value)
+        assert_equals('timer', self.ch._send_timer)
+
+    def test_heartbeat_send_cb_when_no_transport(self):
+        self.ch.connection.transport = None
+        self.ch._send_timer = 'timer'
+        self.ch._heartbeat_send_cb()
+        assert_equals(None, self.ch._send_timer)
+
+    def test_heartbeat_check_cb_when_recently_read(self):
         self.ch.connection._heartbeat = 3
-        self.ch._last_heartbeat_send = 4199
+        self.ch.connection.transport.last_read = 100
+        expect(self.connection.timers.clock).returns(101)
+        expect(self.connection.timers.schedule).args(
+            5, self.ch._heartbeat_check_cb).returns('timer')
 
-        expect(connection.time.time).returns(4200.3)
-        stub(self.ch.send_frame)
+        self.ch._heartbeat_check_cb()
+        assert_equals('timer', self.ch._check_timer)
 
-        self.ch.send_heartbeat()
-        assert_equals(4199, self.ch._last_heartbeat_send)
+    def test_heartbeat_check_cb_when_nothing_read_leaves_it_to_a_read(self):
+        self.ch.connection._heartbeat = 3
+        self.ch.connection.transport.last_read = 100
+        expect(self.connection.timers.clock).returns(107)
+        expect(self.connection.timers.schedule).args(
+            0, self.ch._heartbeat_check_cb).returns('timer')
+        stub(self.connection.transport_closed)
+
+        self.ch._heartbeat_check_cb()
+        assert_equals('timer', self.ch._check_timer)
+
+    def test_heartbeat_check_cb_when_no_transport(self):
+        self.ch.connection.transport = None
+        self.ch._check_timer = 'timer'
+        self.ch._heartbeat_check_cb()
+        assert_equals(None, self.ch._check_timer)
+
+    def test_check_heartbeat_when_recently_read(self):
+        self.ch.connection._heartbeat = 3
+        self.ch.connection.transport.last_read = 100
+        self.ch._check_timer = 'timer'
+        expect(self.connection.timers.clock).returns(105)
+        stub(self.connection.transport_closed)
+        self.ch.check_heartbeat()
+
+    def test_check_heartbeat_when_not_checking(self):
+        stub(self.connection.timers.clock)
+        self.ch.check_heartbeat()
+
+    def test_check_heartbeat_when_nothing_read(self):
+        self.ch.connection._host = 'server'
+        self.ch.connection._heartbeat = 3
+        self.ch.connection.transport.last_read = 100
+        timer = mock()
+        self.ch._send_timer = timer
+        self.ch._check_timer = mock()
+
+        expect(self.connection.timers.clock).returns(106)
+        expect(timer.cancel)
+        expect(self.ch._check_timer.cancel)
+        expect(self.connection.transport_closed).args(
+            msg='Heartbeats not received from server for 6 seconds')
+        assert_raises(ConnectionClosed, self.ch.check_heartbeat)
+        assert_equals(None, self.ch._send_timer)
+        assert_equals(None, self.ch._check_timer)
 
     def test_recv_start(self):
         expect(self.ch._send_start_ok)
@@ -773,7 +930,7 @@ class ConnectionChannelTest(Chai):
 
         expect(self.ch._send_tune_ok)
         expect(self.ch._send_open)
-        expect(self.ch.send_heartbeat)
+        expect(self.ch._start_heartbeat)
 
         self.ch._recv_tune(frame)
         assert_equals(42, self.ch.connection._channel_max)
@@ -792,7 +949,7 @@ class ConnectionChannelTest(Chai):
 
         expect(self.ch._send_tune_ok)
         expect(self.ch._send_open)
-        expect(self.ch.send_heartbeat)
+        expect(self.ch._start_heartbeat)
 
         self.ch._recv_tune(frame)
         assert_equals(500, self.ch.connection._channel_max)
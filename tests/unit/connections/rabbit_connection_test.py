@@ -14,6 +14,8 @@ from haigha.connection import Connection
 from haigha.writer import Writer
 from haigha.frames import *
 from haigha.classes import *
+from haigha.classes.basic_class import ConsumerRecord
+from haigha.declaration_cache import DeclarationCache
 
 
 class RabbitConnectionTest(Chai):
@@ -70,6 +72,7 @@ class RabbitExchangeClassTest(Chai):
         super(RabbitExchangeClassTest, self).setUp()
         ch = mock()
         ch.channel_id = 42
+        ch.connection.declaration_cache = None
         ch.logger = mock()
         self.klass = RabbitExchangeClass(ch)
 
@@ -135,6 +138,26 @@ class RabbitExchangeClassTest(Chai):
                            nowait=True, arguments='table', ticket='t', cb='foo')
         assert_equals(deque(['foo']), self.klass._declare_cb)
 
+    def test_declare_bind_and_unbind_with_cache(self):
+        cache = self.klass.channel.connection.declaration_cache = \
+            DeclarationCache()
+        self.klass.channel.synchronous = False
+        expect(self.klass.send_frame).args(is_a(MethodFrame)).times(2)
+        self.klass.declare('exchange', 'topic', auto_delete=False)
+        self.klass.declare('exchange', 'topic', auto_delete=False)
+        self.klass.declare('exchange', 'topic')
+        assert_equals(2, len(cache))
+
+        key = DeclarationCache.exchange_bind_key('dest', 'source', 'rk', {})
+        expect(self.klass.send_frame).args(is_a(MethodFrame))
+        self.klass.bind('dest', 'source', 'rk')
+        self.klass.bind('dest', 'source', 'rk')
+        assert_true(key in cache)
+
+        expect(self.klass.send_frame).args(is_a(MethodFrame))
+        self.klass.unbind('dest', 'source', 'rk')
+        assert_false(key in cache)
+
     def test_bind_default_args(self):
         w = mock()
 
@@ -296,6 +319,9 @@ class RabbitBasicClassTest(Chai):
         assert_equals(None, self.klass._nack_listener)
         assert_equals(0, self.klass._msg_id)
         assert_equals(0, self.klass._last_ack_id)
+        assert_equals(None, self.klass._ack_range_listener)
+        assert_equals(None, self.klass._nack_range_listener)
+        assert_equals(0, self.klass.unconfirmed)
 
     def test_cleanup(self):
         with expect(mock(rabbit_connection, 'super')).args(is_arg(RabbitBasicClass), RabbitBasicClass).returns(mock()) as c:
@@ -304,7 +330,7 @@ class RabbitBasicClassTest(Chai):
         self.klass._cleanup()
         assert_equals(None, self.klass._ack_listener)
         assert_equals(None, self.klass._nack_listener)
-        assert_equals(None, self.klass._broker_cancel_cb_map)
+        assert_equals(None, self.klass._window_queue)
 
     def test_set_ack_listener(self):
         self.klass.set_ack_listener('foo')
@@ -331,6 +357,126 @@ class RabbitBasicClassTest(Chai):
 
         assert_equals(1, self.klass.publish('a', 'b', c='d'))
         assert_equals(1, self.klass._msg_id)
+        assert_equals(1, self.klass.unconfirmed)
+
+    def test_publish_with_confirm_cb(self):
+        self.klass.channel.confirm._enabled = True
+        with expect(mock(rabbit_connection, 'super')).args(
+                is_arg(RabbitBasicClass), RabbitBasicClass).returns(mock()) as klass:
+            expect(klass.publish).args('a', 'b')
+
+        assert_equals(1, self.klass.publish('a', 'b', confirm_cb='cb'))
+        assert_equals([(1, 'cb')], self.klass._confirms._callbacks.items())
+
+    def test_publish_queues_when_confirm_window_full(self):
+        self.klass.channel.confirm._enabled = True
+        self.klass.channel.synchronous = False
+        self.klass.set_confirm_window(2)
+        with expect(mock(rabbit_connection, 'super')).args(
+                is_arg(RabbitBasicClass), RabbitBasicClass).returns(mock()) as klass:
+            expect(klass.publish).args('a')
+            expect(klass.publish).args('b')
+
+        assert_equals(1, self.klass.publish('a'))
+        assert_equals(2, self.klass.publish('b'))
+        assert_equals(None, self.klass.publish('c', confirm_cb='cb'))
+        assert_equals(None, self.klass.publish('d'))
+        assert_equals(2, self.klass.unconfirmed)
+        assert_equals(2, self.klass.pending_publishes)
+
+    def test_confirm_releases_window(self):
+        self.klass.channel.confirm._enabled = True
+        self.klass.channel.synchronous = False
+        self.klass._confirm_window = 2
+        self.klass._msg_id = 2
+        self.klass._confirms.add(1)
+        self.klass._confirms.add(2)
+        self.klass._window_queue.extend([
+            (('c',), {'confirm_cb': 'cb'}), (('d',), {}), (('e',), {})])
+        with expect(mock(rabbit_connection, 'super')).args(
+                is_arg(RabbitBasicClass), RabbitBasicClass).returns(mock()) as klass:
+            expect(klass.publish).args('c')
+            expect(klass.publish).args('d')
+
+        self.klass._confirm(2, True, False, False)
+        assert_equals(2, self.klass.unconfirmed)
+        assert_equals(4, self.klass._msg_id)
+        assert_equals([(3, 'cb')], self.klass._confirms._callbacks.items())
+        assert_equals(1, self.klass.pending_publishes)
+
+    def test_set_confirm_window_none_flushes_queue(self):
+        self.klass.channel.confirm._enabled = True
+        self.klass._confirm_window = 1
+        self.klass._confirms.add(1)
+        self.klass._msg_id = 1
+        self.klass._window_queue.append((('b',), {}))
+        with expect(mock(rabbit_connection, 'super')).args(
+                is_arg(RabbitBasicClass), RabbitBasicClass).returns(mock()) as klass:
+            expect(klass.publish).args('b')
+
+        self.klass.set_confirm_window(None)
+        assert_equals(None, self.klass.confirm_window)
+        assert_equals(0, self.klass.pending_publishes)
+        assert_equals(2, self.klass.unconfirmed)
+
+    def test_publish_blocks_on_full_window_when_synchronous(self):
+        self.klass.channel.confirm._enabled = True
+        self.klass.channel.synchronous = True
+        self.klass.channel.closed = False
+        self.klass._confirm_window = 1
+        self.klass._confirms.add(1)
+        self.klass._msg_id = 1
+
+        def ack():
+            self.klass._confirm(1, False, True, False)
+        expect(self.klass.channel.connection.read_frames).side_effect(ack)
+        with expect(mock(rabbit_connection, 'super')).args(
+                is_arg(RabbitBasicClass), RabbitBasicClass).returns(mock()) as klass:
+            expect(klass.publish).args('b')
+
+        assert_equals(2, self.klass.publish('b'))
+        assert_equals(1, self.klass.unconfirmed)
+
+    def test_publish_raises_if_channel_closes_waiting_on_window(self):
+        self.klass.channel.confirm._enabled = True
+        self.klass.channel.synchronous = True
+        self.klass.channel.closed = False
+        self.klass._confirm_window = 1
+        self.klass._confirms.add(1)
+
+        def close():
+            self.klass.channel.closed = True
+        expect(self.klass.channel.connection.read_frames).side_effect(close)
+
+        assert_raises(rabbit_connection.ChannelClosed, self.klass.publish, 'b')
+
+    def test_recv_ack_with_range_listener_and_confirm_cbs(self):
+        self.klass._ack_range_listener = mock()
+        cb = mock()
+        for msg_id in xrange(1, 50001):
+            self.klass._confirms.add(msg_id, cb if msg_id == 7 else None)
+        frame = mock()
+        expect(frame.args.read_longlong).returns(50000)
+        expect(frame.args.read_bit).returns(True)
+        expect(self.klass._ack_range_listener).args(1, 50000)
+        expect(cb).args(7, True)
+
+        self.klass._recv_ack(frame)
+        assert_equals(0, self.klass.unconfirmed)
+
+    def test_recv_nack_with_range_listener_and_confirm_cbs(self):
+        self.klass._nack_range_listener = mock()
+        cb = mock()
+        self.klass._confirms.add(1)
+        self.klass._confirms.add(2, cb)
+        frame = mock()
+        expect(frame.args.read_longlong).returns(2)
+        expect(frame.args.read_bits).args(2).returns((False, True))
+        expect(self.klass._nack_range_listener).args(2, 2, True)
+        expect(cb).args(2, False)
+
+        self.klass._recv_nack(frame)
+        assert_equals(1, self.klass.unconfirmed)
 
     def test_recv_ack_no_listener(self):
         self.klass._recv_ack('frame')
@@ -409,12 +555,12 @@ class RabbitBasicClassTest(Chai):
         with expect(mock(rabbit_connection, 'super')).args(
                 is_arg(RabbitBasicClass), RabbitBasicClass).returns(mock()) as klass:
             expect(klass.consume).args(
-                'queue', consumer, 'ctag', False, True, False, True, None, None)
+                'queue', consumer, 'ctag', False, True, False, True, None, None,
+                None, None, None)
 
         expect(self.klass._generate_consumer_tag).args().returns('ctag')
 
         self.klass.consume('queue', consumer)
-        assert_equals({'ctag': None}, self.klass._broker_cancel_cb_map)
 
     def test_consume_with_cancel_cb(self):
         consumer = mock()
@@ -422,12 +568,12 @@ class RabbitBasicClassTest(Chai):
         with expect(mock(rabbit_connection, 'super')).args(
                 is_arg(RabbitBasicClass), RabbitBasicClass).returns(mock()) as klass:
             expect(klass.consume).args(
-                'queue', consumer, 'ctag', False, True, False, True, None, None)
+                'queue', consumer, 'ctag', False, True, False, True, None, None,
+                None, None, cancel_cb)
 
         expect(self.klass._generate_consumer_tag).args().returns('ctag')
 
         self.klass.consume('queue', consumer, cancel_cb=cancel_cb)
-        assert_equals({'ctag': cancel_cb}, self.klass._broker_cancel_cb_map)
 
     def test_consume_with_consumer_tag(self):
         consumer = mock()
@@ -435,7 +581,7 @@ class RabbitBasicClassTest(Chai):
                 is_arg(RabbitBasicClass), RabbitBasicClass).returns(mock()) as klass:
             expect(klass.consume).args(
                 'queue', consumer, 'user-ctag',
-                False, True, False, True, None, None)
+                False, True, False, True, None, None, None, None, None)
 
         expect(self.klass._generate_consumer_tag).times(0)
 
@@ -445,7 +591,7 @@ class RabbitBasicClassTest(Chai):
         assert_raises(
             ValueError,
             self.klass.consume, 'queue', mock(), cancel_cb='not-callable')
-        assert_equals({}, self.klass._broker_cancel_cb_map)
+        assert_equals({}, self.klass._consumers)
 
     def test_cancel_with_default_args(self):
         with expect(mock(rabbit_connection, 'super')).args(
@@ -466,11 +612,13 @@ class RabbitBasicClassTest(Chai):
             expect(klass.cancel).args(
                 'ctag', True, consumer, None)
 
-        self.klass._broker_cancel_cb_map['ctag'] = mock(name='cancel_cb')
+        self.klass._consumers['ctag'] = ConsumerRecord(
+            'ctag', consumer, cancel_cb=mock(name='cancel_cb'))
 
         expect(self.klass._lookup_consumer_tag_by_consumer).args(consumer).returns('ctag')
 
         self.klass.cancel(consumer=consumer)
+        assert_equals(None, self.klass._consumers['ctag'].cancel_cb)
 
     def test_cancel_by_consumer_cb_not_found(self):
         consumer = mock()
@@ -492,11 +640,13 @@ class RabbitBasicClassTest(Chai):
             expect(klass.cancel).args(
                 'ctag', True, None, None)
 
-        self.klass._broker_cancel_cb_map['ctag'] = mock(name='cancel_cb')
+        self.klass._consumers['ctag'] = ConsumerRecord(
+            'ctag', 'consumer', cancel_cb=mock(name='cancel_cb'))
 
         expect(self.klass._lookup_consumer_tag_by_consumer).times(0)
 
         self.klass.cancel(consumer_tag='ctag')
+        assert_equals(None, self.klass._consumers['ctag'].cancel_cb)
 
     def test_cancel_by_consumer_tag_with_cancel_cb_not_found(self):
         with expect(mock(rabbit_connection, 'super')).args(
@@ -513,7 +663,8 @@ class RabbitBasicClassTest(Chai):
 
     def test_recv_cancel(self):
         cancel_cb = mock()
-        self.klass._broker_cancel_cb_map['ctag'] = cancel_cb
+        record = ConsumerRecord('ctag', 'consumer', cancel_cb=cancel_cb)
+        self.klass._consumers['ctag'] = record
         frame = mock()
 
         expect(self.klass.logger.warning).args(
@@ -527,7 +678,7 @@ class RabbitBasicClassTest(Chai):
 
         self.klass._recv_cancel(frame)
 
-        assert_equals({}, self.klass._broker_cancel_cb_map)
+        assert_equals(None, record.cancel_cb)
 
     def test_recv_cancel_with_cancel_cb_not_found(self):
         frame = mock()
@@ -546,7 +697,7 @@ class RabbitBasicClassTest(Chai):
         self.klass._recv_cancel(frame)
 
     def test_recv_cancel_with_cancel_cb_not_callable(self):
-        self.klass._broker_cancel_cb_map['ctag'] = None
+        self.klass._consumers['ctag'] = ConsumerRecord('ctag', 'consumer')
         frame = mock()
 
         expect(self.klass.logger.warning).args(
@@ -558,7 +709,58 @@ class RabbitBasicClassTest(Chai):
 
         self.klass._recv_cancel(frame)
 
-        assert_equals({}, self.klass._broker_cancel_cb_map)
+        assert_equals(['ctag'], self.klass._consumers.keys())
+
+class ConfirmTrackerTest(Chai):
+
+    def test_add(self):
+        t = ConfirmTracker()
+        t.add(1)
+        t.add(2, 'cb')
+        t.add(3)
+        t.add(5)
+        assert_equals([[1, 3], [5, 5]], t._ranges)
+        assert_equals(4, t.outstanding)
+        assert_equals([(2, 'cb')], t._callbacks.items())
+
+    def test_confirm_multiple(self):
+        t = ConfirmTracker()
+        for msg_id in xrange(1, 11):
+            t.add(msg_id, 'cb%d' % msg_id if msg_id % 4 == 0 else None)
+
+        assert_equals(([(1, 6)], [(4, 'cb4')]), t.confirm(6, True))
+        assert_equals([[7, 10]], t._ranges)
+        assert_equals(4, t.outstanding)
+
+        assert_equals(([(7, 10)], [(8, 'cb8')]), t.confirm(12, True))
+        assert_equals([], t._ranges)
+        assert_equals(0, t.outstanding)
+
+    def test_confirm_multiple_after_out_of_order_single(self):
+        t = ConfirmTracker()
+        for msg_id in xrange(1, 6):
+            t.add(msg_id)
+
+        assert_equals(([(3, 3)], []), t.confirm(3))
+        assert_equals([[1, 2], [4, 5]], t._ranges)
+        assert_equals(4, t.outstanding)
+
+        assert_equals(([(1, 2), (4, 4)], []), t.confirm(4, True))
+        assert_equals([[5, 5]], t._ranges)
+        assert_equals(1, t.outstanding)
+
+    def test_confirm_single(self):
+        t = ConfirmTracker()
+        for msg_id in xrange(1, 6):
+            t.add(msg_id, 'cb' if msg_id == 1 else None)
+
+        assert_equals(([(1, 1)], [(1, 'cb')]), t.confirm(1))
+        assert_equals(([(5, 5)], []), t.confirm(5))
+        assert_equals([[2, 4]], t._ranges)
+        assert_equals(([], []), t.confirm(5))
+        assert_equals(([], []), t.confirm(42))
+        assert_equals(3, t.outstanding)
+
 
 class RabbitConfirmClassTest(Chai):
 
@@ -625,6 +827,13 @@ class RabbitConfirmClassTest(Chai):
         assert_true(self.klass._enabled)
         assert_equals(deque(['foo']), self.klass._select_cb)
 
+    def test_select_with_window(self):
+        self.klass._enabled = True
+        expect(self.klass.allow_nowait).returns(True)
+        expect(self.klass.channel.basic.set_confirm_window).args(100)
+
+        self.klass.select(window=100)
+
     def test_select_when_already_enabled(self):
         self.klass._enabled = True
         stub(self.klass.allow_nowait)
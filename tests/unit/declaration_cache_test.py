@@ -0,0 +1,97 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+from chai import Chai
+
+from haigha.declaration_cache import DeclarationCache
+
+
+class DeclarationCacheTest(Chai):
+
+    def setUp(self):
+        super(DeclarationCacheTest, self).setUp()
+        self.cache = DeclarationCache()
+
+    def channel(self, channel_id, reply_code=0):
+        ch = mock()
+        ch.channel_id = channel_id
+        ch.close_info = {'reply_code': reply_code, 'reply_text': ''}
+        return ch
+
+    def test_keys_include_all_arguments(self):
+        k1 = DeclarationCache.exchange_key('ex', 'topic', True, False, False,
+                                           {'b': 1, 'a': [1, {'c': 2}]})
+        k2 = DeclarationCache.exchange_key('ex', 'topic', 1, 0, 0,
+                                           {'a': [1, {'c': 2}], 'b': 1})
+        assert_equals(k1, k2)
+        assert_equals(hash(k1), hash(k2))
+        assert_not_equals(k1, DeclarationCache.exchange_key(
+            'ex', 'topic', False, False, False, None))
+
+        assert_equals(
+            DeclarationCache.queue_key('q', False, False, True, None),
+            DeclarationCache.queue_key('q', False, False, True, {}))
+        assert_not_equals(
+            DeclarationCache.queue_bind_key('q', 'ex', 'a', {}),
+            DeclarationCache.queue_bind_key('q', 'ex', 'b', {}))
+
+    def test_add(self):
+        key = DeclarationCache.queue_key('q', False, False, True, None)
+        self.cache.add(key, 1)
+        assert_true(key in self.cache)
+
+        # The channel which first declared it is kept
+        self.cache.add(key, 2)
+        assert_equals(1, self.cache._entries[key])
+        assert_equals(1, len(self.cache))
+
+    def test_discard(self):
+        key = DeclarationCache.queue_bind_key('q', 'ex', '', {})
+        self.cache.add(key, 1)
+        self.cache.discard(key)
+        self.cache.discard(key)
+        assert_equals(0, len(self.cache))
+
+    def test_discard_exchange(self):
+        keep = DeclarationCache.exchange_key('other', 'topic', 0, 0, 0, {})
+        for key in [
+                DeclarationCache.exchange_key('ex', 'topic', 0, 0, 0, {}),
+                DeclarationCache.queue_bind_key('q', 'ex', '', {}),
+                DeclarationCache.exchange_bind_key('ex', 'other', '', {}),
+                DeclarationCache.exchange_bind_key('other', 'ex', '', {}),
+                keep]:
+            self.cache.add(key, 1)
+        self.cache.discard_exchange('ex')
+        assert_equals([keep], self.cache._entries.keys())
+
+    def test_discard_queue(self):
+        keep = DeclarationCache.queue_bind_key('q2', 'ex', '', {})
+        self.cache.add(DeclarationCache.queue_key('q', 0, 0, 0, {}), 1)
+        self.cache.add(DeclarationCache.queue_bind_key('q', 'ex', '', {}), 1)
+        self.cache.add(keep, 1)
+        self.cache.discard_queue('q')
+        assert_equals([keep], self.cache._entries.keys())
+
+    def test_channel_closed_drops_channel_entries(self):
+        keep = DeclarationCache.queue_key('q2', 0, 0, 0, {})
+        self.cache.add(DeclarationCache.queue_key('q', 0, 0, 0, {}), 1)
+        self.cache.add(keep, 2)
+        self.cache.channel_closed(self.channel(1, 200))
+        assert_equals([keep], self.cache._entries.keys())
+
+    def test_channel_closed_with_error_clears(self):
+        self.cache.add(DeclarationCache.queue_key('q', 0, 0, 0, {}), 1)
+        self.cache.channel_closed(self.channel(2, 404))
+        assert_equals(0, len(self.cache))
+
+        self.cache.add(DeclarationCache.queue_key('q', 0, 0, 0, {}), 1)
+        self.cache.channel_closed(self.channel(2, 406))
+        assert_equals(0, len(self.cache))
+
+    def test_clear(self):
+        self.cache.add(DeclarationCache.queue_key('q', 0, 0, 0, {}), 1)
+        self.cache.clear()
+        assert_equals(0, len(self.cache))
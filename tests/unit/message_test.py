@@ -4,9 +4,11 @@ Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
 https://github.com/agoragames/haigha/blob/master/LICENSE.txt
 '''
 
+import pickle
+
 from chai import Chai
 
-from haigha.message import Message
+from haigha.message import DeliveryInfo, Message
 
 
 class MessageTest(Chai):
@@ -99,3 +101,94 @@ class MessageTest(Chai):
     def test_str_with_return_info(self):
         m = Message('foo', return_info='returned', foo='bar')
         str(m)
+
+    def test_slots(self):
+        assert_false(hasattr(Message(), '__dict__'))
+
+    def test_pickle(self):
+        m = Message('foo', foo='bar')
+        for protocol in xrange(pickle.HIGHEST_PROTOCOL + 1):
+            copy = pickle.loads(pickle.dumps(m, protocol))
+            assert_equals(m, copy)
+            assert_equals(None, copy.delivery_info)
+
+    def test_pickle_with_delivery_info(self):
+        m = Message('foo', delivery_info=DeliveryInfo(
+            'ch', 9, False, 'ex', 'rk', consumer_tag='ctag'))
+        copy = pickle.loads(pickle.dumps(m))
+        assert_equals(9, copy.delivery_info['delivery_tag'])
+        assert_equals('ctag', copy.delivery_info['consumer_tag'])
+        assert_equals(None, copy.delivery_info.channel)
+
+
+class DeliveryInfoTest(Chai):
+
+    def test_init(self):
+        d = DeliveryInfo('ch', 9, False, 'ex', 'rk', consumer_tag='ctag')
+        assert_equals('ch', d.channel)
+        assert_equals(9, d.delivery_tag)
+        assert_false(d.redelivered)
+        assert_equals('ex', d.exchange)
+        assert_equals('rk', d.routing_key)
+        assert_equals('ctag', d.consumer_tag)
+        assert_false(hasattr(d, 'message_count'))
+        assert_false(hasattr(d, '__dict__'))
+
+    def test_mapping_interface(self):
+        d = DeliveryInfo('ch', 9, False, 'ex', 'rk', message_count=3)
+        assert_equals(9, d['delivery_tag'])
+        assert_equals(3, d['message_count'])
+        assert_raises(KeyError, lambda: d['consumer_tag'])
+        assert_raises(KeyError, lambda: d['foo'])
+        assert_true('message_count' in d)
+        assert_false('consumer_tag' in d)
+        assert_equals(None, d.get('consumer_tag'))
+        assert_equals('x', d.get('foo', 'x'))
+        assert_equals(6, len(d))
+        assert_equals(
+            ['channel', 'delivery_tag', 'redelivered', 'exchange',
+             'routing_key', 'message_count'], list(d))
+        assert_equals(dict(d.items()), dict(d.iteritems()))
+        assert_equals(d.values(), list(d.itervalues()))
+
+    def test_setitem(self):
+        d = DeliveryInfo('ch', 9, False, 'ex', 'rk')
+        d['consumer_tag'] = 'ctag'
+        assert_equals('ctag', d.consumer_tag)
+
+    def test_setitem_of_other_keys(self):
+        d = DeliveryInfo('ch', 9, False, 'ex', 'rk')
+        assert_equals(None, d._extra)
+        d['foo'] = 'bar'
+        assert_equals('bar', d['foo'])
+        assert_true('foo' in d)
+        assert_equals('bar', d.get('foo'))
+        assert_equals(
+            ['channel', 'delivery_tag', 'redelivered', 'exchange',
+             'routing_key', 'foo'], d.keys())
+        assert_equals({'channel': 'ch', 'delivery_tag': 9,
+                       'redelivered': False, 'exchange': 'ex',
+                       'routing_key': 'rk', 'foo': 'bar'}, d)
+
+    def test_pickle_leaves_out_channel(self):
+        d = DeliveryInfo('ch', 9, False, 'ex', 'rk', message_count=3)
+        d['foo'] = 'bar'
+        for protocol in xrange(pickle.HIGHEST_PROTOCOL + 1):
+            copy = pickle.loads(pickle.dumps(d, protocol))
+            assert_equals(None, copy.channel)
+            expected = d.copy()
+            expected['channel'] = None
+            assert_equals(expected, copy)
+
+    def test_eq(self):
+        d = DeliveryInfo('ch', 9, False, 'ex', 'rk', consumer_tag='ctag')
+        expected = {'channel': 'ch', 'delivery_tag': 9, 'redelivered': False,
+                    'exchange': 'ex', 'routing_key': 'rk',
+                    'consumer_tag': 'ctag'}
+        assert_equals(expected, d)
+        assert_equals(d, expected)
+        assert_equals(expected, d.copy())
+        assert_equals(DeliveryInfo('ch', 9, False, 'ex', 'rk',
+                                   consumer_tag='ctag'), d)
+        assert_not_equals(DeliveryInfo('ch', 9, False, 'ex', 'rk'), d)
+        assert_not_equals(d, 'foo')
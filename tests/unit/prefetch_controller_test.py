@@ -0,0 +1,111 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+from chai import Chai
+
+from haigha import prefetch_controller
+from haigha.prefetch_controller import PrefetchController
+
+
+class PrefetchControllerTest(Chai):
+
+    def setUp(self):
+        super(PrefetchControllerTest, self).setUp()
+        self.ch = mock()
+        expect(self.ch.basic.qos).args(prefetch_count=10)
+        expect(self.ch.connection.timers.repeat).args(
+            5, is_a(object)).returns(mock())
+        expect(self.ch.add_close_listener).any_args()
+        self.pc = PrefetchController(
+            self.ch, min_prefetch=2, max_prefetch=100, initial_prefetch=10,
+            target_delay=1.0, interval=5)
+
+    def test_init(self):
+        ch = mock()
+        expect(ch.basic.qos).args(prefetch_count=1)
+        expect(ch.connection.timers.repeat).args(1.0, is_a(object))
+        expect(ch.add_close_listener).args(is_a(object))
+        pc = PrefetchController(ch)
+        assert_equals(1, pc.prefetch)
+        assert_equals(0, pc.unacked)
+        assert_equals(ch.basic, pc._acker)
+
+    def test_consumer_measures_latency_and_depth(self):
+        consumer = mock()
+        expect(mock(prefetch_controller, 'monotonic')).returns(100)
+        expect(consumer).args('msg')
+        expect(prefetch_controller.monotonic).returns(100.5)
+
+        self.pc.consumer(consumer)('msg')
+        assert_equals(1, self.pc.unacked)
+        assert_equals(1, self.pc._peak_unacked)
+        assert_equals(1, self.pc._callbacks)
+        assert_equals(0.5, self.pc._callback_time)
+
+    def test_consumer_records_failed_callbacks(self):
+        consumer = mock()
+        expect(consumer).args('msg').raises(ValueError)
+        assert_raises(ValueError, self.pc.consumer(consumer), 'msg')
+        assert_equals(1, self.pc._callbacks)
+
+    def test_ack_and_reject_forward_to_acker(self):
+        self.pc._unacked = 2
+        expect(self.ch.basic.ack).args(7)
+        expect(self.ch.basic.reject).args(8, requeue=True)
+        self.pc.ack(7)
+        self.pc.reject(8, requeue=True)
+        assert_equals(0, self.pc.unacked)
+
+    def test_target_prefetch_without_measurements(self):
+        assert_equals(None, self.pc.target_prefetch())
+
+    def test_target_prefetch_grows_when_window_full(self):
+        self.pc._callbacks = 10
+        self.pc._callback_time = 0.01
+        self.pc._peak_unacked = 10
+        assert_equals(20, self.pc.target_prefetch())
+
+        self.pc._prefetch = 80
+        self.pc._peak_unacked = 80
+        assert_equals(100, self.pc.target_prefetch())
+
+    def test_target_prefetch_does_not_grow_when_window_not_full(self):
+        self.pc._callbacks = 10
+        self.pc._callback_time = 0.01
+        self.pc._peak_unacked = 4
+        assert_equals(10, self.pc.target_prefetch())
+
+    def test_target_prefetch_shrinks_for_slow_consumers(self):
+        self.pc._callbacks = 2
+        self.pc._callback_time = 0.5
+        assert_equals(5, self.pc.target_prefetch())
+
+        self.pc._callback_time = 4
+        self.pc._prefetch = 3
+        assert_equals(2, self.pc.target_prefetch())
+
+    def test_adjust_sends_qos_and_resets(self):
+        self.pc._callbacks = 2
+        self.pc._callback_time = 0.5
+        self.pc._unacked = 3
+        expect(self.ch.basic.qos).args(prefetch_count=5)
+
+        self.pc.adjust()
+        assert_equals(5, self.pc.prefetch)
+        assert_equals(0, self.pc._callbacks)
+        assert_equals(3, self.pc._peak_unacked)
+
+    def test_adjust_when_unchanged(self):
+        self.pc._callbacks = 10
+        self.pc._callback_time = 1.0
+        self.pc.adjust()
+        assert_equals(10, self.pc.prefetch)
+
+    def test_closed_cb(self):
+        self.pc._unacked = 4
+        expect(self.pc._adjust_timer.cancel)
+        self.pc._closed_cb(self.ch)
+        assert_equals(0, self.pc.unacked)
@@ -0,0 +1,438 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+import time
+
+from chai import Chai
+
+from haigha import recovery
+from haigha.ack_batcher import AckBatcher
+from haigha.exceptions import ConnectionClosed
+from haigha.message import Message
+from haigha.recovery import RecoveringConnection
+
+
+class FakeBroker(object):
+
+    '''
+    Stands in for a broker, keeping what has been declared on it and
+    forgetting everything when it restarts.
+    '''
+
+    def __init__(self):
+        self.connections = []
+        self.refuse = False
+        self.restart()
+
+    def restart(self):
+        self.exchanges = {}
+        self.queues = {}
+        self.bindings = []
+        self.consumers = {}
+        self.published = []
+        for connection in self.connections[:]:
+            connection.drop()
+
+
+class FakeConnection(object):
+
+    broker = None
+
+    def __init__(self, **kwargs):
+        if self.broker.refuse:
+            raise IOError('refused')
+        self.kwargs = kwargs
+        self.closed = False
+        self.close_info = None
+        self.transport = 'transport'
+        self.synchronous = False
+        self.writable = True
+        self.channels = []
+        self.broker.connections.append(self)
+
+    def add_writable_listener(self, listener):
+        pass
+
+    def channel(self, synchronous=False):
+        channel = FakeChannel(self, len(self.channels) + 1)
+        self.channels.append(channel)
+        return channel
+
+    def read_frames(self):
+        pass
+
+    def drop(self):
+        self.broker.connections.remove(self)
+        self.transport = None
+        self.close_info = {'reply_code': 0, 'reply_text': 'reset',
+                           'class_id': 0, 'method_id': 0}
+        self.kwargs['close_cb']()
+
+    def close(self, *args):
+        self.closed = True
+        self.broker.connections.remove(self)
+        self.kwargs['close_cb']()
+
+
+class FakeChannel(object):
+
+    def __init__(self, connection, channel_id):
+        self.connection = connection
+        self.broker = connection.broker
+        self.channel_id = channel_id
+        self.closed = False
+        self.active = True
+        self.close_listeners = set()
+        self.prefetch = None
+        self.confirming = False
+        self.next_msg_id = 0
+        self.confirm_cbs = {}
+        self.acks = []
+        self.exchange = self.queue = self.basic = self.confirm = self
+
+    def _closed_cb(self):
+        for listener in self.close_listeners:
+            listener(self)
+
+    def add_close_listener(self, listener):
+        self.close_listeners.add(listener)
+
+    def close(self, *args):
+        self.closed = True
+        self._closed_cb()
+
+    def topology(self):
+        return FakeTopology(self)
+
+    def declare(self, name, type=None, **kwargs):
+        if type is None:
+            self.broker.queues[name] = kwargs
+        else:
+            self.broker.exchanges[name] = type
+
+    def bind(self, *args, **kwargs):
+        self.broker.bindings.append(args)
+
+    def qos(self, prefetch_size=0, prefetch_count=0, is_global=False):
+        self.prefetch = prefetch_count
+
+    def select(self, nowait=True, cb=None, window=None):
+        self.confirming = True
+
+    def consume(self, queue, consumer, consumer_tag='', **kwargs):
+        self.broker.consumers[consumer_tag] = (queue, consumer, kwargs)
+
+    def cancel(self, consumer_tag='', nowait=True, cb=None):
+        del self.broker.consumers[consumer_tag]
+
+    def publish(self, msg, exchange, routing_key, confirm_cb=None):
+        self.broker.published.append((msg, routing_key))
+        if self.confirming:
+            self.next_msg_id += 1
+            self.confirm_cbs[self.next_msg_id] = confirm_cb
+            return self.next_msg_id
+        return 0
+
+    def ack(self, delivery_tag, multiple=False):
+        self.acks.append(delivery_tag)
+
+    def deliver(self, consumer_tag, delivery_tag):
+        msg = Message('hi', delivery_info={'delivery_tag': delivery_tag})
+        self.broker.consumers[consumer_tag][1](msg)
+        return msg
+
+
+class FakeTopology(object):
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.calls = []
+
+    def declare_exchange(self, exchange, type, **kwargs):
+        self.channel.declare(exchange, type)
+        return self
+
+    def declare_queue(self, queue='', **kwargs):
+        self.channel.declare(queue, **kwargs)
+        return self
+
+    def bind_queue(self, queue, exchange, routing_key='', **kwargs):
+        self.channel.bind(queue, exchange, routing_key)
+        return self
+
+    def execute(self, cb=None, err_cb=None):
+        cb([])
+
+
+class QuietLogger(object):
+
+    '''Swallows log records, which would otherwise call time.time().'''
+
+    def _log(self, *args, **kwargs):
+        pass
+
+    debug = info = warning = error = exception = _log
+
+
+class RecoveringConnectionTest(Chai):
+
+    def setUp(self):
+        super(RecoveringConnectionTest, self).setUp()
+        self.broker = FakeConnection.broker = FakeBroker()
+
+    def connection(self, **kwargs):
+        return RecoveringConnection(connection_class=FakeConnection,
+                                    transport='gevent', logger=QuietLogger(),
+                                    **kwargs)
+
+    def setup_topology(self, conn):
+        ch = conn.channel()
+        ch.exchange.declare('ex', 'topic')
+        ch.queue.declare('q', durable=True, nowait=False)
+        ch.queue.declare(auto_delete=True)
+        ch.queue.bind('q', 'ex', 'rk')
+        return ch
+
+    def test_init(self):
+        conn = self.connection(user='u')
+        assert_equals('u', conn.connection.kwargs['user'])
+        assert_false(conn.recovering)
+        assert_false(conn.synchronous)
+        assert_equals(0, conn.recoveries)
+        assert_equals(None, conn.recovery_time)
+
+    def test_records_topology(self):
+        conn = self.connection()
+        self.setup_topology(conn)
+        assert_equals(
+            [('exchange', 'ex'), ('queue', 'q'), ('queue_bind', 'q', 'ex',
+                                                  'rk')],
+            conn._topology.keys())
+        assert_equals(('declare_queue', ('q',), {'durable': True}),
+                      conn._topology[('queue', 'q')])
+
+    def test_delete_forgets_topology(self):
+        conn = self.connection()
+        ch = self.setup_topology(conn)
+        FakeChannel.delete = lambda *args, **kwargs: None
+        try:
+            ch.queue.delete('q')
+        finally:
+            del FakeChannel.delete
+        assert_equals([('exchange', 'ex')], conn._topology.keys())
+
+    def test_recovers_after_broker_restart(self):
+        recovered = []
+        conn = self.connection(recover_cb=recovered.append)
+        ch = self.setup_topology(conn)
+        ch.basic.qos(prefetch_count=10)
+        consumed = []
+        ch.basic.consume('q', consumed.append)
+
+        old_channel = ch._channel
+        self.broker.restart()
+
+        assert_equals(1, conn.recoveries)
+        assert_equals([conn], recovered)
+        assert_true(conn.recovery_time >= 0)
+        assert_true(old_channel._closed)
+        assert_false(ch.closed)
+        assert_true(ch._channel is not old_channel)
+
+        assert_equals({'ex': 'topic'}, self.broker.exchanges)
+        assert_equals({'q': {'durable': True}}, self.broker.queues)
+        assert_equals([('q', 'ex', 'rk')], self.broker.bindings)
+        assert_equals(['recovering-1'], self.broker.consumers.keys())
+        assert_equals(10, ch._channel.prefetch)
+
+    def test_recovery_time_is_measured(self):
+        conn = self.connection()
+        self.setup_topology(conn)
+        clock = mock(recovery, 'monotonic')
+        expect(clock).returns(100.0).times(1)
+        expect(clock).returns(100.25).times(1)
+        self.broker.restart()
+        assert_equals(0.25, conn.recovery_time)
+
+    def test_recovery_time_against_fake_broker(self):
+        conn = self.connection()
+        ch = self.setup_topology(conn)
+        for i in xrange(100):
+            ch.queue.declare('q%d' % (i), durable=True)
+            ch.queue.bind('q%d' % (i), 'ex', 'rk%d' % (i))
+            ch.basic.consume('q%d' % (i), lambda msg: None)
+
+        start = time.time()
+        self.broker.restart()
+        elapsed = time.time() - start
+
+        assert_equals(101, len(self.broker.queues))
+        assert_equals(100, len(self.broker.consumers))
+        assert_true(conn.recovery_time <= elapsed)
+        assert_true(elapsed < 1.0)
+
+    def test_delivery_tags_are_offset(self):
+        conn = self.connection()
+        ch = self.setup_topology(conn)
+        consumed = []
+        ch.basic.consume('q', consumed.append, consumer_tag='tag')
+        ch._channel.deliver('tag', 1)
+        ch._channel.deliver('tag', 2)
+
+        self.broker.restart()
+        msg = ch._channel.deliver('tag', 1)
+        assert_equals(3, msg.delivery_info['delivery_tag'])
+
+        # Messages from before the restart were requeued by the broker
+        ch.basic.ack(2)
+        ch.basic.ack(3)
+        assert_equals([1], ch._channel.acks)
+
+    def test_batch_delivery_tags_are_offset(self):
+        conn = self.connection()
+        ch = conn.channel()
+        ch._tag_offset = 5
+        msgs = [Message('a', delivery_info={'delivery_tag': 1}),
+                Message('b', delivery_info={'delivery_tag': 2})]
+        consumed = []
+        ch._wrap_consumer(consumed.append)(msgs)
+        assert_equals([6, 7], [m.delivery_info['delivery_tag']
+                               for m in consumed[0]])
+        assert_equals(2, ch._last_tag)
+
+    def test_cancel_forgets_consumer(self):
+        conn = self.connection()
+        ch = self.setup_topology(conn)
+        consumer = lambda msg: None
+        ch.basic.consume('q', consumer, consumer_tag='tag')
+        ch.basic.cancel(consumer=consumer)
+        assert_equals({}, ch._consumers)
+        ch.basic.consume('q', consumer, consumer_tag='tag')
+        ch.basic.cancel('tag')
+        assert_equals({}, ch._consumers)
+        assert_equals({}, self.broker.consumers)
+
+    def test_unconfirmed_messages_are_republished(self):
+        conn = self.connection()
+        ch = self.setup_topology(conn)
+        ch.confirm.select()
+        confirms = []
+        confirm_cb = lambda *args: confirms.append(args)
+        assert_equals(1, ch.basic.publish('m1', 'ex', 'rk',
+                                          confirm_cb=confirm_cb))
+        assert_equals(2, ch.basic.publish('m2', 'ex', 'rk',
+                                          confirm_cb=confirm_cb))
+        ch._channel.confirm_cbs[1](1, True)
+        assert_equals([(1, True)], confirms)
+
+        self.broker.restart()
+        assert_true(ch._channel.confirming)
+        assert_equals([('m2', 'rk')], self.broker.published)
+
+        # The broker numbers it 1, the caller still sees 2
+        ch._channel.confirm_cbs[1](1, True)
+        assert_equals([(1, True), (2, True)], confirms)
+        assert_equals({}, ch._unconfirmed)
+
+    def test_timers_carry_over_across_reconnects(self):
+        conn = self.connection()
+        ch = conn.channel()
+        assert_true(conn.connection.kwargs['timers'] is conn.timers)
+
+        fired = []
+        timer = conn.timers.schedule(60, fired.append, True)
+        AckBatcher(ch).ack(1)
+        assert_equals(2, len(conn.timers))
+
+        self.broker.restart()
+        assert_false(conn.recovering)
+        assert_true(conn.connection.kwargs['timers'] is conn.timers)
+        assert_true(timer.active)
+
+    def test_read_frames_runs_timers_while_down(self):
+        conn = self.connection(initial_delay=10)
+        self.broker.refuse = True
+        self.broker.restart()
+        fired = []
+        conn.timers.schedule(0, fired.append, True)
+
+        conn.read_frames()
+        assert_equals([True], fired)
+        assert_true(conn.recovering)
+
+    def test_backoff_while_broker_is_down(self):
+        conn = self.connection(initial_delay=1, max_delay=3)
+        ch = self.setup_topology(conn)
+        self.broker.refuse = True
+
+        clock = mock(recovery, 'monotonic')
+        expect(clock).returns(100).times(2)
+        self.broker.restart()
+        assert_true(conn.recovering)
+        assert_equals(101, conn._next_attempt)
+
+        # Publishing and declaring while down is held for recovery
+        ch.basic.publish('held', 'ex', 'rk')
+        ch.exchange.declare('ex2', 'direct')
+        assert_raises(ConnectionClosed, getattr, ch.basic, 'flow')
+
+        expect(clock).returns(100.5)
+        conn.read_frames()
+        assert_equals(1, conn._attempts)
+
+        expect(clock).returns(101).times(2)
+        conn.read_frames()
+        assert_equals(103, conn._next_attempt)
+
+        expect(clock).returns(103).times(2)
+        conn.read_frames()
+        assert_equals(106, conn._next_attempt)
+
+        self.broker.refuse = False
+        expect(clock).returns(106).times(2)
+        conn.read_frames()
+        assert_false(conn.recovering)
+        assert_equals({'ex': 'topic', 'ex2': 'direct'},
+                      self.broker.exchanges)
+        assert_equals([('held', 'rk')], self.broker.published)
+
+    def test_gives_up_after_max_attempts(self):
+        closed = []
+        conn = self.connection(max_attempts=1,
+                               close_cb=lambda: closed.append(True))
+        ch = conn.channel()
+        channel_closed = []
+        ch.add_close_listener(lambda c: channel_closed.append(c))
+        self.broker.refuse = True
+        self.broker.restart()
+
+        assert_true(conn.closed)
+        assert_false(conn.recovering)
+        assert_equals([True], closed)
+        assert_equals([ch], channel_closed)
+        assert_false(conn.recover())
+
+    def test_close_does_not_recover(self):
+        closed = []
+        conn = self.connection(close_cb=lambda: closed.append(True))
+        conn.close()
+        assert_true(conn.closed)
+        assert_equals([True], closed)
+        assert_equals(0, conn.recoveries)
+        assert_equals([], self.broker.connections)
+
+    def test_closed_channel_is_not_recovered(self):
+        conn = self.connection()
+        ch = conn.channel()
+        closed = []
+        ch.add_close_listener(lambda c: closed.append(c))
+        ch.close()
+        assert_true(ch.closed)
+        assert_equals([ch], closed)
+        assert_equals([], conn._channels)
+
+        self.broker.restart()
+        assert_equals(None, ch._channel)
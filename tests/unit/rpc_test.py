@@ -0,0 +1,312 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+from chai import Chai
+
+from haigha.exceptions import ChannelClosed, RpcTimeout
+from haigha.message import Message
+from haigha.rpc import RpcClient, RpcCall, RpcServer
+
+
+class RpcClientTest(Chai):
+
+    def setUp(self):
+        super(RpcClientTest, self).setUp()
+        self.ch = mock()
+        expect(self.ch.add_close_listener).any_args()
+
+    def client(self, **kwargs):
+        expect(self.ch.basic.consume).args(
+            'amq.rabbitmq.reply-to', is_a(object), no_ack=True)
+        return RpcClient(self.ch, **kwargs)
+
+    def test_init_direct_reply_to(self):
+        client = self.client(routing_key='rk')
+        assert_equals('amq.rabbitmq.reply-to', client.reply_queue)
+        assert_equals('rk', client._routing_key)
+        assert_equals(0, client.pending)
+
+    def test_init_declares_reply_queue(self):
+        expect(self.ch.queue.declare).args(
+            exclusive=True, auto_delete=True, cb=is_a(object))
+        client = RpcClient(self.ch, direct_reply_to=False)
+        assert_equals(None, client.reply_queue)
+
+    def test_calls_held_until_reply_queue_declared(self):
+        expect(self.ch.queue.declare).args(
+            exclusive=True, auto_delete=True, cb=is_a(object))
+        client = RpcClient(self.ch, direct_reply_to=False)
+        rpc_call = client.call('hello', 'rk')
+        assert_equals(1, len(client._unsent))
+
+        expect(self.ch.basic.consume).args(
+            'reply', client._reply_cb, no_ack=True)
+        expect(self.ch.basic.publish).args(is_a(Message), '', 'rk')
+        client._declared_cb('reply', 0, 0)
+        assert_equals([], client._unsent)
+        assert_equals(1, client.pending)
+        assert_false(rpc_call.done)
+
+    def test_call_publishes_with_correlation_id(self):
+        client = self.client(exchange='ex', routing_key='rk')
+        msg = var('msg')
+        expect(self.ch.basic.publish).args(msg, 'ex', 'rk')
+
+        rpc_call = client.call('hello')
+        assert_equals('hello', msg.value.body)
+        assert_equals(rpc_call.correlation_id,
+                      msg.value.properties['correlation_id'])
+        assert_equals('amq.rabbitmq.reply-to',
+                      msg.value.properties['reply_to'])
+        assert_equals(rpc_call, client._pending[rpc_call.correlation_id])
+        assert_equals({}, client._timers)
+
+    def test_call_copies_message(self):
+        client = self.client()
+        orig = Message('hello', content_type='text/plain')
+        msg = var('msg')
+        expect(self.ch.basic.publish).args(msg, 'ex', 'rk')
+
+        client.call(orig, 'rk', exchange='ex')
+        assert_equals('text/plain', msg.value.properties['content_type'])
+        assert_false('correlation_id' in orig.properties)
+
+    def test_correlation_ids_are_unique(self):
+        client = self.client()
+        expect(self.ch.basic.publish).any_args().times(2)
+        assert_not_equals(client.call('a').correlation_id,
+                          client.call('b').correlation_id)
+
+    def test_call_with_timeout_schedules_timer(self):
+        client = self.client(timeout=5)
+        expect(self.ch.basic.publish).any_args().times(2)
+        expect(self.ch.connection.timers.schedule).args(
+            5, client._expire, is_a(str)).returns('t1')
+        expect(self.ch.connection.timers.schedule).args(
+            2, client._expire, is_a(str)).returns('t2')
+
+        c1 = client.call('a')
+        c2 = client.call('b', timeout=2)
+        assert_equals('t2', client._timers[c2.correlation_id])
+        assert_equals(2, len(client._timers))
+        assert_equals(2, client.pending)
+        assert_false(c1.done)
+
+    def test_reply_cb_completes_call(self):
+        client = self.client()
+        expect(self.ch.basic.publish).any_args()
+        cb = mock()
+        rpc_call = client.call('a', cb=cb)
+        reply = Message('b', correlation_id=rpc_call.correlation_id)
+        expect(cb).args(rpc_call)
+
+        client._reply_cb(reply)
+        assert_true(rpc_call.done)
+        assert_equals(reply, rpc_call.result())
+        assert_equals(0, client.pending)
+
+    def test_reply_cb_ignores_unknown_correlation_id(self):
+        client = self.client()
+        client._reply_cb(Message('b', correlation_id='unknown'))
+        client._reply_cb(Message('b'))
+
+    def test_reply_cb_cancels_timer(self):
+        client = self.client()
+        timer = mock()
+        expect(self.ch.basic.publish).any_args()
+        expect(self.ch.connection.timers.schedule).any_args().returns(timer)
+        rpc_call = client.call('a', timeout=1)
+
+        expect(timer.cancel)
+        client._reply_cb(Message('b', correlation_id=rpc_call.correlation_id))
+        assert_equals({}, client._timers)
+
+    def test_expire_fails_call(self):
+        client = self.client()
+        expect(self.ch.basic.publish).any_args().times(2)
+        expect(self.ch.connection.timers.schedule).any_args().returns(
+            mock()).times(2)
+        c1 = client.call('a', timeout=1)
+        c2 = client.call('b', timeout=10)
+
+        client._expire(c1.correlation_id)
+        assert_true(isinstance(c1.exception, RpcTimeout))
+        assert_raises(RpcTimeout, c1.result)
+        assert_false(c2.done)
+        assert_equals([c2.correlation_id], client._timers.keys())
+        assert_equals(1, client.pending)
+
+        # A timer which fires after the reply does nothing
+        client._expire(c1.correlation_id)
+
+    def test_wait_reads_frames_until_done(self):
+        client = self.client()
+        expect(self.ch.basic.publish).any_args()
+        rpc_call = client.call('a')
+        self.ch.closed = False
+        reply = Message('b', correlation_id=rpc_call.correlation_id)
+        expect(self.ch.connection.read_frames).side_effect(
+            lambda: client._reply_cb(reply))
+
+        assert_equals(reply, rpc_call.result())
+
+    def test_wait_raises_if_channel_closed(self):
+        client = self.client()
+        expect(self.ch.basic.publish).any_args()
+        rpc_call = client.call('a')
+        self.ch.closed = True
+        assert_raises(ChannelClosed, rpc_call.result)
+
+    def test_closed_cb_fails_pending_calls(self):
+        client = self.client(timeout=1)
+        timer = mock()
+        expect(self.ch.basic.publish).any_args()
+        expect(self.ch.connection.timers.schedule).any_args().returns(timer)
+        rpc_call = client.call('a')
+
+        expect(timer.cancel)
+        client._closed_cb(self.ch)
+        assert_true(isinstance(rpc_call.exception, ChannelClosed))
+        assert_equals(0, client.pending)
+        assert_equals({}, client._timers)
+
+
+class RpcCallTest(Chai):
+
+    def test_init(self):
+        rpc_call = RpcCall('client', 'cid')
+        assert_equals('cid', rpc_call.correlation_id)
+        assert_false(rpc_call.done)
+        assert_equals(None, rpc_call.reply)
+        assert_equals(None, rpc_call.exception)
+
+    def test_result_when_done_does_not_wait(self):
+        client = mock()
+        rpc_call = RpcCall(client, 'cid')
+        rpc_call._complete('reply', None)
+        assert_equals('reply', rpc_call.result())
+
+    def test_result_waits_on_client(self):
+        client = mock()
+        rpc_call = RpcCall(client, 'cid')
+        expect(client.wait).args(rpc_call).side_effect(
+            lambda c: c._complete('reply', None))
+        assert_equals('reply', rpc_call.result())
+
+
+class RpcServerTest(Chai):
+
+    def setUp(self):
+        super(RpcServerTest, self).setUp()
+        self.ch = mock()
+        expect(self.ch.add_close_listener).any_args()
+        self.handler = mock()
+        self.server = RpcServer(self.ch, 'requests', self.handler,
+                                workers=2, prefetch=20)
+
+    def msg(self, tag, **properties):
+        msg = Message('request', **properties)
+        msg._delivery_info = {'delivery_tag': tag, 'consumer_tag': 'ctag'}
+        return msg
+
+    def test_init(self):
+        assert_equals(5, self.server._acker._size)
+        assert_equals(20, self.server._pool._max_pending)
+        assert_equals(self.server, self.server._pool._acker)
+        assert_equals(0, self.server.pending)
+
+    def test_start_and_stop(self):
+        expect(self.server._pool.start)
+        expect(self.ch.basic.qos).args(prefetch_count=20)
+        expect(self.ch.basic.consume).args(
+            'requests', self.server._consumer, no_ack=False)
+        self.server.start()
+
+        expect(self.ch.basic.cancel).args(consumer=self.server._consumer)
+        expect(self.server._pool.stop).args(None)
+        expect(self.server._acker.flush)
+        self.server.stop()
+
+        expect(self.server._pool.stop).args(3)
+        expect(self.server._acker.flush)
+        self.server.stop(3)
+
+    def test_flush_flushes_pool(self):
+        expect(self.server._pool.flush)
+        self.server.flush()
+
+    def test_handle_queues_reply(self):
+        msg = self.msg(3, reply_to='replies', correlation_id='cid')
+        expect(self.handler).args(msg).returns('result')
+        expect(self.server._pool.ack).args(3)
+        self.server._handle(msg)
+
+        reply, reply_to = self.server._replies[3]
+        assert_equals('result', reply.body)
+        assert_equals({'correlation_id': 'cid'}, reply.properties)
+        assert_equals('replies', reply_to)
+
+    def test_handle_keeps_reply_message_properties(self):
+        msg = self.msg(3, reply_to='replies', correlation_id='cid')
+        expect(self.handler).args(msg).returns(
+            Message('result', content_type='text/plain'))
+        expect(self.server._pool.ack).args(3)
+        self.server._handle(msg)
+
+        reply = self.server._replies[3][0]
+        assert_equals({'correlation_id': 'cid', 'content_type': 'text/plain'},
+                      reply.properties)
+
+    def test_handle_without_reply(self):
+        msg = self.msg(3)
+        expect(self.handler).args(msg).returns('result')
+        expect(self.server._pool.ack).args(3)
+        self.server._handle(msg)
+
+        msg = self.msg(4, reply_to='replies')
+        expect(self.handler).args(msg).returns(None)
+        expect(self.server._pool.ack).args(4)
+        self.server._handle(msg)
+        assert_equals(0, self.server.pending)
+
+    def test_handle_rejects_on_error(self):
+        msg = self.msg(3, reply_to='replies')
+        expect(self.handler).args(msg).raises(ValueError('fail'))
+        expect(self.ch.logger.exception).any_args()
+        expect(self.server._pool.reject).args(3, requeue=False)
+        self.server._handle(msg)
+        assert_equals(0, self.server.pending)
+
+    def test_ack_publishes_then_acks(self):
+        self.server._replies[1] = ('reply', 'replies')
+        expect(self.ch.basic.publish).args('reply', '', 'replies')
+        expect(self.server._acker.ack).args(1)
+        self.server.ack(1)
+        assert_equals(0, self.server.pending)
+
+        expect(self.server._acker.ack).args(2)
+        self.server.ack(2)
+
+    def test_reject(self):
+        expect(self.server._acker.reject).args(1, requeue=False)
+        self.server.reject(1)
+
+    def test_replies_sent_by_pool_flush(self):
+        self.server._replies[1] = ('reply', 'replies')
+        self.server._pool.ack(1)
+        self.server._pool.reject(2, requeue=False)
+        expect(self.ch.basic.publish).args('reply', '', 'replies')
+        expect(self.server._acker.ack).args(1)
+        expect(self.server._acker.reject).args(2, requeue=False)
+        self.server.flush()
+        assert_equals(0, self.server.pending)
+
+    def test_closed_cb(self):
+        self.server._replies[1] = ('reply', 'replies')
+        self.server._consuming = True
+        self.server._closed_cb(self.ch)
+        assert_equals(0, self.server.pending)
+        assert_false(self.server._consuming)
@@ -0,0 +1,188 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+import types
+
+from chai import Chai
+
+from haigha import supervisor
+from haigha.supervisor import ConsumerSupervisor, _WorkerConsumer, _run_worker
+
+
+class ConsumerSupervisorTest(Chai):
+
+    def test_init(self):
+        s = ConsumerSupervisor('q', 'consumer', workers=3, host='rabbit')
+        assert_equals('q', s._queue)
+        assert_equals('consumer', s._consumer)
+        assert_equals(3, s.workers)
+        assert_equals(0, s._prefetch_count)
+        assert_true(s._no_ack)
+        assert_equals({'host': 'rabbit'}, s._connection_args)
+        assert_equals([], s.processes)
+
+    def test_init_defaults_to_cpu_count(self):
+        expect(supervisor.multiprocessing.cpu_count).returns(7)
+        s = ConsumerSupervisor('q', 'consumer')
+        assert_equals(7, s.workers)
+
+    def test_worker_prefetch(self):
+        s = ConsumerSupervisor('q', 'consumer', workers=3, prefetch_count=10)
+        assert_equals([4, 3, 3], [s.worker_prefetch(i) for i in xrange(3)])
+
+        s = ConsumerSupervisor('q', 'consumer', workers=4, prefetch_count=4)
+        assert_equals([1, 1, 1, 1], [s.worker_prefetch(i) for i in xrange(4)])
+
+        s = ConsumerSupervisor('q', 'consumer', workers=4)
+        assert_equals(0, s.worker_prefetch(0))
+
+    def test_worker_prefetch_sums_to_prefetch_count(self):
+        for workers in xrange(1, 9):
+            for prefetch_count in xrange(workers, 40):
+                s = ConsumerSupervisor('q', 'consumer', workers=workers,
+                                       prefetch_count=prefetch_count)
+                shares = [s.worker_prefetch(i) for i in xrange(workers)]
+                assert_equals(prefetch_count, sum(shares))
+                assert_true(min(shares) >= 1)
+
+    def test_init_with_prefetch_count_below_workers(self):
+        assert_raises(ValueError, ConsumerSupervisor, 'q', 'consumer',
+                      workers=4, prefetch_count=2)
+
+    def test_stats_aggregates_worker_reports(self):
+        s = ConsumerSupervisor('q', 'consumer', workers=2)
+        s._stats_queue = mock()
+        expect(s._stats_queue.get_nowait).returns(
+            {'pid': 1, 'consumed': 3, 'errors': 1})
+        expect(s._stats_queue.get_nowait).returns(
+            {'pid': 2, 'consumed': 5, 'errors': 0})
+        expect(s._stats_queue.get_nowait).returns(
+            {'pid': 1, 'consumed': 4, 'errors': 1})
+        expect(s._stats_queue.get_nowait).raises(supervisor.Empty)
+
+        stats = s.stats
+        assert_equals(9, stats['consumed'])
+        assert_equals(1, stats['errors'])
+        assert_equals(set([1, 2]), set(stats['workers'].keys()))
+
+    def test_start(self):
+        s = ConsumerSupervisor('q', 'consumer', workers=2, prefetch_count=3,
+                               host='rabbit')
+        p1 = mock()
+        p2 = mock()
+        expect(supervisor.multiprocessing.Process).args(
+            target=_run_worker, name='haigha-consumer-0',
+            args=('q', 'consumer', 2, True, 1.0, 0.1, s._stop_event,
+                  s._stats_queue, supervisor.Connection,
+                  {'host': 'rabbit'})).returns(p1)
+        expect(p1.start)
+        expect(supervisor.multiprocessing.Process).args(
+            target=_run_worker, name='haigha-consumer-1',
+            args=('q', 'consumer', 1, True, 1.0, 0.1, s._stop_event,
+                  s._stats_queue, supervisor.Connection,
+                  {'host': 'rabbit'})).returns(p2)
+        expect(p2.start)
+
+        s.start()
+        assert_equals([p1, p2], s.processes)
+        assert_true(p1.daemon)
+
+    def test_stop_terminates_stragglers(self):
+        s = ConsumerSupervisor('q', 'consumer', workers=2)
+        p1 = mock()
+        p2 = mock()
+        s._processes = [p1, p2]
+        expect(s._stop_event.set)
+        expect(p1.is_alive).returns(False).times(2)
+        expect(p2.is_alive).returns(True).times(2)
+        expect(p2.terminate)
+        expect(p2.join)
+        expect(s.poll_stats)
+
+        s.stop(timeout=0)
+        assert_equals([], s.processes)
+
+    def test_stop_drains_stats_while_joining(self):
+        s = ConsumerSupervisor('q', 'consumer', workers=1)
+        proc = mock()
+        s._processes = [proc]
+        expect(s._stop_event.set)
+        expect(proc.is_alive).returns(True)
+        expect(proc.join).args(ConsumerSupervisor.JOIN_INTERVAL)
+        expect(s.poll_stats)
+        expect(proc.is_alive).returns(False).times(2)
+        expect(s.poll_stats)
+
+        s.stop()
+        assert_equals([], s.processes)
+
+
+class WorkerConsumerTest(Chai):
+
+    def test_call_with_no_ack(self):
+        consumer = mock()
+        w = _WorkerConsumer(consumer, True, mock())
+        expect(consumer).args('msg')
+        w('msg')
+        assert_equals(1, w.consumed)
+        assert_equals(0, w.errors)
+
+    def test_call_acks_on_success(self):
+        consumer = mock()
+        msg = mock()
+        ch = mock()
+        msg.delivery_info = {'channel': ch, 'delivery_tag': 42}
+        w = _WorkerConsumer(consumer, False, mock())
+        expect(consumer).args(msg)
+        expect(ch.basic.ack).args(42)
+        w(msg)
+        assert_equals(1, w.consumed)
+
+    def test_call_rejects_on_error(self):
+        consumer = mock()
+        logger = mock()
+        msg = mock()
+        ch = mock()
+        msg.delivery_info = {'channel': ch, 'delivery_tag': 42}
+        w = _WorkerConsumer(consumer, False, logger)
+        expect(consumer).args(msg).raises(ValueError('fail'))
+        expect(logger.exception).any_args()
+        expect(ch.basic.reject).args(42, requeue=True)
+        w(msg)
+        assert_equals(1, w.consumed)
+        assert_equals(1, w.errors)
+
+
+class RunWorkerTest(Chai):
+
+    def test_run_worker(self):
+        connection_class = mock()
+        connection = mock()
+        channel = mock()
+        stop_event = mock()
+        stats_queue = mock()
+
+        expect(connection_class).args(host='rabbit').returns(connection)
+        expect(connection.channel).returns(channel)
+        expect(channel.basic.qos).args(prefetch_count=5)
+        expect(channel.basic.consume).args('q', is_a(_WorkerConsumer),
+                                           no_ack=False)
+        connection.closed = False
+        connection.transport = 'transport'
+        connection.frames_read = 3
+        connection.frames_written = 2
+        expect(connection.timers.repeat).args(1.0, is_a(types.FunctionType))
+        expect(connection.timers.repeat).args(0.1, is_a(types.FunctionType))
+        expect(stop_event.is_set).returns(False)
+        expect(connection.read_frames)
+        expect(stop_event.is_set).returns(True)
+        expect(stats_queue.put).args(
+            {'pid': supervisor.os.getpid(), 'consumed': 0, 'errors': 0,
+             'frames_read': 3, 'frames_written': 2}).at_least_once()
+        expect(connection.close).args(disconnect=True)
+
+        _run_worker('q', 'consumer', 5, False, 1.0, 0.1, stop_event,
+                    stats_queue, connection_class, {'host': 'rabbit'})
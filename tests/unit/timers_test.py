@@ -0,0 +1,150 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+from chai import Chai
+
+from haigha.timers import TimerService
+
+
+class Clock(object):
+
+    def __init__(self, now=100.0):
+        self.now = now
+        self.reads = 0
+
+    def __call__(self):
+        self.reads += 1
+        return self.now
+
+
+class TimerServiceTest(Chai):
+
+    def setUp(self):
+        super(TimerServiceTest, self).setUp()
+        self.clock = Clock()
+        self.timers = TimerService(clock=self.clock)
+        self.fired = []
+
+    def fire(self, *args):
+        self.fired.append(args)
+
+    def test_init(self):
+        assert_equals(self.clock, self.timers.clock)
+        assert_equals(0, len(self.timers))
+
+    def test_run_when_empty_does_not_read_clock(self):
+        assert_equals(None, self.timers.run())
+        assert_equals(0, self.clock.reads)
+        assert_equals(None, self.timers.timeout())
+
+    def test_schedule(self):
+        timer = self.timers.schedule(5, self.fire, 'a')
+        assert_equals(105, timer.deadline)
+        assert_true(timer.active)
+        assert_equals(1, len(self.timers))
+
+        self.clock.now = 104
+        assert_equals(1, self.timers.run())
+        assert_equals([], self.fired)
+
+        self.clock.now = 105
+        assert_equals(None, self.timers.run())
+        assert_equals([('a',)], self.fired)
+        assert_equals(1, self.timers.fired)
+        assert_false(timer.active)
+        assert_equals(0, len(self.timers))
+
+    def test_run_fires_in_deadline_order(self):
+        self.timers.schedule(3, self.fire, 3)
+        self.timers.schedule(1, self.fire, 1)
+        self.timers.schedule(2, self.fire, 2)
+        self.timers.schedule(2, self.fire, 'tie')
+        self.clock.now = 110
+        self.timers.run()
+        assert_equals([(1,), (2,), ('tie',), (3,)], self.fired)
+
+    def test_run_reads_clock_once(self):
+        for i in xrange(10):
+            self.timers.schedule(i, self.fire)
+        self.clock.reads = 0
+        self.clock.now = 105
+        assert_equals(1, self.timers.run())
+        assert_equals(1, self.clock.reads)
+
+    def test_timeout_has_a_minimum(self):
+        self.timers.schedule(0, self.fire)
+        assert_equals(TimerService.RESOLUTION, self.timers.timeout(101))
+
+    def test_repeat(self):
+        timer = self.timers.repeat(2, self.fire)
+        self.clock.now = 102
+        assert_equals(2, self.timers.run())
+        assert_equals(104, timer.deadline)
+
+        # A late run isn't caught up
+        self.clock.now = 109
+        assert_equals(2, self.timers.run())
+        assert_equals(2, len(self.fired))
+        assert_equals(111, timer.deadline)
+        assert_true(timer.active)
+
+        timer.cancel()
+        assert_false(timer.active)
+        self.clock.now = 120
+        assert_equals(None, self.timers.run())
+        assert_equals(2, len(self.fired))
+
+    def test_repeat_cancelled_from_callback(self):
+        timers = []
+        timers.append(self.timers.repeat(1, lambda: timers[0].cancel()))
+        self.clock.now = 101
+        assert_equals(None, self.timers.run())
+        assert_equals(0, len(self.timers))
+
+    def test_cancel(self):
+        timer = self.timers.schedule(1, self.fire)
+        other = self.timers.schedule(2, self.fire)
+        timer.cancel()
+        timer.cancel()
+        assert_equals(1, len(self.timers))
+        assert_equals(2, self.timers.timeout())
+        assert_equals(1, len(self.timers._heap))
+
+        self.clock.now = 102
+        self.timers.run()
+        assert_equals(1, len(self.fired))
+        other.cancel()
+        assert_equals(0, len(self.timers))
+
+    def test_cancel_compacts_heap(self):
+        timers = [self.timers.schedule(i, self.fire)
+                  for i in xrange(TimerService.COMPACT_THRESHOLD * 2)]
+        for timer in timers[:TimerService.COMPACT_THRESHOLD]:
+            timer.cancel()
+        assert_equals(TimerService.COMPACT_THRESHOLD * 2,
+                      len(self.timers._heap))
+
+        timers[-1].cancel()
+        assert_equals(TimerService.COMPACT_THRESHOLD - 1,
+                      len(self.timers._heap))
+        assert_equals(TimerService.COMPACT_THRESHOLD - 1, len(self.timers))
+
+    def test_callback_exception_propagates(self):
+        def fail():
+            raise RuntimeError('boom')
+        self.timers.schedule(0, fail)
+        self.timers.schedule(0, self.fire)
+        assert_raises(RuntimeError, self.timers.run)
+        self.timers.run()
+        assert_equals([()], self.fired)
+
+    def test_clear(self):
+        timer = self.timers.schedule(1, self.fire)
+        self.timers.clear()
+        assert_false(timer.active)
+        assert_equals(0, len(self.timers))
+        timer.cancel()
+        assert_equals(0, len(self.timers))
@@ -0,0 +1,135 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+from chai import Chai
+
+from haigha.channel import Channel
+from haigha.classes.channel_class import ChannelClass
+from haigha.classes.exchange_class import ExchangeClass
+from haigha.classes.queue_class import QueueClass
+from haigha.exceptions import ChannelClosed
+from haigha.frames.method_frame import MethodFrame
+from haigha.reader import Reader
+from haigha.topology import Topology
+from haigha.writer import Writer
+
+
+class TopologyTest(Chai):
+
+    _CLASS_MAP = {
+        20: ChannelClass,
+        40: ExchangeClass,
+        50: QueueClass,
+    }
+
+    def setUp(self):
+        super(TopologyTest, self).setUp()
+        self.conn = mock()
+        self.conn.logger = mock()
+        self.conn.synchronous = True
+        self.conn.declaration_cache = None
+        self.ch = Channel(self.conn, 1, self._CLASS_MAP)
+        self.sent = []
+        expect(self.conn.send_frame).any_args().side_effect(
+            self.sent.append).at_least(0)
+
+    def declare_ok(self, queue, msgs, consumers):
+        args = Writer().write_shortstr(queue).write_long(msgs).\
+            write_long(consumers)
+        return MethodFrame(1, 50, 11, Reader(args.buffer()))
+
+    def test_add_declarations(self):
+        t = Topology(self.ch)
+        assert_equals(t, t.declare_exchange('ex', 'topic', durable=True,
+                                            nowait=True, cb='cb'))
+        t.declare_queue('q').bind_queue('q', 'ex', 'rk')
+        t.unbind_queue('q', 'ex').bind_exchange('ex2', 'ex')
+        assert_equals(5, len(t))
+        assert_equals([
+            ('exchange', 'declare', ('ex', 'topic'), {'durable': True}),
+            ('queue', 'declare', ('q',), {}),
+            ('queue', 'bind', ('q', 'ex', 'rk'), {}),
+            ('queue', 'unbind', ('q', 'ex', ''), {}),
+            ('exchange', 'bind', ('ex2', 'ex', ''), {}),
+        ], t._declarations)
+
+    def test_execute_pipelines_and_returns_results(self):
+        t = Topology(self.ch)
+        t.declare_exchange('ex', 'topic').declare_queue('q').\
+            bind_queue('q', 'ex', 'rk')
+        cb = mock()
+
+        def read_frames():
+            # Every declaration was sent before the first read
+            assert_equals(3, len(self.sent))
+            self.ch.dispatch(MethodFrame(1, 40, 11))
+            self.ch.dispatch(self.declare_ok('q', 5, 2))
+            self.ch.dispatch(MethodFrame(1, 50, 21))
+        expect(self.conn.read_frames).side_effect(read_frames)
+        expect(cb).args([None, ('q', 5, 2), None])
+
+        assert_equals([None, ('q', 5, 2), None], t.execute(cb=cb))
+        assert_true(t.done)
+        assert_false(self.ch._pipelining)
+        assert_equals(0, len(self.ch._pending_events))
+        assert_equals(set(), self.ch._close_listeners)
+
+    def test_execute_without_declarations(self):
+        cb = mock()
+        expect(cb).args([])
+        assert_equals([], Topology(self.ch).execute(cb=cb))
+
+    def test_execute_when_channel_closed(self):
+        self.ch._closed = True
+        assert_raises(ChannelClosed, Topology(self.ch).execute)
+
+    def test_execute_raises_when_channel_closes(self):
+        t = Topology(self.ch)
+        t.declare_queue('q', passive=True).bind_queue('q', 'ex')
+
+        def read_frames():
+            self.ch._close_info = {'reply_code': 404, 'reply_text': 'no q',
+                                   'class_id': 50, 'method_id': 10}
+            self.ch._closed = True
+        expect(self.conn.read_frames).side_effect(read_frames)
+
+        assert_raises(ChannelClosed, t.execute)
+        assert_false(t.done)
+
+    def test_execute_queues_behind_outstanding_synchronous_method(self):
+        self.conn.synchronous = False
+        self.ch._pending_events.append('other_cb')
+        t = Topology(self.ch).declare_exchange('ex', 'topic')
+
+        assert_equals(None, t.execute())
+        assert_equals([], self.sent)
+        assert_equals(3, len(self.ch._pending_events))
+
+    def test_execute_asynchronous(self):
+        self.conn.synchronous = False
+        t = Topology(self.ch).declare_exchange('ex', 'topic').\
+            declare_exchange('ex2', 'direct')
+        cb = mock()
+
+        assert_equals(None, t.execute(cb=cb))
+        assert_equals(2, len(self.sent))
+        assert_false(t.done)
+
+        self.ch.dispatch(MethodFrame(1, 40, 11))
+        expect(cb).args([None, None])
+        self.ch.dispatch(MethodFrame(1, 40, 11))
+        assert_true(t.done)
+
+    def test_closed_cb_calls_err_cb(self):
+        self.conn.synchronous = False
+        t = Topology(self.ch).declare_exchange('ex', 'topic')
+        err_cb = mock()
+        t.execute(err_cb=err_cb)
+
+        self.ch._close_info = {'reply_code': 406, 'reply_text': 'mismatch',
+                               'class_id': 40, 'method_id': 10}
+        expect(err_cb).args(is_a(ChannelClosed))
+        t._closed_cb(self.ch)
@@ -113,6 +113,23 @@ class EventTransportTest(Chai):
         expect(self.transport._sock.write).args('somedata')
         self.transport.write('somedata')
 
+    def test_write_updates_pending_bytes(self):
+        transport = EventTransport(self.connection, high_watermark=10)
+        transport._sock = mock()
+        transport._sock._write_buf = ['some', 'data']
+        expect(transport._sock.write).args('somedata')
+        transport.write('somedata')
+        assert_equals(8, transport.pending_bytes)
+
+    def test_sock_read_cb_updates_pending_bytes(self):
+        transport = EventTransport(self.connection, high_watermark=10)
+        transport._sock = mock()
+        transport._sock._write_buf = ['somedata', 'more']
+        expect(self.connection.transport_writable_changed).args(False)
+        expect(self.connection.read_frames)
+        transport._sock_read_cb(transport._sock)
+        assert_false(transport.writable)
+
     def test_write_when_no_sock(self):
         self.transport.write('somedata')
 
@@ -5,6 +5,7 @@ https://github.com/agoragames/haigha/blob/master/LICENSE.txt
 '''
 
 from chai import Chai
+from collections import deque
 import errno
 import unittest
 
@@ -14,6 +15,7 @@ try:
     from gevent import socket
     from gevent.pool import Pool
 
+    from haigha.exceptions import ConnectionClosed
     from haigha.transports import gevent_transport
     from haigha.transports.gevent_transport import *
 except ImportError:
@@ -109,6 +111,217 @@ class GeventTransportTest(Chai):
 
         assert_raises(Exception, self.transport.write, 'datas')
 
+    def test_write_tracks_pending_bytes(self):
+        transport = GeventTransport(self.connection, high_watermark=5)
+        transport._write_lock = mock()
+
+        expect(self.connection.transport_writable_changed).args(False)
+        expect(transport._write_lock.acquire)
+        with expect(mock(gevent_transport, 'super')).args(is_arg(GeventTransport), GeventTransport).returns(mock()) as parent:
+            expect(parent.write).args('datas').side_effect(
+                lambda data: assert_equals(5, transport.pending_bytes))
+        expect(transport._write_lock.release)
+        expect(self.connection.transport_writable_changed).args(True)
+
+        transport.write('datas')
+        assert_equals(0, transport.pending_bytes)
+        assert_true(transport.writable)
+
+
+@unittest.skipIf(gevent is None, 'skipping gevent tests')
+class GeventTransportWriterGreenletTest(Chai):
+
+    def setUp(self):
+        super(GeventTransportWriterGreenletTest, self).setUp()
+
+        self.connection = mock()
+        self.connection.debug = False
+        self.transport = GeventTransport(
+            self.connection, writer_greenlet=True, write_coalesce_size=8)
+        self.transport._host = 'server:1234'
+        self.transport._sock = mock()
+
+    def test_init(self):
+        assert_true(self.transport._use_writer_greenlet)
+        assert_equals(8, self.transport._write_coalesce_size)
+        assert_equals(deque(), self.transport._write_queue)
+        assert_equals(None, self.transport._writer)
+
+        transport = GeventTransport(self.connection)
+        assert_false(transport._use_writer_greenlet)
+        assert_equals(GeventTransport.WRITE_COALESCE_SIZE,
+                      transport._write_coalesce_size)
+
+    def test_connect_spawns_writer(self):
+        with expect(mock(gevent_transport, 'super')).args(is_arg(GeventTransport), GeventTransport).returns(mock()) as parent:
+            expect(parent.connect).args(
+                ('host', 'port'), klass=is_arg(socket.socket))
+        mock(gevent_transport, 'gevent')
+        expect(gevent_transport.gevent.spawn).args(
+            self.transport._write_loop).returns('writer')
+
+        self.transport.connect(('host', 'port'))
+        assert_equals('writer', self.transport._writer)
+
+    def test_write_queues_data(self):
+        self.transport._writer = 'writer'
+        self.transport.write('datas')
+        self.transport.write('more')
+        assert_equals(deque(['datas', 'more']), self.transport._write_queue)
+        assert_equals(9, self.transport.pending_bytes)
+        assert_true(self.transport._write_event.is_set())
+
+    def test_write_loop_coalesces_writes(self):
+        self.transport._write_queue.extend(['abc', 'def', 'ghi', 'jk'])
+        self.transport._pending_bytes = 11
+        self.transport._write_event.set()
+        self.transport._closing = True
+
+        expect(self.transport._sock.sendall).args(bytearray('abcdefghi'))
+        expect(self.transport._sock.sendall).args(bytearray('jk'))
+
+        self.transport._write_loop()
+        assert_equals(0, self.transport.pending_bytes)
+        assert_equals(deque(), self.transport._write_queue)
+
+    def test_write_loop_when_sendall_fails(self):
+        self.transport._writer = 'writer'
+        self.transport._write_queue.extend(['abc', 'def'])
+        self.transport._pending_bytes = 6
+        self.transport._write_event.set()
+
+        expect(self.transport._sock.sendall).args(bytearray('abcdef')).raises(
+            EnvironmentError(errno.EPIPE, 'broken'))
+        expect(self.connection.logger.exception).args(
+            'error writing to server:1234')
+        expect(self.connection.transport_closed).args(
+            msg='error writing to server:1234')
+
+        self.transport._write_loop()
+        assert_equals(None, self.transport._writer)
+        assert_equals(0, self.transport.pending_bytes)
+
+    def test_disconnect_flushes_writer(self):
+        self.transport._writer = gevent.spawn(self.transport._write_loop)
+        self.transport.write('datas')
+
+        expect(self.transport._sock.sendall).args(bytearray('datas'))
+        expect(self.transport._sock.close)
+
+        self.transport.disconnect()
+        assert_true(self.transport._closing)
+        assert_equals(None, self.transport._writer)
+        assert_equals(None, self.transport._sock)
+
+
+@unittest.skipIf(gevent is None, 'skipping gevent tests')
+class GeventTransportReaderGreenletTest(Chai):
+
+    def setUp(self):
+        super(GeventTransportReaderGreenletTest, self).setUp()
+
+        self.connection = mock()
+        self.transport = GeventTransport(self.connection, reader_greenlet=True)
+        self.transport._host = 'server:1234'
+        self.transport._read_lock = mock()
+
+    def test_connect_spawns_reader(self):
+        with expect(mock(gevent_transport, 'super')).args(is_arg(GeventTransport), GeventTransport).returns(mock()) as parent:
+            expect(parent.connect).args(
+                ('host', 'port'), klass=is_arg(socket.socket))
+        mock(gevent_transport, 'gevent')
+        expect(gevent_transport.gevent.spawn).args(
+            self.transport._read_loop).returns('reader')
+
+        self.transport.connect(('host', 'port'))
+        assert_equals('reader', self.transport._reader)
+
+    def test_read_in_reader_greenlet(self):
+        self.transport._reader = 'reader'
+        mock(gevent_transport, 'gevent')
+        expect(gevent_transport.gevent.getcurrent).returns('reader')
+        with expect(mock(gevent_transport, 'super')).args(is_arg(GeventTransport), GeventTransport).returns(mock()) as parent:
+            expect(parent.read).args(timeout=3).returns('somedata')
+
+        assert_equals('somedata', self.transport.read(3))
+
+    def test_read_in_other_greenlet_waits_for_reader(self):
+        self.transport._reader = 'reader'
+        self.transport._read_wait = mock()
+        mock(gevent_transport, 'gevent')
+        expect(gevent_transport.gevent.getcurrent).returns('other')
+        expect(self.transport._read_wait.wait).args(3)
+
+        assert_equals(None, self.transport.read(3))
+
+    def test_buffer_skips_lock(self):
+        self.transport._reader = 'reader'
+        with expect(mock(gevent_transport, 'super')).args(is_arg(GeventTransport), GeventTransport).returns(mock()) as parent:
+            expect(parent.buffer).args('datas')
+
+        self.transport.buffer('datas')
+
+    def test_read_loop(self):
+        self.transport._reader = 'reader'
+        self.connection.transport = self.transport
+        self.transport._read_wait = mock()
+
+        expect(self.connection.read_frames)
+        expect(self.transport._read_wait.set)
+        expect(self.transport._read_wait.clear)
+        expect(self.connection.read_frames).side_effect(
+            lambda: setattr(self.connection, 'transport', None))
+        expect(self.transport._read_wait.set).times(2)
+        expect(self.transport._read_wait.clear).times(2)
+
+        self.transport._read_loop()
+        assert_equals(None, self.transport._reader)
+
+    def test_read_loop_when_connection_closed(self):
+        self.transport._reader = 'reader'
+        self.connection.transport = self.transport
+
+        expect(self.connection.read_frames).raises(ConnectionClosed())
+
+        self.transport._read_loop()
+        assert_equals(None, self.transport._reader)
+
+    def test_disconnect_kills_reader(self):
+        reader = mock()
+        self.transport._reader = reader
+        self.transport._sock = mock()
+
+        expect(reader.kill)
+        expect(self.transport._sock.close)
+
+        self.transport.disconnect()
+        assert_equals(None, self.transport._reader)
+
+    def test_reader_processes_frames(self):
+        a, b = socket.socketpair()
+        self.transport._sock = a
+        self.connection.transport = self.transport
+        self.connection.debug = False
+        reader = self.transport._reader = gevent.spawn(
+            self.transport._read_loop)
+
+        def read_frames():
+            data = self.transport.read()
+            if data == 'stop':
+                self.connection.transport = None
+
+        expect(self.connection.read_frames).side_effect(
+            read_frames).at_least_once()
+
+        b.sendall('stop')
+        assert_equals(None, self.transport.read(1))
+        reader.join(1)
+        assert_true(reader.ready())
+        assert_equals(None, self.transport._reader)
+        a.close()
+        b.close()
+
+
 @unittest.skipIf(gevent is None, 'skipping gevent tests')
 class GeventPoolTransportTest(Chai):
 
@@ -135,3 +348,15 @@ class GeventPoolTransportTest(Chai):
         expect(self.transport._pool.spawn).args(chs[1].process_frames)
 
         self.transport.process_channels(chs)
+
+    def test_process_channels_wakes_readers(self):
+        chs = [mock()]
+        self.transport._pool = mock()
+        self.transport._reader = 'reader'
+        greenlet = mock()
+
+        expect(self.transport._pool.spawn).args(
+            chs[0].process_frames).returns(greenlet)
+        expect(greenlet.link).args(func(callable))
+
+        self.transport.process_channels(chs)
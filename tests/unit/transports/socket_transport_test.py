@@ -7,7 +7,9 @@ https://github.com/agoragames/haigha/blob/master/LICENSE.txt
 from chai import Chai
 import errno
 import socket
+import threading
 
+from haigha.frames.heartbeat_frame import HeartbeatFrame
 from haigha.transports import socket_transport
 from haigha.transports.socket_transport import *
 
@@ -24,6 +26,21 @@ class SocketTransportTest(Chai):
     def test_init(self):
         assert_equals(bytearray(), self.transport._buffer)
         assert_true(self.transport._synchronous)
+        assert_equals(SocketTransport.READ_SIZE_MIN,
+                      self.transport._read_size_min)
+        assert_equals(SocketTransport.READ_SIZE_MAX,
+                      self.transport._read_size_max)
+        assert_equals(None, self.transport.read_size)
+        assert_equals(None, self.transport._timeout)
+        assert_false(self.transport._heartbeat_thread)
+        assert_equals(None, self.transport._send_lock)
+        assert_equals(None, self.transport._heartbeat_stop)
+
+    def test_init_with_heartbeat_thread(self):
+        transport = SocketTransport(self.connection, heartbeat_thread=True)
+        assert_true(transport._heartbeat_thread)
+        assert_true(transport._send_lock.acquire(False))
+        transport._send_lock.release()
 
     def _set_up_connect_test(self, sock):
         """Set up common options and expects for connect() related tests."""
@@ -216,36 +233,191 @@ class SocketTransportTest(Chai):
             socket.error, self.transport.connect, ('host', 5309), klass=klass,
         )
 
+    def _recv_into(self, data):
+        """Return a recv_into side effect which fills the buffer with data."""
+        def recv_into(buf, nbytes):
+            assert_true(isinstance(buf, memoryview))
+            assert_equals(len(buf), nbytes)
+            buf[:len(data)] = data
+            return len(data)
+        return recv_into
+
     def test_read(self):
         self.transport._sock = mock()
         self.transport.connection.debug = False
 
-        expect(self.transport._sock.settimeout).args(None)
         expect(self.transport._sock.getsockopt).args(
-            socket.SOL_SOCKET, socket.SO_RCVBUF).returns(4095)
-        expect(self.transport._sock.recv).args(4095).returns('buffereddata')
+            socket.SOL_SOCKET, socket.SO_RCVBUF).returns(8192)
+        expect(self.transport._sock.recv_into).any_args().side_effect(
+            self._recv_into('buffereddata'))
 
+        expect(mock(socket_transport, 'monotonic')).returns(42)
         assert_equals('buffereddata', self.transport.read())
+        assert_equals(42, self.transport.last_read)
+        assert_equals(8192, self.transport.read_size)
+        assert_equals({'recv': 1, 'settimeout': 0, 'getsockopt': 1},
+                      self.transport.syscalls)
+
+    def test_read_only_queries_rcvbuf_and_timeout_once(self):
+        self.transport._sock = mock()
+        self.transport.connection.debug = False
+
+        expect(self.transport._sock.settimeout).args(2.048)
+        expect(self.transport._sock.getsockopt).args(
+            socket.SOL_SOCKET, socket.SO_RCVBUF).returns(8192)
+        expect(self.transport._sock.recv_into).any_args().side_effect(
+            self._recv_into('data')).times(2)
+
+        assert_equals('data', self.transport.read(3))
+        assert_equals('data', self.transport.read(3))
+        assert_equals({'recv': 2, 'settimeout': 1, 'getsockopt': 1},
+                      self.transport.syscalls)
+
+    def test_read_rounds_timeout_down(self):
+        self.transport._sock = mock()
+        self.transport.connection.debug = False
+        self.transport._read_size = 4096
+
+        expect(self.transport._sock.settimeout).args(8.192)
+        expect(self.transport._sock.settimeout).args(0.001)
+        expect(self.transport._sock.recv_into).any_args().side_effect(
+            self._recv_into('data')).times(4)
+
+        self.transport.read(9.5)
+        self.transport.read(9.0)
+        self.transport.read(8.2)
+        self.transport.read(0.0005)
+        assert_equals(2, self.transport.syscalls['settimeout'])
+
+    def test_fileno(self):
+        assert_equals(None, self.transport.fileno())
+        self.transport._sock = mock()
+        expect(self.transport._sock.fileno).returns(7)
+        assert_equals(7, self.transport.fileno())
+
+    def test_read_receives_into_returned_buffer(self):
+        self.transport._sock = mock()
+        self.transport.connection.debug = False
+        expect(self.transport._sock.getsockopt).any_args().returns(8192)
+        expect(self.transport._sock.recv_into).any_args().side_effect(
+            self._recv_into('data')).times(2)
+
+        first = self.transport.read()
+        second = self.transport.read()
+        assert_equals('data', first)
+        assert_equals('data', second)
+        assert_false(first is second)
+
+    def test_read_grows_buffered_data_in_place(self):
+        self.transport._sock = mock()
+        self.transport.connection.debug = False
+        buffered = bytearray('buffered')
+        self.transport._buffer = buffered
+
+        expect(self.transport._sock.getsockopt).any_args().returns(4096)
+        expect(self.transport._sock.recv_into).any_args().side_effect(
+            self._recv_into('data'))
+
+        data = self.transport.read()
+        assert_true(data is buffered)
+        assert_equals('buffereddata', data)
+
+    def test_read_size_clamped(self):
+        self.transport._sock = mock()
+        self.transport.connection.debug = False
+
+        expect(self.transport._sock.getsockopt).any_args().returns(10)
+        expect(self.transport._sock.recv_into).any_args().side_effect(
+            self._recv_into('data'))
+
+        self.transport.read()
+        assert_equals(SocketTransport.READ_SIZE_MIN, self.transport.read_size)
+
+        transport = SocketTransport(self.connection, read_size_max=5000)
+        transport._sock = mock()
+        expect(transport._sock.getsockopt).any_args().returns(1 << 20)
+        expect(transport._sock.recv_into).any_args().side_effect(
+            self._recv_into('data'))
+
+        transport.read()
+        assert_equals(5000, transport.read_size)
+
+    def test_read_size_grows_when_buffer_filled(self):
+        self.transport._sock = mock()
+        self.transport.connection.debug = False
+
+        expect(self.transport._sock.getsockopt).any_args().returns(4096)
+        expect(self.transport._sock.recv_into).any_args().side_effect(
+            self._recv_into('x' * 4096))
+
+        assert_equals(4096, len(self.transport.read()))
+        assert_equals(8192, self.transport.read_size)
+
+    def test_read_size_shrinks_after_small_reads(self):
+        self.transport._sock = mock()
+        self.transport.connection.debug = False
+        self.transport._set_read_size(16384)
+
+        expect(self.transport._sock.recv_into).any_args().side_effect(
+            self._recv_into('data')).times(SocketTransport.SMALL_READ_LIMIT)
+
+        for _ in xrange(SocketTransport.SMALL_READ_LIMIT - 1):
+            self.transport.read()
+        assert_equals(16384, self.transport.read_size)
+        self.transport.read()
+        assert_equals(8192, self.transport.read_size)
 
     def test_read_when_data_buffered(self):
         self.transport._sock = mock()
         self.transport.connection.debug = False
         self.transport._buffer = bytearray('buffered')
 
-        expect(self.transport._sock.settimeout).args(3)
-        expect(self.transport._sock.getsockopt).any_args().returns(4095)
-        expect(self.transport._sock.recv).args(4095).returns('data')
+        expect(self.transport._sock.settimeout).args(2.048)
+        expect(self.transport._sock.getsockopt).any_args().returns(4096)
+        expect(self.transport._sock.recv_into).any_args().side_effect(
+            self._recv_into('data'))
 
         assert_equals('buffereddata', self.transport.read(3))
         assert_equals(bytearray(), self.transport._buffer)
 
+    def test_read_receives_after_buffered_data(self):
+        self.transport._sock = mock()
+        self.transport.connection.debug = False
+        self.transport._buffer = bytearray('buffered')
+
+        def recv_into(buf, nbytes):
+            assert_equals(4096, nbytes)
+            assert_equals(4096, len(buf))
+            buf[:4] = 'data'
+            return 4
+
+        expect(self.transport._sock.getsockopt).any_args().returns(4096)
+        expect(self.transport._sock.recv_into).any_args().side_effect(
+            recv_into)
+
+        data = self.transport.read()
+        assert_true(isinstance(data, bytearray))
+        assert_equals('buffereddata', data)
+
+    def test_read_keeps_buffered_data_on_timeout(self):
+        self.transport._sock = mock()
+        self.transport.connection.debug = False
+        self.transport._buffer = bytearray('buffered')
+
+        expect(self.transport._sock.getsockopt).any_args().returns(4096)
+        expect(self.transport._sock.recv_into).any_args().raises(
+            socket.timeout())
+
+        assert_equals(None, self.transport.read())
+        assert_equals(bytearray('buffered'), self.transport._buffer)
+
     def test_read_when_debugging(self):
         self.transport._sock = mock()
         self.transport.connection.debug = 2
 
-        expect(self.transport._sock.settimeout).args(None)
-        expect(self.transport._sock.getsockopt).any_args().returns(4095)
-        expect(self.transport._sock.recv).args(4095).returns('buffereddata')
+        expect(self.transport._sock.getsockopt).any_args().returns(4096)
+        expect(self.transport._sock.recv_into).any_args().side_effect(
+            self._recv_into('buffereddata'))
         expect(self.transport.connection.logger.debug).args(
             'read 12 bytes from server:1234')
 
@@ -255,9 +427,8 @@ class SocketTransportTest(Chai):
         self.transport._sock = mock()
         self.transport.connection.debug = 2
 
-        expect(self.transport._sock.settimeout).args(None)
-        expect(self.transport._sock.getsockopt).any_args().returns(4095)
-        expect(self.transport._sock.recv).args(4095).returns('')
+        expect(self.transport._sock.getsockopt).any_args().returns(4096)
+        expect(self.transport._sock.recv_into).any_args().returns(0)
         expect(self.transport.connection.transport_closed).args(
             msg='error reading from server:1234')
 
@@ -266,21 +437,22 @@ class SocketTransportTest(Chai):
     def test_read_when_socket_timeout(self):
         self.transport._sock = mock()
         self.transport.connection.debug = 2
+        self.transport._set_read_size(8192)
 
-        expect(self.transport._sock.settimeout).args(42)
-        expect(self.transport._sock.getsockopt).any_args().returns(4095)
-        expect(self.transport._sock.recv).args(4095).raises(
+        expect(self.transport._sock.settimeout).args(32.768)
+        expect(self.transport._sock.recv_into).any_args().raises(
             socket.timeout('not now'))
 
         assert_equals(None, self.transport.read(42))
+        assert_equals(4096, self.transport.read_size)
 
     def test_read_when_raises_eagain(self):
         self.transport._sock = mock()
         self.transport.connection.debug = 2
 
-        expect(self.transport._sock.settimeout).args(42)
-        expect(self.transport._sock.getsockopt).any_args().returns(4095)
-        expect(self.transport._sock.recv).args(4095).raises(
+        expect(self.transport._sock.settimeout).args(32.768)
+        expect(self.transport._sock.getsockopt).any_args().returns(4096)
+        expect(self.transport._sock.recv_into).any_args().raises(
             EnvironmentError(errno.EAGAIN, 'tryagainlater'))
 
         assert_equals(None, self.transport.read(42))
@@ -289,9 +461,9 @@ class SocketTransportTest(Chai):
         self.transport._sock = mock()
         self.transport.connection.debug = 2
 
-        expect(self.transport._sock.settimeout).args(42)
-        expect(self.transport._sock.getsockopt).any_args().returns(4095)
-        expect(self.transport._sock.recv).args(4095).raises(
+        expect(self.transport._sock.settimeout).args(32.768)
+        expect(self.transport._sock.getsockopt).any_args().returns(4096)
+        expect(self.transport._sock.recv_into).any_args().raises(
             socket.timeout())
 
         assert_equals(None, self.transport.read(42))
@@ -300,9 +472,9 @@ class SocketTransportTest(Chai):
         self.transport._sock = mock()
         self.transport.connection.debug = 2
 
-        expect(self.transport._sock.settimeout).args(42)
-        expect(self.transport._sock.getsockopt).any_args().returns(4095)
-        expect(self.transport._sock.recv).args(4095).raises(
+        expect(self.transport._sock.settimeout).args(32.768)
+        expect(self.transport._sock.getsockopt).any_args().returns(4096)
+        expect(self.transport._sock.recv_into).any_args().raises(
             EnvironmentError(errno.EBADF, 'baddog'))
         expect(self.transport.connection.logger.exception).args(
             'error reading from server:1234')
@@ -336,6 +508,18 @@ class SocketTransportTest(Chai):
         self.transport.connection.debug = False
 
         expect(self.transport._sock.sendall).args('somedata')
+        expect(mock(socket_transport, 'monotonic')).returns(42)
+        self.transport.write('somedata')
+        assert_equals(42, self.transport.last_write)
+
+    def test_write_with_send_lock(self):
+        self.transport._sock = mock()
+        self.transport._send_lock = mock()
+        self.transport.connection.debug = False
+
+        expect(self.transport._send_lock.__enter__)
+        expect(self.transport._sock.sendall).args('somedata')
+        expect(self.transport._send_lock.__exit__).args(None, None, None)
         self.transport.write('somedata')
 
     def test_write_when_sendall_fails(self):
@@ -376,6 +560,120 @@ class SocketTransportTest(Chai):
         expect(self.transport._sock.close)
         self.transport.disconnect()
         assert_equals(None, self.transport._sock)
+        assert_equals(None, self.transport.read_size)
 
     def test_disconnect_when_no_sock(self):
         self.transport.disconnect()
+
+    def test_disconnect_stops_heartbeat(self):
+        self.transport._sock = mock()
+        stop = self.transport._heartbeat_stop = mock()
+        expect(stop.set)
+        expect(self.transport._sock.close)
+        self.transport.disconnect()
+        assert_equals(None, self.transport._heartbeat_stop)
+
+    def test_start_heartbeat_when_not_enabled(self):
+        self.transport._sock = mock()
+        self.transport.start_heartbeat(10)
+        assert_equals(None, self.transport._heartbeat_stop)
+
+    def test_start_heartbeat_when_no_sock(self):
+        self.transport._heartbeat_thread = True
+        self.transport.start_heartbeat(10)
+        assert_equals(None, self.transport._heartbeat_stop)
+
+    def test_start_heartbeat(self):
+        self.transport._heartbeat_thread = True
+        self.transport._sock = mock()
+        old_stop = self.transport._heartbeat_stop = mock()
+        stop = mock()
+        thread = mock()
+
+        expect(old_stop.set)
+        mock(socket_transport, 'threading')
+        expect(socket_transport.threading.Event).returns(stop)
+        expect(socket_transport.threading.Thread).args(
+            target=self.transport._heartbeat_loop,
+            args=(self.transport._sock, 10, stop),
+            name='haigha heartbeat server:1234').returns(thread)
+        expect(thread.start)
+
+        self.transport.start_heartbeat(10)
+        assert_equals(stop, self.transport._heartbeat_stop)
+        assert_true(thread.daemon)
+
+    def _set_up_heartbeat_loop(self):
+        self.transport._send_lock = threading.Lock()
+        self.transport._last_read = 100
+        self.transport._last_write = 100
+        sock = mock()
+        stop = mock()
+        frame = bytearray()
+        HeartbeatFrame(0).write_frame(frame)
+        return sock, stop, frame
+
+    def test_heartbeat_loop_sends_when_idle(self):
+        sock, stop, frame = self._set_up_heartbeat_loop()
+        now = mock(socket_transport, 'monotonic')
+
+        expect(stop.is_set).returns(False)
+        expect(now).returns(109)
+        expect(stop.is_set).returns(False)
+        expect(sock.sendall).args(frame)
+        expect(now).returns(109.5)
+        expect(stop.wait).args(5.0)
+        expect(stop.is_set).returns(True)
+
+        self.transport._heartbeat_loop(sock, 10, stop)
+        assert_equals(109.5, self.transport.last_write)
+
+    def test_heartbeat_loop_waits_while_active(self):
+        sock, stop, frame = self._set_up_heartbeat_loop()
+
+        expect(stop.is_set).returns(False)
+        expect(mock(socket_transport, 'monotonic')).returns(107)
+        expect(stop.wait).args(2.0)
+        expect(stop.is_set).returns(True)
+
+        self.transport._heartbeat_loop(sock, 10, stop)
+        assert_equals(100, self.transport.last_write)
+
+    def test_heartbeat_loop_exits_when_send_fails(self):
+        sock, stop, frame = self._set_up_heartbeat_loop()
+
+        expect(stop.is_set).returns(False)
+        expect(mock(socket_transport, 'monotonic')).returns(109)
+        expect(stop.is_set).returns(False)
+        expect(sock.sendall).args(frame).raises(
+            EnvironmentError(errno.EPIPE, 'broken pipe'))
+
+        self.transport._heartbeat_loop(sock, 10, stop)
+
+    def test_heartbeat_loop_closes_when_nothing_read(self):
+        sock, stop, frame = self._set_up_heartbeat_loop()
+        self.transport._last_write = 115
+
+        expect(stop.is_set).returns(False)
+        expect(mock(socket_transport, 'monotonic')).returns(120)
+        expect(mock(socket_transport, 'select').select).args(
+            [sock], [], [], 0).returns(([], [], []))
+        expect(self.connection.logger.warning).args(
+            'Heartbeats not received from %s for %d seconds',
+            'server:1234', 20)
+        expect(sock.shutdown).args(socket.SHUT_RDWR)
+
+        self.transport._heartbeat_loop(sock, 10, stop)
+
+    def test_heartbeat_loop_waits_when_data_pending(self):
+        sock, stop, frame = self._set_up_heartbeat_loop()
+        self.transport._last_write = 115
+
+        expect(stop.is_set).returns(False)
+        expect(mock(socket_transport, 'monotonic')).returns(120)
+        expect(mock(socket_transport, 'select').select).args(
+            [sock], [], [], 0).returns(([sock], [], []))
+        expect(stop.wait).args(4.0)
+        expect(stop.is_set).returns(True)
+
+        self.transport._heartbeat_loop(sock, 10, stop)
@@ -6,6 +6,7 @@ https://github.com/agoragames/haigha/blob/master/LICENSE.txt
 
 from chai import Chai
 
+from haigha.transports import transport
 from haigha.transports.transport import Transport
 
 
@@ -15,6 +16,52 @@ class TransportTest(Chai):
         t = Transport('conn')
         assert_equals('conn', t._connection)
         assert_equals('conn', t.connection)
+        assert_true(t.writable)
+        assert_equals(0, t.pending_bytes)
+        assert_equals(None, t._high_watermark)
+
+    def test_init_sets_last_read_and_write(self):
+        expect(mock(transport, 'monotonic')).returns(42)
+        t = Transport('conn')
+        assert_equals(42, t.last_read)
+        assert_equals(42, t.last_write)
+
+    def test_init_with_watermarks(self):
+        t = Transport('conn', high_watermark=100)
+        assert_equals(100, t._high_watermark)
+        assert_equals(50, t._low_watermark)
+
+        t = Transport('conn', high_watermark=100, low_watermark=10)
+        assert_equals(10, t._low_watermark)
+
+    def test_set_pending_bytes_without_watermarks(self):
+        t = Transport(mock())
+        t._set_pending_bytes(1 << 30)
+        assert_equals(1 << 30, t.pending_bytes)
+        assert_true(t.writable)
+
+    def test_set_pending_bytes_crosses_watermarks(self):
+        conn = mock()
+        t = Transport(conn, high_watermark=100, low_watermark=10)
+
+        t._set_pending_bytes(99)
+        assert_true(t.writable)
+
+        expect(conn.transport_writable_changed).args(False)
+        t._set_pending_bytes(100)
+        assert_false(t.writable)
+
+        t._set_pending_bytes(200)
+        t._set_pending_bytes(11)
+        assert_false(t.writable)
+
+        expect(conn.transport_writable_changed).args(True)
+        t._set_pending_bytes(10)
+        assert_true(t.writable)
+
+    def test_start_heartbeat(self):
+        t = Transport('conn')
+        assert_equals(None, t.start_heartbeat(10))
 
     def test_process_channels(self):
         t = Transport('conn')
@@ -0,0 +1,165 @@
+'''
+Copyright (c) 2011-2017, Agora Games, LLC All rights reserved.
+
+https://github.com/agoragames/haigha/blob/master/LICENSE.txt
+'''
+
+import Queue
+import time
+
+from chai import Chai
+
+from haigha.timers import TimerService
+from haigha.worker_pool import WorkerPool
+
+
+class WorkerPoolTest(Chai):
+
+    def setUp(self):
+        super(WorkerPoolTest, self).setUp()
+        self.ch = mock()
+        self.ch.connection.timers = TimerService()
+        expect(self.ch.add_close_listener).any_args()
+
+    def msg(self, tag, consumer_tag='ctag'):
+        msg = mock()
+        msg.delivery_info = {'delivery_tag': tag, 'consumer_tag': consumer_tag}
+        return msg
+
+    def test_init(self):
+        pool = WorkerPool(self.ch)
+        assert_equals(4, pool._workers)
+        assert_equals(100, pool._max_pending)
+        assert_false(pool._ordered)
+        assert_equals(self.ch.basic, pool._acker)
+        assert_equals(0, pool.pending)
+
+    def test_start_and_stop_threads(self):
+        consumer = mock()
+        pool = WorkerPool(self.ch, workers=2, auto_ack=True)
+        pool.start()
+        assert_equals(1, len(pool._queues))
+        assert_equals(2, len(pool._threads))
+
+        msg = self.msg(1)
+        expect(consumer).args(msg)
+        expect(self.ch.basic.ack).args(1)
+        pool.consumer(consumer)(msg)
+        pool.stop()
+        assert_equals([], pool._threads)
+
+    def test_start_ordered_uses_queue_per_worker(self):
+        pool = WorkerPool(self.ch, workers=3, max_pending=10, ordered=True)
+        pool.start()
+        assert_equals(3, len(pool._queues))
+        assert_equals(3, pool._queues[0].maxsize)
+        pool.stop()
+
+    def test_queue_for_ordered_uses_key(self):
+        pool = WorkerPool(self.ch, workers=2, ordered=True,
+                          key=lambda msg: msg.delivery_info['delivery_tag'])
+        pool._queues = ['q0', 'q1']
+        assert_equals('q0', pool._queue_for(self.msg(4)))
+        assert_equals('q1', pool._queue_for(self.msg(5)))
+
+    def test_queue_for_default_key_is_consumer_tag(self):
+        pool = WorkerPool(self.ch, workers=2, ordered=True)
+        pool._queues = ['q0', 'q1']
+        q = pool._queue_for(self.msg(1, 'a'))
+        assert_equals(q, pool._queue_for(self.msg(2, 'a')))
+
+    def test_consumer_flushes_and_queues(self):
+        pool = WorkerPool(self.ch)
+        pool._queues = [Queue.Queue()]
+        pool.ack(3)
+        expect(self.ch.basic.ack).args(3)
+
+        pool.consumer('consumer')('msg')
+        assert_equals(('consumer', 'msg'), pool._queues[0].get_nowait())
+        assert_equals(1, pool._in_flight)
+        assert_true(pool._flush_timer.active)
+
+    def test_work_runs_consumers_in_order(self):
+        pool = WorkerPool(self.ch)
+        seen = []
+        queue = Queue.Queue()
+        queue.put((seen.append, 'a'))
+        queue.put((seen.append, 'b'))
+        queue.put(None)
+        pool._work(queue)
+        assert_equals(['a', 'b'], seen)
+        assert_equals(0, len(pool._completions))
+        assert_equals(2, len(pool._finished))
+
+    def test_work_auto_acks_and_rejects(self):
+        pool = WorkerPool(self.ch, auto_ack=True)
+        consumer = mock()
+        ok = self.msg(1)
+        bad = self.msg(2)
+        expect(consumer).args(ok)
+        expect(consumer).args(bad).raises(ValueError('fail'))
+        expect(self.ch.logger.exception).any_args()
+
+        queue = Queue.Queue()
+        queue.put((consumer, ok))
+        queue.put((consumer, bad))
+        queue.put(None)
+        pool._work(queue)
+
+        expect(self.ch.basic.ack).args(1)
+        expect(self.ch.basic.reject).args(2, requeue=True)
+        pool.flush()
+        assert_equals(0, len(pool._completions))
+
+    def test_flush_timer_runs_while_messages_are_in_flight(self):
+        acker = mock()
+        pool = WorkerPool(self.ch, acker=acker)
+        pool._queues = [Queue.Queue()]
+        pool.consumer('consumer')('msg')
+        timer = pool._flush_timer
+
+        # Still with a worker, so the timer is rescheduled
+        pool._flush_cb()
+        assert_true(pool._flush_timer.active)
+        assert_false(pool._flush_timer is timer)
+
+        pool.reject(5)
+        pool._finished.append(None)
+        expect(acker.reject).args(5, requeue=False)
+        pool._flush_cb()
+        assert_equals(0, pool._in_flight)
+        assert_equals(None, pool._flush_timer)
+
+    def test_acks_sent_without_reads_returning_data(self):
+        acker = mock()
+        pool = WorkerPool(self.ch, workers=1, auto_ack=True, acker=acker,
+                          flush_interval=0.001)
+        pool.start()
+        msg = self.msg(1)
+        consumer = mock()
+        expect(consumer).args(msg)
+        expect(acker.ack).args(1)
+        pool.consumer(consumer)(msg)
+
+        # Stands in for the blocking reads of read_frames(), which wait no
+        # longer than the next timer
+        timers = self.ch.connection.timers
+        while len(timers):
+            time.sleep(timers.run() or 0)
+        assert_equals(0, pool._in_flight)
+        pool.stop()
+
+    def test_closed_cb(self):
+        pool = WorkerPool(self.ch)
+        pool._queues = [Queue.Queue()]
+        pool.consumer('consumer')('msg')
+        timer = pool._flush_timer
+        pool.ack(1)
+        pool._closed_cb(self.ch)
+        assert_equals(0, len(pool._completions))
+        assert_false(timer.active)
+
+        # Acks queued by the workers after the channel closed are dropped
+        pool.ack(2)
+        pool.flush()
+        assert_equals(0, len(pool._completions))